@@ -0,0 +1,368 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+from watchdog.events import FileModifiedEvent
+
+from handlers.file_event_handler import FileEventHandler
+from handlers.file_history_handler import FileHistoryHandler
+from handlers.completion_handler import CompletionHandler
+from utils.utils import Utils
+from utils.snapshot_store import SnapshotStore
+from utils.diff_engine import create_diff_engine
+from utils.diff_pool import DiffPool
+from utils.file_repr import FileRepr
+from utils.payload_builder import PayloadBuilder, estimate_tokens
+from utils.diff_serializer import create_serializer
+
+# Reproducible benchmarks on synthetic trees. Results are written as JSON, and
+# two result files can be compared with `--compare`:
+#
+#   $ python benchmark.py --files 5000 --output before.json
+#   $ python benchmark.py --files 5000 --output after.json --compare before.json
+
+WORDS = (
+    "def class return import self value index items result error path file data "
+    "for while if else try except with yield async await None True False"
+).split()
+
+# Metrics where a larger value is an improvement, used to flag regressions
+HIGHER_IS_BETTER = ('_per_s',)
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def percentile(values: List[float], share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def text_lines(rng: random.Random, size: int) -> List[str]:
+    lines, total = [], 0
+    while total < size:
+        line = " ".join(rng.choices(WORDS, k=rng.randint(1, 12)))
+        lines.append(line)
+        total += len(line) + 1
+    return lines
+
+
+def generate_tree(
+        root: Path,
+        files: int,
+        depth: int,
+        mean_size: int,
+        binary_share: float,
+        seed: int
+    ) -> Dict[str, List[Path]]:
+
+    # File sizes follow a log-normal distribution around `mean_size`, as in real
+    # repositories: many small files and a few large ones.
+    rng = random.Random(seed)
+    directories = [root]
+    for _ in range(max(1, files // 20)):
+        parent = rng.choice(directories)
+        if len(parent.relative_to(root).parts) < depth:
+            directories.append(parent / f"dir{len(directories)}")
+
+    generated = {'text': [], 'binary': []}
+    for i in range(files):
+        directory = rng.choice(directories)
+        directory.mkdir(parents=True, exist_ok=True)
+        size = max(1, int(rng.lognormvariate(0, 1) * mean_size / 1.65))
+        if rng.random() < binary_share:
+            path = directory / f"blob{i}.bin"
+            path.write_bytes(b'\x89PNG\r\n\x1a\n' + rng.randbytes(size))
+            generated['binary'].append(path)
+        else:
+            path = directory / f"module{i}.py"
+            path.write_text("\n".join(text_lines(rng, size)) + "\n")
+            generated['text'].append(path)
+    return generated
+
+
+def mutate(rng: random.Random, lines: List[str], share: float = 0.05) -> List[str]:
+    mutated = list(lines)
+    for _ in range(max(1, int(len(lines) * share))):
+        position = rng.randrange(len(mutated) + 1)
+        if rng.random() < 0.5 and position < len(mutated):
+            del mutated[position]
+        else:
+            mutated.insert(position, " ".join(rng.choices(WORDS, k=6)))
+    return mutated
+
+
+class StubCompletions:
+    # Stands in for `AsyncOpenAI().chat.completions`, recording what would be sent
+    def __init__(self) -> None:
+        self.requests: List[int] = []
+
+    async def create(self, model: str, messages: List[Dict], stream: bool = False):
+        self.requests.append(sum(estimate_tokens(message['content']) for message in messages))
+        message = SimpleNamespace(content="Stub commit message")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def bench_scan(utils: Utils, root: Path) -> Dict:
+    history = FileHistoryHandler(utils=utils, tree={}, store=SnapshotStore())
+    history.root_path = root
+    history.construct_tree()
+    scan = history.last_scan
+    seconds = max(scan['seconds'], 1e-9)
+    return {
+        'scan_seconds': round(scan['seconds'], 4),
+        'scan_files_per_s': round(scan['files'] / seconds, 1),
+        'scan_mb_per_s': round(scan['bytes'] / 1024 / 1024 / seconds, 2),
+        'scan_peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def bench_warm_restart(utils: Utils, root: Path, files: List[Path]) -> Dict:
+    # Restart on an unchanged tree with a baseline index, which should only check
+    # stat signatures. Files are backdated, a file modified within a second of being
+    # read is always read again.
+    backdated = time.time_ns() - 10 * 1_000_000_000
+    for path in files:
+        os.utime(path, ns=(backdated, backdated))
+
+    index_path = root / '.vcwatcher' / 'index.sqlite'
+    scans = []
+    for _ in range(2):
+        history = FileHistoryHandler(utils=utils, tree={}, store=SnapshotStore())
+        history.root_path = root
+        history.open_index(index_path)
+        history.construct_tree()
+        history.save_index()
+        history.index.close()
+        scans.append(history)
+    shutil.rmtree(index_path.parent, ignore_errors=True)
+
+    warm = scans[-1]
+    seconds = max(warm.last_scan['seconds'], 1e-9)
+    return {
+        'warm_scan_seconds': round(warm.last_scan['seconds'], 4),
+        'warm_scan_files_per_s': round(warm.last_scan['files'] / seconds, 1),
+        'warm_scan_stale_files': len(warm.stale),
+    }
+
+
+def bench_events(
+        utils: Utils,
+        root: Path,
+        text_files: List[Path],
+        events: int,
+        hot_files: int,
+        seed: int
+    ) -> Tuple[Dict, CompletionHandler]:
+
+    # A storm of saves on a few hot files, as produced by formatters and build tools
+    rng = random.Random(seed)
+    history = FileHistoryHandler(utils=utils, tree={}, store=SnapshotStore())
+    history.root_path = root
+    history.construct_tree()
+
+    completion = CompletionHandler('benchmark', stream=False)
+    handler = FileEventHandler(history, completion, utils)
+
+    queued: Dict[str, float] = {}
+    latencies: List[float] = []
+    process_file = handler.process_file
+
+    def timed_process_file(path: str) -> None:
+        process_file(path)
+        latencies.append(time.perf_counter() - queued.pop(path))
+    handler.process_file = timed_process_file
+
+    hot = rng.sample(text_files, min(hot_files, len(text_files)))
+    contents = {path: path.read_text().splitlines() for path in hot}
+    handler.queue.start()
+    start = time.perf_counter()
+    for _ in range(events):
+        path = rng.choice(hot)
+        contents[path] = mutate(rng, contents[path], share=0.01)
+        path.write_text("\n".join(contents[path]) + "\n")
+        queued.setdefault(str(path), time.perf_counter())
+        handler.on_modified(FileModifiedEvent(str(path)))
+    handler.queue.stop()
+    seconds = time.perf_counter() - start
+
+    return {
+        'events': events,
+        'events_processed': len(latencies),
+        'events_coalesced': handler.queue.coalesced,
+        'events_per_s': round(events / max(seconds, 1e-9), 1),
+        'event_latency_p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'event_latency_p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'event_latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'pending_files': len(completion.commit_cache),
+        'events_peak_rss_mb': peak_rss_mb(),
+    }, completion
+
+
+def bench_diff(text_files: List[Path], samples: int, seed: int, workers: int = 0) -> Dict:
+    rng = random.Random(seed)
+    pairs = []
+    for path in rng.sample(text_files, min(samples, len(text_files))):
+        lines = path.read_text().splitlines()
+        pairs.append(("\n".join(lines), "\n".join(mutate(rng, lines))))
+    size = sum(len(old) for old, _ in pairs)
+    line_count = sum(old.count("\n") + 1 for old, _ in pairs)
+
+    results = {}
+    for name in ('patience', 'myers'):
+        engine = create_diff_engine(name)
+        start = time.perf_counter()
+        for old, new in pairs:
+            engine.compare(old, new)
+        seconds = max(time.perf_counter() - start, 1e-9)
+        results[f'diff_{name}_lines_per_s'] = round(line_count / seconds, 1)
+        results[f'diff_{name}_mb_per_s'] = round(size / 1024 / 1024 / seconds, 2)
+
+    if workers > 0 and pairs:
+        # Every pair goes to the worker processes, which are started before timing
+        store = SnapshotStore()
+        reprs = [(FileRepr(None, old, store=store), FileRepr(None, new, store=store)) for old, new in pairs]
+        engine = create_diff_engine('patience')
+        pool = DiffPool(workers=workers, min_bytes=0)
+        try:
+            pool.map(engine, reprs[:1])
+            start = time.perf_counter()
+            pool.map(engine, reprs)
+            seconds = max(time.perf_counter() - start, 1e-9)
+        finally:
+            pool.close()
+        results['diff_pool_lines_per_s'] = round(line_count / seconds, 1)
+        results['diff_pool_mb_per_s'] = round(size / 1024 / 1024 / seconds, 2)
+    return results
+
+
+def bench_payload(utils: Utils, completion: CompletionHandler) -> Dict:
+    stub = StubCompletions()
+    completion.client = SimpleNamespace(chat=SimpleNamespace(completions=stub))
+    completion.payload_builder = PayloadBuilder(
+        utils.payload_chunk_tokens, utils.payload_total_tokens, create_serializer(utils.payload_format)
+    )
+    completion.commit_cache.context = utils.diff_context
+    diff_state, _ = completion.commit_cache.net_diffs()
+
+    start = time.perf_counter()
+    completion.generate_commit_msg()
+    chunks = completion.payload_builder.build(diff_state)
+    report = completion.payload_builder.report(diff_state, chunks)
+    return {
+        'payload_files': len(diff_state),
+        'payload_chunks': len(chunks),
+        'payload_requests': len(stub.requests),
+        'payload_tokens': sum(stub.requests),
+        'payload_diff_tokens': report['tokens'],
+        'payload_legacy_tokens': report['legacy_tokens'],
+        'payload_seconds': round(time.perf_counter() - start, 4),
+    }
+
+
+def run(args: argparse.Namespace) -> Dict:
+    workdir = Path(args.workdir)
+    if workdir.exists():
+        shutil.rmtree(workdir)
+    workdir.mkdir(parents=True)
+
+    utils = Utils()
+    utils.settle_time = args.settle_time
+    utils.max_event_latency = args.settle_time * 10
+    utils.index_path = None
+
+    try:
+        generated = generate_tree(workdir, args.files, args.depth, args.mean_size, args.binary_share, args.seed)
+        metrics = bench_scan(utils, workdir)
+        metrics.update(bench_warm_restart(utils, workdir, generated['text'] + generated['binary']))
+        event_metrics, completion = bench_events(
+            utils, workdir, generated['text'], args.events, args.hot_files, args.seed
+        )
+        metrics.update(event_metrics)
+        metrics.update(bench_diff(generated['text'], args.diff_samples, args.seed, args.diff_workers))
+        metrics.update(bench_payload(utils, completion))
+        metrics['peak_rss_mb'] = peak_rss_mb()
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    params = {name: value for name, value in vars(args).items() if name not in ('output', 'compare', 'keep')}
+    return {
+        'params': params,
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'metrics': metrics,
+    }
+
+
+def compare(previous: Dict, current: Dict) -> List[str]:
+    # One line per metric: previous and current values, and the relative change
+    lines = []
+    if previous.get('params') != current.get('params'):
+        lines.append("Warning: the runs used different parameters")
+    for name, value in current['metrics'].items():
+        old = previous.get('metrics', {}).get(name)
+        if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or not old:
+            continue
+        change = (value - old) / old * 100
+        better = change > 0 if name.endswith(HIGHER_IS_BETTER) else change < 0
+        marker = "" if abs(change) < 5 else (" (better)" if better else " (worse)")
+        lines.append(f"{name}: {old} -> {value} ({change:+.1f}%){marker}")
+    return lines
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark scanning, events, diffing and payload building.")
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--mean-size', type=int, default=4096, help="Mean file size in bytes")
+    parser.add_argument('--binary-share', type=float, default=0.1)
+    parser.add_argument('--events', type=int, default=500)
+    parser.add_argument('--hot-files', type=int, default=20, help="Files receiving the event storm")
+    parser.add_argument('--diff-samples', type=int, default=200)
+    parser.add_argument('--diff-workers', type=int, default=0, help="Also diff the samples in this many processes")
+    parser.add_argument('--settle-time', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default='.vcwatcher-bench')
+    parser.add_argument('--keep', action='store_true', help="Keep the generated tree")
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    parser.add_argument('--compare', help="Previous results to compare against")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    print(json.dumps(results['metrics'], indent=4))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=4)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            print("\n".join(compare(json.load(file), results)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,25 +1,206 @@
-from openai  import OpenAI
-from typing import List
-from collections import defaultdict
+import asyncio
+import threading
+
+from typing import Callable, List, Mapping, Optional, Tuple
 
 from utils.utils import Utils
+from utils.payload_builder import PayloadBuilder, estimate_tokens
+from utils.diff_serializer import create_serializer
+from utils.response_cache import ResponseCache
+from utils.commit_cache import CommitCache
+from utils.file_repr import FileRepr
+from utils.metrics import Metrics, TOKEN_BUCKETS
+
+def retryable_errors() -> Tuple[type, ...]:
+    # openai is only imported once a client is built, see CompletionHandler.client
+    from openai import APIConnectionError, APITimeoutError, RateLimitError, InternalServerError
+    return (
+        APIConnectionError,
+        APITimeoutError,
+        RateLimitError,
+        InternalServerError,
+        asyncio.TimeoutError,
+    )
+
+NO_CHANGES_MSG = "\n No changes since the last generated commit message."
+COMMIT_HEADER = "\n Generated commit message: \n"
 
 class CompletionHandler:
-    def __init__(self, api_key: str) -> None:
-        self.client = OpenAI(api_key=api_key)
-        self.commit_cache: defaultdict[str, List[str]] = defaultdict(list)
-            
-    def store_commit(self, file_path: str, changes: List[str]) -> None:
-        self.commit_cache[file_path].append(changes)
-
-    def generate_commit_msg(self, diff_state: List[str]) -> str:
-        response = self.client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": Utils.content_prompt},
-                {"role": "user", "content": str(diff_state)}
-            ]
+    def __init__(
+            self,
+            api_key: str,
+            payload_builder: Optional[PayloadBuilder] = None,
+            max_concurrency: int = 4,
+            base_url: Optional[str] = None,
+            timeout: float = 60,
+            max_retries: int = 3,
+            retry_backoff: float = 1,
+            stream: bool = False,
+            on_token: Optional[Callable[[str], None]] = None,
+            model: str = "gpt-3.5-turbo",
+            cache: Optional[ResponseCache] = None,
+            commit_cache: Optional[CommitCache] = None,
+            metrics: Optional[Metrics] = None,
+            payload_format: Optional[str] = None
+        ) -> None:
+
+        # Retries are handled here, so they share the backoff and the concurrency limit.
+        # `base_url` lets a local stub server stand in for the API.
+        self.api_key = api_key
+        self.base_url = base_url
+        self._client = None
+        self.client_lock = threading.Lock()
+        self.commit_cache = commit_cache if commit_cache is not None else CommitCache()
+        self.payload_builder = payload_builder if payload_builder is not None else PayloadBuilder()
+        if payload_format is not None:
+            self.payload_builder.serializer = create_serializer(payload_format) # 'plain' or 'compact'
+        self.last_payload: Optional[dict] = None
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.stream = stream
+        self.on_token = on_token if on_token is not None else (lambda token: print(token, end='', flush=True))
+        self.model = model
+        self.cache = cache if cache is not None else ResponseCache()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.loop = asyncio.new_event_loop() # Reused, since the client's connections are bound to it
+
+    @property
+    def client(self):
+        # Built on first use: importing openai, with its httpx and pydantic tree,
+        # takes longer than the rest of startup put together
+        with self.client_lock:
+            if self._client is None:
+                from openai import AsyncOpenAI
+                self._client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0)
+            return self._client
+
+    @client.setter
+    def client(self, client) -> None:
+        # A stub client stands in for the API, e.g. in the benchmark
+        self._client = client
+
+    def store_commit(self, file_path: str, old: Optional[FileRepr], new: Optional[FileRepr]) -> None:
+        self.commit_cache.store(file_path, old, new)
+
+    async def request(self, prompt: str, content: str, tokens: Optional[List[str]] = None) -> str:
+        # Streams into `tokens` when given, printing each token as it arrives
+        messages = [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": content}
+        ]
+        if tokens is None:
+            response = await self.client.chat.completions.create(model=self.model, messages=messages)
+            return response.choices[0].message.content
+
+        response = await self.client.chat.completions.create(
+            model=self.model, messages=messages, stream=True
         )
-        commit_header = "\n Generated commit message: \n"
-        commit_msg = response.choices[0].message.content
-        return commit_header + commit_msg
+        async for chunk in response:
+            token = chunk.choices[0].delta.content if chunk.choices else None
+            if token:
+                tokens.append(token)
+                self.on_token(token)
+        return "".join(tokens)
+
+    async def complete(self, prompt: str, content: str, stream: bool = False) -> str:
+        key = self.cache.key(self.model, prompt, content)
+        response = self.cache.get(key)
+        if response is not None:
+            self.metrics.inc('llm_requests_total', outcome='cached')
+            if stream:
+                self.on_token(response)
+            return response
+
+        self.metrics.observe('llm_payload_tokens', estimate_tokens(prompt + content), buckets=TOKEN_BUCKETS)
+        for attempt in range(self.max_retries + 1):
+            tokens = [] if stream else None
+            try:
+                async with self.semaphore:
+                    with self.metrics.span('llm_request'):
+                        response = await asyncio.wait_for(self.request(prompt, content, tokens), self.timeout)
+                self.metrics.inc('llm_requests_total', outcome='ok')
+                break
+            except retryable_errors():
+                # Tokens already printed cannot be taken back, so a broken stream is not retried
+                if attempt == self.max_retries or tokens:
+                    self.metrics.inc('llm_requests_total', outcome='error')
+                    raise
+                self.metrics.inc('llm_requests_total', outcome='retry')
+                await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+
+        self.cache.put(key, response)
+        return response
+
+    async def summarize(self, prompt: str, chunks: List[str]) -> List[str]:
+        return list(await asyncio.gather(*(self.complete(prompt, chunk) for chunk in chunks)))
+
+    async def asummarize_chunk(self, chunk: str) -> str:
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        return await self.complete(Utils.summary_prompt, chunk)
+
+    def summarize_chunk(self, chunk: str) -> str:
+        # A single summary outside of commit-generate, e.g. of one file in the background
+        return self.loop.run_until_complete(self.asummarize_chunk(chunk))
+
+    async def agenerate_commit_msg(
+            self,
+            diff_state: Mapping[str, List],
+            summaries: Optional[Mapping[str, str]] = None
+        ) -> str:
+
+        # Files with a summary made ahead of time are not sent again, only merged
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        summaries = summaries or {}
+        remaining = {file_path: changes for file_path, changes in diff_state.items() if file_path not in summaries}
+        chunks = self.payload_builder.build(remaining) if remaining else []
+        self.last_payload = self.payload_builder.report(remaining, chunks)
+        self.metrics.inc('payload_tokens_total', self.last_payload['tokens'])
+        self.metrics.inc('payload_legacy_tokens_total', self.last_payload['legacy_tokens'])
+        if summaries:
+            self.metrics.inc('speculative_summaries_used_total', len(summaries))
+
+        if len(chunks) <= 1 and not summaries:
+            prompt, content = Utils.content_prompt, chunks[0] if chunks else ""
+        else:
+            # Map: summarize each chunk concurrently. Reduce: merge the partial
+            # summaries, in several rounds if they do not fit in a single chunk.
+            partial = [summaries[file_path] for file_path in sorted(summaries)]
+            partial += await self.summarize(Utils.summary_prompt, chunks)
+            while len(partial) > 1 and estimate_tokens("\n\n".join(partial)) > self.payload_builder.chunk_tokens:
+                groups = [partial[i:i + 2] for i in range(0, len(partial), 2)]
+                partial = await self.summarize(Utils.merge_prompt, ["\n\n".join(group) for group in groups])
+            prompt, content = Utils.merge_prompt, "\n\n".join(partial)
+
+        if self.stream:
+            self.on_token(COMMIT_HEADER)
+        commit_msg = await self.complete(prompt, content, stream=self.stream)
+        return COMMIT_HEADER + commit_msg
+
+    def generate_commit_msg(
+            self,
+            diff_state: Optional[Mapping[str, List]] = None,
+            commit_cache: Optional[CommitCache] = None
+        ) -> str:
+
+        # Without explicit diffs, the net changes of the commit cache are used, and
+        # their baselines advanced once the message was generated successfully.
+        if diff_state is not None:
+            return self.loop.run_until_complete(self.agenerate_commit_msg(diff_state))
+
+        commit_cache = commit_cache if commit_cache is not None else self.commit_cache
+        with self.metrics.span('diff'):
+            diff_state, snapshot = commit_cache.net_diffs()
+        if not diff_state:
+            return NO_CHANGES_MSG
+
+        summaries = {
+            file_path: summary for file_path, summary in commit_cache.speculative_summaries().items()
+            if file_path in diff_state
+        }
+        with self.metrics.span('generate'):
+            commit_msg = self.loop.run_until_complete(self.agenerate_commit_msg(diff_state, summaries))
+        commit_cache.advance(snapshot)
+        return commit_msg
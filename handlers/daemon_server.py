@@ -0,0 +1,134 @@
+import os
+import json
+import socket
+import logging
+import threading
+
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingUnixStreamServer
+from typing import Any, Callable, Dict, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+from utils.utils import make_state_dir
+
+# (method, path) -> callable taking the request parameters as keyword arguments
+Commands = Dict[Tuple[str, str], Callable[..., Any]]
+
+
+class TextResponse(str):
+    # Returned by commands whose result is sent as is, e.g. Prometheus metrics
+    pass
+
+
+class UnixHTTPServer(ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    def address_string(self) -> str:
+        # Unix socket clients have no host and port
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'local'
+
+    def log_message(self, format: str, *args) -> None:
+        logging.debug(f"{self.address_string()} {format % args}")
+
+    def do_GET(self) -> None:
+        self.dispatch('GET')
+
+    def do_POST(self) -> None:
+        self.dispatch('POST')
+
+    def dispatch(self, method: str) -> None:
+        # The body is read first, replying before the client finished sending breaks its pipe
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        command = self.server.commands.get((method, url.path))
+        if command is None:
+            return self.reply(404, {'error': f"Unknown command: {method} {url.path}"})
+
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            if body:
+                fields = json.loads(body)
+                if not isinstance(fields, dict):
+                    raise ValueError("expected a JSON object")
+                params.update(fields)
+        except ValueError as e:
+            return self.reply(400, {'error': f"Invalid request body: {e}"})
+
+        # Commands share the watcher state, so they run one at a time
+        try:
+            with self.server.lock:
+                result = command(**params)
+        except TypeError as e:
+            return self.reply(400, {'error': str(e)})
+        except Exception as e:
+            logging.error(f"Error running {url.path}: {e}")
+            return self.reply(500, {'error': str(e)})
+
+        if isinstance(result, TextResponse):
+            return self.reply(200, result)
+        self.reply(200, {'result': result})
+
+    def reply(self, status: int, body: Any) -> None:
+        if isinstance(body, TextResponse):
+            data, content_type = body.encode('utf-8'), 'text/plain; version=0.0.4'
+        else:
+            data, content_type = json.dumps(body).encode('utf-8'), 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class DaemonServer:
+    # Serves VCWatcher commands as a small JSON over HTTP API, on a Unix socket,
+    # or on a localhost TCP port where Unix sockets are not available.
+    def __init__(self, commands: Commands) -> None:
+        self.commands = commands
+        self.server = None
+        self.socket_path: Optional[Path] = None
+
+    def bind(self, socket_path: Optional[Path] = None, port: int = 0) -> str:
+        if socket_path is not None and hasattr(socket, 'AF_UNIX'):
+            make_state_dir(socket_path.parent)
+            self.remove_stale_socket(socket_path)
+            self.server = UnixHTTPServer(str(socket_path), DaemonRequestHandler)
+            os.chmod(socket_path, 0o600) # Only the owner may drive the watcher
+            self.socket_path = socket_path
+            address = str(socket_path)
+        else:
+            self.server = ThreadingHTTPServer(('127.0.0.1', port), DaemonRequestHandler)
+            address = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+        self.server.commands = self.commands
+        self.server.lock = threading.Lock()
+        return address
+
+    @staticmethod
+    def remove_stale_socket(socket_path: Path) -> None:
+        if not socket_path.exists():
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(str(socket_path))
+            except OSError:
+                socket_path.unlink() # Left behind by a daemon which did not exit cleanly
+                return
+        raise OSError(f"Another VCWatcher daemon is listening on {socket_path}")
+
+    def serve_forever(self) -> None:
+        self.server.serve_forever()
+
+    def shutdown(self) -> None:
+        # Must be called from another thread than the one serving
+        self.server.shutdown()
+
+    def close(self) -> None:
+        if self.server is not None:
+            self.server.server_close()
+        if self.socket_path is not None and self.socket_path.exists():
+            self.socket_path.unlink()
@@ -0,0 +1,103 @@
+import time
+import logging
+import threading
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class EventQueue:
+    # Coalesces file events per path. A path is handed to the worker once it has
+    # been quiet for `settle_time` seconds, or once it has been pending for
+    # `max_latency` seconds, so bursts collapse into a single diff per file.
+    def __init__(
+            self,
+            process_batch: Callable[[List[str]], None],
+            settle_time: float = 0.5,
+            max_latency: float = 5.0,
+            max_pending: int = 10000
+        ) -> None:
+
+        self.process_batch = process_batch
+        self.settle_time = settle_time
+        self.max_latency = max_latency
+        self.max_pending = max_pending
+
+        self.pending: Dict[str, Tuple[float, float]] = {} # path -> (first_seen, last_seen)
+        self.coalesced = 0
+        self.condition = threading.Condition()
+        self.worker: Optional[threading.Thread] = None
+        self.running = False
+
+    def put(self, path: str) -> None:
+        with self.condition:
+            now = time.monotonic()
+            if path in self.pending:
+                first_seen, _ = self.pending[path]
+                self.pending[path] = (first_seen, now)
+                self.coalesced += 1
+                return
+
+            # Apply backpressure instead of dropping events when the queue is full
+            while self.running and len(self.pending) >= self.max_pending:
+                self.condition.notify_all()
+                self.condition.wait()
+
+            self.pending[path] = (now, now)
+            self.condition.notify_all()
+
+    def take_ready(self, force: bool = False) -> Tuple[List[str], Optional[float]]:
+        # Must be called with the condition held. Returns the ready paths and
+        # the time to wait until the next pending path becomes ready.
+        now = time.monotonic()
+        flush_all = force or len(self.pending) >= self.max_pending
+        ready, wait = [], None
+
+        for path, (first_seen, last_seen) in self.pending.items():
+            due = min(last_seen + self.settle_time, first_seen + self.max_latency)
+            if flush_all or due <= now:
+                ready.append(path)
+            else:
+                wait = due - now if wait is None else min(wait, due - now)
+
+        for path in ready:
+            del self.pending[path]
+        if ready:
+            self.condition.notify_all()
+        return ready, wait
+
+    def drain(self) -> None:
+        with self.condition:
+            batch, _ = self.take_ready(force=True)
+        if batch:
+            self.process_batch(batch)
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                batch, wait = self.take_ready()
+                while not batch and self.running:
+                    self.condition.wait(timeout=wait)
+                    batch, wait = self.take_ready()
+                if not batch and not self.running:
+                    return
+
+            try:
+                self.process_batch(batch)
+            except Exception as e:
+                logging.error(f"Error processing events: {e}")
+
+    def start(self) -> None:
+        if self.worker is not None and self.worker.is_alive():
+            return
+        self.running = True
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.worker is not None:
+            self.worker.join()
+        self.drain()
@@ -1,7 +1,9 @@
-import time
-import logging
+import os
+import threading
 
-from watchdog.events import FileSystemEvent, FileSystemEventHandler
+from typing import Dict, List, Optional, Tuple
+
+from watchdog.events import FileSystemEvent, FileSystemMovedEvent, FileSystemEventHandler
 
 # For typing only -->
 from .completion_handler import CompletionHandler
@@ -9,12 +11,20 @@ from .file_history_handler import FileHistoryHandler
 from utils.utils import Utils
 # For typing only -->
 
+from .event_queue import EventQueue
+from utils.commit_cache import CommitCache
+from utils.file_repr import FileRepr
+from utils.metrics import Metrics
+
 class FileEventHandler(FileSystemEventHandler):
     def __init__(
             self, 
             history_handler: FileHistoryHandler,
             completion_handler: CompletionHandler,
-            utils: Utils
+            utils: Utils,
+            queue: Optional[EventQueue] = None,
+            commit_cache: Optional[CommitCache] = None,
+            metrics: Optional[Metrics] = None
         ) -> None:
 
         super().__init__()
@@ -22,33 +32,139 @@ class FileEventHandler(FileSystemEventHandler):
         self.history_handler = history_handler
         self.completion_handler = completion_handler
         self.utils = utils
+        self.commit_cache = commit_cache # Separate pending changes per root when watching several
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        # Renames seen but not processed yet, destination -> original source. Both paths
+        # are queued, so the rename is reconciled once the burst of events has settled.
+        self.moves: Dict[str, str] = {}
+        self.moves_lock = threading.Lock()
+
+        # Several roots can share one queue, and so one worker thread
+        self.queue = queue if queue is not None else EventQueue(
+            self.process_batch,
+            settle_time=self.utils.settle_time,
+            max_latency=self.utils.max_event_latency,
+            max_pending=self.utils.max_pending_events
+        )
 
-        
     def on_modified(self, event: FileSystemEvent) -> None:
         if not event.is_directory:
-    
-            current_time = time.time()
-            if current_time - self.utils.last_modified_time < self.utils.debounce_time:
-                return
-            
-            self.utils.last_modified_time = current_time
-            self.utils.modified_file_path = event.src_path
-
-            # Store file content before changes
-            old = self.history_handler.get_file_repr()
-
-            # Reconstruct tree with new changes
-            self.history_handler.construct_tree()
-
-            # Store file content after changes
-            new = self.history_handler.get_file_repr()
-
-            # Collect diffs and store in memory
-            try:
-                diffs = self.history_handler.compare_files(old.file_content, new.file_content)
-                self.completion_handler.store_commit(self.utils.modified_file_path, diffs)
-            except AttributeError as e:
-                logging.error((f"Error comparing files: {e}"))     
-
-            return super().on_modified(event)
-      
\ No newline at end of file
+            self.enqueue(event.src_path)
+        return super().on_modified(event)
+
+    def on_created(self, event: FileSystemEvent) -> None:
+        # Files of a directory moved in from outside get their own created events
+        if not event.is_directory:
+            self.enqueue(event.src_path)
+        return super().on_created(event)
+
+    def on_deleted(self, event: FileSystemEvent) -> None:
+        self.enqueue(event.src_path, event.is_directory)
+        return super().on_deleted(event)
+
+    def on_moved(self, event: FileSystemMovedEvent) -> None:
+        src_ignored = self.history_handler.is_ignored(event.src_path, event.is_directory)
+        dest_ignored = self.history_handler.is_ignored(event.dest_path, event.is_directory)
+        if not src_ignored and not dest_ignored:
+            with self.moves_lock:
+                # Renamed again before it was processed: a -> b -> c is a -> c
+                source = self.moves.pop(event.src_path, event.src_path)
+                if source != event.dest_path:
+                    self.moves[event.dest_path] = source
+
+        # Otherwise a temporary file saved over a watched one, or a file moved to an
+        # ignored path, which are a change and a deletion of the watched path
+        self.enqueue(event.src_path, event.is_directory)
+        self.enqueue(event.dest_path, event.is_directory)
+        return super().on_moved(event)
+
+    def enqueue(self, path: str, is_dir: bool = False) -> None:
+        self.metrics.inc('events_received_total')
+        if os.path.basename(path) in self.utils.ignore_files:
+            self.history_handler.ignore.invalidate()
+
+        # Ignored paths are dropped before they take a slot in the queue
+        if self.history_handler.is_ignored(path, is_dir):
+            self.metrics.inc('events_dropped_total', reason='ignored')
+        else:
+            # Events are coalesced per path, the actual work happens on the queue worker
+            self.queue.put(path)
+
+    def process_batch(self, paths: List[str]) -> None:
+        for path in paths:
+            self.process_file(path)
+
+    def process_file(self, path: str) -> None:
+        with self.metrics.trace_event('event', path=path):
+            self.handle_change(path)
+
+    def take_move(self, path: str) -> Optional[Tuple[str, str]]:
+        # The pending rename `path` is either end of
+        with self.moves_lock:
+            if path in self.moves:
+                return self.moves.pop(path), path
+            for dest, source in self.moves.items():
+                if source == path:
+                    del self.moves[dest]
+                    return source, dest
+        return None
+
+    def handle_change(self, path: str) -> None:
+        move = self.take_move(path)
+        if move is not None:
+            return self.handle_move(*move)
+
+        self.utils.modified_file_path = path
+        removed = self.history_handler.remove_directory(path)
+        if removed:
+            for file_path, old in removed:
+                self.store(file_path, old, None)
+            return
+
+        # Re-read only the modified file, storing its content before and after changes
+        old, new = self.history_handler.update_file(self.utils.modified_file_path)
+
+        # Content did not change (touch, save without edits), nothing to diff
+        if old is not None and old is new:
+            self.metrics.inc('events_skipped_total', reason='unchanged')
+            return
+
+        # Created and removed again before the events settled, e.g. an editor's temporary file
+        if old is None and new is None:
+            self.metrics.inc('events_skipped_total', reason='transient')
+            return
+
+        self.store(self.utils.modified_file_path, old, new)
+
+    def handle_move(self, src: str, dest: str) -> None:
+        # Editors saving atomically rename the original away and write a new file, or
+        # write a temporary file and rename it over the original. Renames whose
+        # destination is gone already, or which did not move any watched file, are
+        # handled as plain changes of both paths, so they reduce to a modification.
+        moved = self.history_handler.move_path(src, dest) if os.path.exists(dest) else []
+        if not moved:
+            self.handle_change(src)
+            self.handle_change(dest)
+            return
+
+        self.metrics.inc('events_reconciled_total', kind='rename')
+        commit_cache = self.commit_cache if self.commit_cache is not None else self.completion_handler.commit_cache
+        for old_path, new_path, file_repr, replaced in moved:
+            if new_path is None:
+                commit_cache.store(old_path, file_repr, None)
+            else:
+                commit_cache.move(old_path, new_path, file_repr, replaced)
+
+        # Also picks up a file saved at its new path since the rename
+        if os.path.isfile(dest):
+            self.handle_change(dest)
+        if os.path.exists(src):
+            self.handle_change(src)
+
+    def store(self, path: str, old: Optional[FileRepr], new: Optional[FileRepr]) -> None:
+        # Only the baseline and latest version are kept, the net diff is computed on commit-generate
+        if self.commit_cache is not None:
+            self.commit_cache.store(path, old, new)
+        else:
+            self.completion_handler.store_commit(path, old, new)
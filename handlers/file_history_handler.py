@@ -1,77 +1,414 @@
+import os
 import json
-import difflib
+import time
+import logging
+import threading
 
 from pathlib import Path
-from typing import Dict, List, Optional
+from functools import partial
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 from utils.file_repr import FileRepr, FileReprEncoder
-from utils.utils import Utils
+from utils.snapshot_store import SnapshotStore, read_and_hash
+from utils.diff_engine import DiffEngine, PatienceDiffEngine
+from utils.baseline_index import BaselineIndex, IndexEntry
+from utils.file_classifier import SNIFF_SIZE, is_binary, detect_encoding
+from utils.ignore_rules import IgnoreRules
+from utils.metrics import Metrics, BYTES_BUCKETS
+from utils.utils import Utils, make_state_dir
 
 class FileHistoryHandler:
-    def __init__(self, utils: Utils, tree: dict = {}) -> None:
-        self.root_path = Path('.')
-        self.tree = tree
+    def __init__(
+            self,
+            utils: Utils,
+            tree: Optional[dict] = None,
+            store: Optional[SnapshotStore] = None,
+            diff_engine: Optional[DiffEngine] = None,
+            metrics: Optional[Metrics] = None
+        ) -> None:
+
+        self.tree = tree if tree is not None else {}
+        # Held while the tree or the index state changes: the queue worker updates
+        # files while the REPL or the daemon saves the index or scans again
+        self.lock = threading.RLock()
+        self.metrics = metrics if metrics is not None else Metrics()
         self.utils = utils
+        self.root_path = Path('.')
+        self.store = store if store is not None else SnapshotStore()
+        self.diff_engine = diff_engine if diff_engine is not None else PatienceDiffEngine()
         self.visited: set[Path] = set() # Cache for visited directories to avoid RecursionError
-    
+        self.skipped = {'stat': 0, 'hash': 0} # Events skipped because the file did not change
+        self.last_scan = {'files': 0, 'bytes': 0, 'seconds': 0.0}
+
+        self.index: Optional[BaselineIndex] = None
+        self.indexed: Dict[str, IndexEntry] = {} # Index entries not yet matched by the scan in progress
+        self.dirty: set[str] = set() # Relative paths changed since the index was last saved
+        self.removed: set[str] = set() # Relative paths deleted since the index was last saved
+        self.stale: List[str] = [] # Files restored from the index which changed on disk since
+        self.indexed_blobs: set[str] = set() # Hashes of the blobs in the index
+
+        # Flat views of `tree`, keyed by '/' separated paths relative to the root
+        self.files: Dict[str, FileRepr] = {}
+        self.dirs: Dict[str, Dict] = {}
+        self.reindex()
+
+    @property
+    def root_path(self) -> Path:
+        return self._root_path
+
+    @root_path.setter
+    def root_path(self, root_path: Path) -> None:
+        # Ignore rules are read relative to the root, so they follow it
+        self._root_path = Path(root_path)
+        self.ignore = IgnoreRules(
+            self._root_path,
+            ignore_files=self.utils.ignore_files,
+            excluded_dirs=self.utils.excluded_dirs,
+            excluded_files=self.utils.excluded_files
+        )
+
+    def is_ignored(self, file_path: str, is_dir: bool = False) -> bool:
+        parts = self.relative_parts(file_path)
+        if not parts:
+            return True # The root itself, or outside of it
+        return self.ignore.is_ignored('/'.join(parts), is_dir)
+
     def get_directory_tree(self, current_path = None) -> Dict:
-        tree = {}
-        
         if current_path is None:
             current_path = self.root_path
 
-        for path in current_path.iterdir():
-            file_repr = FileRepr()
+        # Directories are walked serially, file reads are spread over a thread pool
+        start = time.perf_counter()
+        parts = self.relative_parts(str(current_path))
+        prefix = '/'.join(parts) + '/' if parts else ''
+        pending: List[Tuple[Dict, str, str, Future]] = []
+        with ThreadPoolExecutor(max_workers=self.utils.scan_workers) as pool:
+            tree = self.scan_directory(current_path, pool, pending, prefix)
+            scanned_bytes = 0
+            for node, name, key, future in pending:
+                node[name] = self.files[key] = future.result()
+                scanned_bytes += node[name].st_size or 0
+
+        self.last_scan = {
+            'files': len(pending),
+            'bytes': scanned_bytes,
+            'seconds': time.perf_counter() - start,
+        }
+        return tree
 
-            if path.is_dir():
-                if path.name not in self.utils.excluded_dirs and path.resolve() not in self.visited:
-                    self.visited.add(path.resolve())
-                    tree[path.name] = self.get_directory_tree(path)
-                    file_repr.file_path = f"{current_path}/{path.name}"
+    def scan_directory(
+            self,
+            current_path: Path,
+            pool: ThreadPoolExecutor,
+            pending: List,
+            prefix: str = ''
+        ) -> Dict:
 
-            else:
-                if path.name not in self.utils.excluded_files:
-                    file_repr.file_path = f"{current_path}/{path.name}"
-                    try:
-                        with path.open('r', encoding='utf-8') as file:
-                            file_content = file.read()
-                            file_repr.file_content = file_content
-                    except Exception as e:
-                        file_content = f"Error reading file: {e}"
-                        file_repr.file_content = file_content
-
-                    tree[path.name] = file_repr
+        tree = self.dirs[prefix[:-1]] = {}
+
+        with os.scandir(current_path) as entries:
+            for entry in entries:
+                path = current_path / entry.name
+
+                # Ignored directories are pruned along with their whole subtree
+                if entry.is_dir():
+                    if not self.ignore.match(prefix + entry.name, is_dir=True):
+                        resolved = Path(os.path.realpath(entry.path))
+                        if resolved not in self.visited:
+                            self.visited.add(resolved)
+                            tree[entry.name] = self.scan_directory(
+                                path, pool, pending, f"{prefix}{entry.name}/"
+                            )
+
+                elif not self.ignore.match(prefix + entry.name):
+                    key = prefix + entry.name
+                    indexed = self.indexed.pop(key, None)
+                    if indexed is not None:
+                        future = pool.submit(self.restore_file, path, indexed)
+                    else:
+                        future = pool.submit(self.read_file, path)
+                        self.dirty.add(key)
+
+                    tree[entry.name] = None # Keeps directory listing order
+                    pending.append((tree, entry.name, key, future))
         return tree
 
+    def restore_file(self, path: Path, indexed: IndexEntry) -> FileRepr:
+        # Uses the baseline stored in the index. Files whose stat changed since are
+        # kept with that old baseline and queued in `stale`, so the changes made
+        # while VCWatcher was not running still show up as diffs. The content is
+        # only read from the index when it is first diffed, so a warm start costs
+        # a stat per file rather than a read of the whole tree.
+        file_repr = FileRepr(file_path=f"{path.parent}/{path.name}", store=self.store)
+        if indexed.kind == 'text':
+            if indexed.content_hash not in self.indexed_blobs:
+                return self.read_file(path)
+            file_repr.set_lazy(
+                indexed.content_hash, indexed.st_size, partial(self.index_blob, indexed.content_hash), indexed.encoding
+            )
+        else:
+            file_repr.set_digest(indexed.content_hash, indexed.kind)
+        file_repr.st_size = indexed.st_size
+        file_repr.st_mtime_ns = indexed.st_mtime_ns
+        file_repr.st_ino = indexed.st_ino
+        file_repr.read_ns = indexed.read_ns
+
+        try:
+            unchanged = file_repr.stat_matches(path.stat())
+        except OSError:
+            unchanged = False
+        if not unchanged:
+            self.stale.append(str(path))
+        return file_repr
+
+    def index_blob(self, content_hash: str) -> Optional[Tuple[bytes, str]]:
+        blob = self.index.compressed_blob(content_hash) if self.index is not None else None
+        return None if blob is None else (blob, 'zlib')
+
+    def scan_report(self) -> str:
+        files, size, seconds = self.last_scan['files'], self.last_scan['bytes'], self.last_scan['seconds']
+        seconds = max(seconds, 1e-9)
+        return (
+            f"Scanned {files} files ({size / 1024 / 1024:.1f} MB) in {seconds:.2f}s: "
+            f"{files / seconds:.0f} files/s, {size / 1024 / 1024 / seconds:.1f} MB/s"
+        )
+
+    def read_file(self, path: Path, old: Optional[FileRepr] = None) -> FileRepr:
+        # Returns `old` itself when the file did not change since it was read
+        file_repr = FileRepr(file_path=f"{path.parent}/{path.name}", store=self.store)
+        try:
+            read_ns = time.time_ns()
+            stat = path.stat()
+            if old is not None and old.stat_matches(stat):
+                self.skipped['stat'] += 1
+                self.metrics.inc('files_skipped_total', reason='stat')
+                return old
+
+            # Oversized files are hashed while streaming, but never held in memory
+            oversized = stat.st_size > self.utils.max_file_size
+            with self.metrics.span('read'):
+                data, digest = read_and_hash(path, keep=not oversized)
+            self.metrics.observe('read_bytes', stat.st_size, buckets=BYTES_BUCKETS)
+            if old is not None and old.content_hash == digest:
+                old.set_stat(stat, read_ns)
+                self.skipped['hash'] += 1
+                self.metrics.inc('files_skipped_total', reason='hash')
+                return old
+
+            encoding = None if oversized or is_binary(data[:SNIFF_SIZE]) else detect_encoding(data)
+            if oversized:
+                file_repr.set_digest(digest, 'oversized')
+            elif encoding is None:
+                file_repr.set_digest(digest, 'binary')
+            else:
+                file_repr.set_data(data, digest, encoding)
+            file_repr.set_stat(stat, read_ns)
+        except OSError as e:
+            logging.error(f"Error reading file: {e}")
+            file_repr.kind = 'unreadable'
+        return file_repr
+
     def construct_tree(self) -> None:
-        self.visited.clear() # Clear visited cache before constructing
-        self.tree = {'.': self.get_directory_tree()}
+        with self.lock:
+            self.visited.clear() # Clear visited cache before constructing
+            self.ignore.invalidate() # Ignore files may have changed since the last scan
+            self.files, self.dirs = {}, {}
+            self.stale = []
+            if self.index is not None:
+                self.indexed = self.index.load()
+                self.indexed_blobs = self.index.blob_hashes()
+
+            self.tree = {'.': self.get_directory_tree()}
+
+            # Whatever the scan did not match was deleted while VCWatcher was not running
+            self.removed.update(self.indexed)
+            self.indexed = {}
+
+    def open_index(self, index_path: Path) -> None:
+        make_state_dir(index_path.parent)
+        self.index = BaselineIndex(str(index_path))
+
+    def save_index(self) -> None:
+        if self.index is None:
+            return
+
+        with self.lock:
+            entries = []
+            for key in self.dirty:
+                file_repr = self.files.get(key)
+                if file_repr is None or file_repr.st_mtime_ns is None:
+                    continue # Unreadable files are simply read again on the next start
+                entry = IndexEntry(
+                    file_repr.st_size,
+                    file_repr.st_mtime_ns,
+                    file_repr.st_ino,
+                    file_repr.read_ns,
+                    file_repr.content_hash,
+                    file_repr.kind,
+                    file_repr.encoding
+                )
+                data = self.store.get(file_repr.content_hash) if file_repr.in_store else None
+                entries.append((key, entry, data))
+
+            self.index.save(entries, self.removed - self.dirty, keep=self.store.lazy_digests())
+            self.dirty.clear()
+            self.removed.clear()
 
     def show_directory_tree(self) -> None:
         print(json.dumps(self.tree, cls=FileReprEncoder, indent=4))
 
-    def get_file_repr(self) -> Optional[FileRepr]:
-        path_parts = self.utils.modified_file_path.split('\\')
-
-        if path_parts[0] != '.':
-            path_parts[0] = '.'
-
-        current = self.tree
-  
-        for part in path_parts:
-            if part in self.utils.excluded_dirs or part in self.utils.excluded_files:
-                return f"Warning: '{self.utils.modified_file_path}' found in excluded."
-            try:
-                current = current[part]
-            except KeyError:
+    def relative_parts(self, file_path: str) -> Optional[Tuple[str, ...]]:
+        relative = os.path.relpath(file_path.replace('\\', '/'), self.root_path)
+        parts = Path(relative).parts
+        if parts and parts[0] == '..':
+            return None # Outside of the observed root
+        return tuple(part for part in parts if part != '.')
+
+    def reindex(self) -> None:
+        # Rebuilds the flat views, for a tree which was not built by a scan
+        self.files, self.dirs = {}, {}
+        stack = [('', self.tree.get('.'))]
+        while stack:
+            directory, node = stack.pop()
+            if not isinstance(node, dict):
                 continue
-        return current
+            self.dirs[directory] = node
+            for name, child in node.items():
+                key = f"{directory}/{name}" if directory else name
+                if isinstance(child, dict):
+                    stack.append((key, child))
+                elif isinstance(child, FileRepr):
+                    self.files[key] = child
+
+    def directory_node(self, directory: str) -> Dict:
+        # Only directories created since the scan walk the tree
+        node = self.dirs.get(directory)
+        if node is None:
+            if directory:
+                parent_dir, _, name = directory.rpartition('/')
+                parent = self.directory_node(parent_dir)
+                node = parent.get(name)
+                if not isinstance(node, dict):
+                    node = parent[name] = {}
+            else:
+                node = self.tree.setdefault('.', {})
+            self.dirs[directory] = node
+        return node
+
+    def update_file(self, file_path: str) -> Tuple[Optional[FileRepr], Optional[FileRepr]]:
+        # Re-read only the changed file and patch its node in place, so the cost
+        # of a save scales with the file size rather than the repository size.
+        with self.lock:
+            parts = self.relative_parts(file_path)
+            if not parts:
+                return None, None
+
+            key = '/'.join(parts)
+            if self.ignore.is_ignored(key):
+                return None, None
+
+            directory, _, file_name = key.rpartition('/')
+            old = self.files.get(key)
+            path = self.root_path.joinpath(*parts)
+            if not path.is_file():
+                if old is not None:
+                    del self.files[key]
+                    self.directory_node(directory).pop(file_name, None)
+                self.removed.add(key)
+                self.dirty.discard(key)
+                return old, None
+
+            new = self.read_file(path, old)
+            if new is not old:
+                self.files[key] = new
+                self.directory_node(directory)[file_name] = new
+                self.dirty.add(key)
+            return old, new
 
+    def move_path(
+            self,
+            src_path: str,
+            dest_path: str
+        ) -> List[Tuple[str, Optional[str], FileRepr, Optional[FileRepr]]]:
+
+        # Relocates the nodes of a renamed file or directory without reading them again.
+        # Returns (old path, new path, file, file replaced at the new path) per moved file,
+        # the new path being None when the file was moved to an ignored path.
+        with self.lock:
+            src_parts, dest_parts = self.relative_parts(src_path), self.relative_parts(dest_path)
+            if not src_parts or not dest_parts:
+                return []
+
+            src_key, dest_key = '/'.join(src_parts), '/'.join(dest_parts)
+            if src_key in self.files:
+                keys = [src_key]
+            else:
+                prefix = src_key + '/'
+                keys = [key for key in self.files if key.startswith(prefix)]
+
+            moved = []
+            for key in keys:
+                suffix = key[len(src_key):]
+                new_key = dest_key + suffix
+                file_repr = self.files.pop(key)
+                directory, _, file_name = key.rpartition('/')
+                self.directory_node(directory).pop(file_name, None)
+                self.removed.add(key)
+                self.dirty.discard(key)
+
+                if self.ignore.is_ignored(new_key):
+                    moved.append((src_path + suffix, None, file_repr, None))
+                    continue
+
+                new_directory, _, new_name = new_key.rpartition('/')
+                replaced = self.files.get(new_key)
+                file_repr.file_path = dest_path + suffix
+                self.files[new_key] = self.directory_node(new_directory)[new_name] = file_repr
+                self.dirty.add(new_key)
+                moved.append((src_path + suffix, dest_path + suffix, file_repr, replaced))
+
+            if src_key in self.dirs:
+                self.drop_directory(src_key)
+            return moved
+
+    def remove_directory(self, dir_path: str) -> List[Tuple[str, FileRepr]]:
+        # A deleted directory, or one moved out of the root, takes all its files along
+        with self.lock:
+            parts = self.relative_parts(dir_path)
+            if not parts or '/'.join(parts) not in self.dirs or os.path.isdir(dir_path):
+                return []
+
+            dir_key = '/'.join(parts)
+            prefix = dir_key + '/'
+            removed = []
+            for key in [key for key in self.files if key.startswith(prefix)]:
+                removed.append((dir_path + key[len(dir_key):], self.files.pop(key)))
+                self.removed.add(key)
+                self.dirty.discard(key)
+            self.drop_directory(dir_key)
+            return removed
+
+    def drop_directory(self, dir_key: str) -> None:
+        parent_dir, _, name = dir_key.rpartition('/')
+        self.directory_node(parent_dir).pop(name, None)
+        prefix = dir_key + '/'
+        for key in [key for key in self.dirs if key == dir_key or key.startswith(prefix)]:
+            del self.dirs[key]
+
+    def get_file_repr(self) -> Optional[FileRepr]:
+        parts = self.relative_parts(self.utils.modified_file_path)
+        if not parts:
+            return None
 
+        key = '/'.join(parts)
+        if self.ignore.is_ignored(key):
+            return f"Warning: '{self.utils.modified_file_path}' found in excluded."
+        return self.files.get(key)
 
     def compare_files(self, old_file: str, new_file: str) -> List[str]:
-        diff = difflib.ndiff(old_file.splitlines(), new_file.splitlines())
-        differences = [line for line in diff if line.startswith('+ ') or line.startswith('- ')]
+        return self.diff_engine.compare(old_file, new_file)
 
-        return differences
+    def compare_hunks(self, old_file: str, new_file: str, context: int = 3) -> List[str]:
+        return self.diff_engine.unified(old_file, new_file, context)
 
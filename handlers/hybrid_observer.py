@@ -0,0 +1,478 @@
+import os
+import sys
+import ctypes
+import time
+import select
+import struct
+import logging
+import threading
+
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from watchdog.events import (
+    FileSystemEvent, FileSystemEventHandler, FileCreatedEvent, FileDeletedEvent,
+    FileModifiedEvent, FileMovedEvent, DirCreatedEvent, DirDeletedEvent, DirMovedEvent
+)
+
+# name -> (is_dir, st_mtime_ns, st_size)
+Entries = Dict[str, Tuple[bool, int, int]]
+
+
+def inotify_watch_limit() -> Optional[int]:
+    # Half of the per user limit, the other half is left to other programs
+    try:
+        with open('/proc/sys/fs/inotify/max_user_watches') as file:
+            return int(file.read()) // 2
+    except (OSError, ValueError):
+        return None # Not Linux, or no limit to worry about
+
+
+def list_directory(path: str) -> Optional[Entries]:
+    # None when the directory is gone
+    entries = {}
+    try:
+        with os.scandir(path) as scanned:
+            for entry in scanned:
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                    entries[entry.name] = (entry.is_dir(follow_symlinks=False), stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    continue # Removed while listing
+    except OSError:
+        return None
+    return entries
+
+
+class PolledDirectory:
+    __slots__ = ('handler', 'entries', 'interval', 'due')
+
+    def __init__(self, handler: FileSystemEventHandler, entries: Entries, interval: float) -> None:
+        self.handler = handler
+        self.entries = entries
+        self.interval = interval
+        self.due = time.monotonic() + interval
+
+
+class ActivityHandler(FileSystemEventHandler):
+    # Forwards the events of a native watch, counting them as activity of the directory
+    def __init__(self, observer: 'HybridObserver', handler: FileSystemEventHandler) -> None:
+        super().__init__()
+        self.observer = observer
+        self.handler = handler
+
+    def dispatch(self, event: FileSystemEvent) -> None:
+        self.observer.native_event(self.handler, event)
+
+
+class SharedInotify:
+    # Stands in for the watchdog Observer on Linux. The Observer opens one inotify
+    # instance, with its own thread, per scheduled directory, and the kernel only
+    # allows `max_user_instances` (128 by default) of them per user. Here every native
+    # watch is added to one instance, read by one thread.
+    def __init__(self) -> None:
+        self.fd: Optional[int] = None
+        self.handlers: Dict[str, FileSystemEventHandler] = {} # Watched directory -> handler
+        self.wds: Dict[str, int] = {} # Watched directory -> watch descriptor
+        self.paths: Dict[int, str] = {} # Watch descriptor -> directory, until the kernel confirms its removal
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.reader: Optional[threading.Thread] = None
+
+    @staticmethod
+    def error() -> OSError:
+        code = ctypes.get_errno()
+        return OSError(code, os.strerror(code))
+
+    def schedule(self, handler: FileSystemEventHandler, path: str, recursive: bool = False) -> str:
+        # Directories are always watched on their own, `recursive` is only accepted for the Observer interface
+        from watchdog.observers.inotify_c import inotify_init, inotify_add_watch, InotifyConstants as constants
+        mask = (
+            constants.IN_MODIFY | constants.IN_ATTRIB | constants.IN_CREATE | constants.IN_DELETE
+            | constants.IN_MOVED_FROM | constants.IN_MOVED_TO | constants.IN_DELETE_SELF | constants.IN_ONLYDIR
+        )
+        with self.lock:
+            if self.fd is None:
+                fd = inotify_init()
+                if fd == -1:
+                    raise self.error()
+                self.fd = fd
+            wd = inotify_add_watch(self.fd, os.fsencode(path), mask)
+            if wd == -1:
+                raise self.error()
+            self.wds[path] = wd
+            self.paths[wd] = path
+            self.handlers[path] = handler
+        return path
+
+    def unschedule(self, watch: str) -> None:
+        with self.lock:
+            self.handlers.pop(watch, None)
+            self.remove_watch(watch)
+
+    def remove_watch(self, path: str) -> None:
+        # Called with the lock held. The descriptor stays known until IN_IGNORED
+        # arrives, events still queued for it are dropped since it has no handler.
+        from watchdog.observers.inotify_c import inotify_rm_watch
+        wd = self.wds.pop(path, None)
+        if wd is not None and self.fd is not None:
+            inotify_rm_watch(self.fd, wd) # Fails when the kernel already removed it along with the directory
+
+    def start(self) -> None:
+        self.stopped.clear()
+        self.reader = threading.Thread(target=self.run)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def join(self) -> None:
+        if self.reader is not None:
+            self.reader.join()
+            self.reader = None
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+            self.wds.clear()
+            self.paths.clear()
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            fd = self.fd
+            if fd is None:
+                self.stopped.wait(0.5) # Nothing watched yet
+                continue
+            try:
+                # Waits with a timeout, a blocking read would not notice `stop`
+                readable, _, _ = select.select([fd], [], [], 0.5)
+                if readable:
+                    self.dispatch_events(self.read_events(fd))
+            except Exception as e:
+                logging.error(f"Error reading inotify events: {e}")
+
+    def read_events(self, fd: int) -> List:
+        from watchdog.observers.inotify_c import InotifyEvent, InotifyConstants as constants
+        buffer = os.read(fd, 64 * 1024)
+        events = []
+        offset = 0
+        with self.lock:
+            while offset + 16 <= len(buffer):
+                # struct inotify_event: wd, mask, cookie, len, then the name padded with NULs
+                wd, mask, cookie, length = struct.unpack_from('iIII', buffer, offset)
+                name = buffer[offset + 16:offset + 16 + length].rstrip(b'\0')
+                offset += 16 + length
+                directory = self.paths.get(wd)
+                if mask & constants.IN_IGNORED:
+                    self.paths.pop(wd, None)
+                    if directory is not None and self.wds.get(directory) == wd:
+                        del self.wds[directory] # Removed by the kernel, the directory is gone
+                    continue
+                if directory is None:
+                    continue # Queue overflow (wd -1), or a watch already forgotten
+                path = os.path.join(os.fsencode(directory), name) if name else os.fsencode(directory)
+                events.append(InotifyEvent(wd, mask, cookie, name, path))
+        return events
+
+    def dispatch_events(self, inotify_events: List) -> None:
+        # Moves are paired by cookie within one read, an unpaired half is a deletion or a creation
+        moved_from = {event.cookie: event for event in inotify_events if event.is_moved_from}
+        moved_to = {event.cookie for event in inotify_events if event.is_moved_to}
+        for inotify_event in inotify_events:
+            if not inotify_event.name:
+                continue # About a watched directory itself, its parent reports it
+            path = os.fsdecode(inotify_event.src_path)
+            is_dir = inotify_event.is_directory
+            if inotify_event.is_moved_to and inotify_event.cookie in moved_from:
+                source = os.fsdecode(moved_from[inotify_event.cookie].src_path)
+                event = DirMovedEvent(source, path) if is_dir else FileMovedEvent(source, path)
+                if is_dir:
+                    self.drop_moved_watch(source, path)
+            elif inotify_event.is_moved_to or inotify_event.is_create:
+                event = DirCreatedEvent(path) if is_dir else FileCreatedEvent(path)
+            elif inotify_event.is_moved_from:
+                if inotify_event.cookie in moved_to:
+                    continue # Sent with its destination
+                event = DirDeletedEvent(path) if is_dir else FileDeletedEvent(path)
+            elif inotify_event.is_delete:
+                event = DirDeletedEvent(path) if is_dir else FileDeletedEvent(path)
+            elif (inotify_event.is_modify or inotify_event.is_attrib) and not is_dir:
+                event = FileModifiedEvent(path)
+            else:
+                continue
+
+            with self.lock:
+                handler = self.handlers.get(os.path.dirname(path))
+            if handler is not None:
+                handler.dispatch(event)
+
+    def drop_moved_watch(self, source: str, dest: str) -> None:
+        # Inotify carries the watch of a moved directory over to its new path, where
+        # the hybrid observer does not know it: the new path is discovered and polled
+        with self.lock:
+            if self.handlers.pop(source, None) is not None:
+                self.remove_watch(source)
+
+
+class HybridObserver:
+    # Drop-in for the recursive watchdog Observer on trees with more directories than
+    # the kernel lets us watch. The most active directories get a native, non
+    # recursive watch, up to `watch_budget`. The others are polled with os.scandir,
+    # less often the longer they stay quiet, and at most `poll_budget` directories
+    # per second. Directories are promoted and demoted every `rebalance_interval`,
+    # from their recent activity, which halves at each rebalance.
+    def __init__(
+            self,
+            watch_budget: int = 8192,
+            min_interval: float = 1.0,
+            max_interval: float = 30.0,
+            poll_budget: int = 1000,
+            rebalance_interval: float = 30.0,
+            observer_factory: Optional[Callable] = None
+        ) -> None:
+
+        self.watch_budget = watch_budget
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.poll_budget = poll_budget
+        self.rebalance_interval = rebalance_interval
+        if observer_factory is None and sys.platform.startswith('linux'):
+            observer_factory = SharedInotify
+        elif observer_factory is None:
+            from watchdog.observers import Observer
+            observer_factory = Observer
+        self.observer = observer_factory()
+
+        self.handlers: Dict[str, FileSystemEventHandler] = {} # Every known directory -> handler of its root
+        self.is_ignored: Dict[FileSystemEventHandler, Callable[[str, bool], bool]] = {}
+        self.watches: Dict[str, object] = {} # Natively watched directory -> watchdog ObservedWatch
+        self.polled: Dict[str, PolledDirectory] = {}
+        self.activity: Dict[str, float] = {}
+        self.polls = 0
+
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.poller: Optional[threading.Thread] = None
+
+    def schedule(
+            self,
+            handler: FileSystemEventHandler,
+            path: str,
+            directories: Iterable[str] = (),
+            is_ignored: Callable[[str, bool], bool] = lambda path, is_dir: False
+        ) -> None:
+
+        # `directories` are the known directories of the root, relative to it
+        self.is_ignored[handler] = is_ignored
+        with self.lock:
+            for directory in directories:
+                self.handlers[os.path.join(path, directory) if directory else path] = handler
+            self.handlers.setdefault(path, handler)
+
+    def start(self) -> None:
+        self.rebalance()
+        self.observer.start()
+        self.poller = threading.Thread(target=self.run)
+        self.poller.daemon = True
+        self.poller.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.observer.stop()
+
+    def join(self) -> None:
+        self.observer.join()
+        if self.poller is not None:
+            self.poller.join()
+
+    def run(self) -> None:
+        tick = self.min_interval / 2
+        next_rebalance = time.monotonic() + self.rebalance_interval
+        while not self.stopped.wait(tick):
+            try:
+                self.poll_due(max(1, int(self.poll_budget * tick)))
+                if time.monotonic() >= next_rebalance:
+                    self.rebalance()
+                    next_rebalance = time.monotonic() + self.rebalance_interval
+            except Exception as e:
+                logging.error(f"Error polling directories: {e}")
+
+    def touch(self, directory: str) -> None:
+        with self.lock:
+            self.activity[directory] = self.activity.get(directory, 0) + 1
+
+    def native_event(self, handler: FileSystemEventHandler, event: FileSystemEvent) -> None:
+        self.touch(os.path.dirname(event.src_path))
+        if event.is_directory and event.event_type == 'created':
+            self.discover(handler, event.src_path, announce=True)
+        elif event.is_directory and event.event_type in ('deleted', 'moved'):
+            self.forget(event.src_path)
+            if event.event_type == 'moved':
+                self.discover(handler, event.dest_path, announce=False)
+        handler.dispatch(event)
+
+    def discover(self, handler: FileSystemEventHandler, path: str, announce: bool = True) -> None:
+        # A directory appeared: it is polled from now on, and with `announce` the files
+        # already in it are reported as created, since no watch saw them arrive.
+        is_ignored = self.is_ignored.get(handler, lambda path, is_dir: False)
+        stack = [path]
+        while stack:
+            directory = stack.pop()
+            entries = list_directory(directory)
+            if entries is None or is_ignored(directory, True):
+                continue
+            with self.lock:
+                self.handlers[directory] = handler
+                if directory not in self.watches:
+                    self.polled[directory] = PolledDirectory(handler, entries, self.min_interval)
+            for name, (is_dir, _, _) in entries.items():
+                child = os.path.join(directory, name)
+                if is_dir:
+                    stack.append(child)
+                elif announce:
+                    handler.dispatch(FileCreatedEvent(child))
+
+    def forget(self, path: str) -> None:
+        prefix = path + os.sep
+        with self.lock:
+            for directory in [d for d in self.handlers if d == path or d.startswith(prefix)]:
+                del self.handlers[directory]
+                self.polled.pop(directory, None)
+                self.activity.pop(directory, None)
+                watch = self.watches.pop(directory, None)
+                if watch is not None:
+                    self.unschedule(watch)
+
+    def unschedule(self, watch) -> None:
+        try:
+            self.observer.unschedule(watch)
+        except (KeyError, OSError):
+            pass # Already removed along with its directory
+
+    def poll_due(self, budget: int) -> int:
+        # Polls the directories whose interval elapsed, most overdue first
+        now = time.monotonic()
+        with self.lock:
+            due = sorted((state.due, path) for path, state in self.polled.items() if state.due <= now)
+        for _, path in due[:budget]:
+            self.poll(path)
+        return min(len(due), budget)
+
+    def poll(self, path: str) -> None:
+        with self.lock:
+            state = self.polled.get(path)
+        if state is None:
+            return
+
+        self.polls += 1
+        entries = list_directory(path)
+        if entries is None:
+            self.forget(path) # Its parent reports the deletion
+            return
+
+        events = self.compare(path, state.entries, entries)
+        with self.lock:
+            state.entries = entries
+            if events:
+                state.interval = self.min_interval
+                self.activity[path] = self.activity.get(path, 0) + len(events)
+            else:
+                state.interval = min(state.interval * 2, self.max_interval)
+            state.due = time.monotonic() + state.interval
+
+        for event in events:
+            if isinstance(event, DirDeletedEvent):
+                self.forget(event.src_path)
+            state.handler.dispatch(event)
+            if isinstance(event, DirCreatedEvent):
+                self.discover(state.handler, event.src_path, announce=True)
+
+    @staticmethod
+    def compare(path: str, old: Entries, new: Entries) -> List[FileSystemEvent]:
+        events = []
+        deleted = {name: entry for name, entry in old.items() if name not in new}
+        for name, entry in new.items():
+            previous = old.get(name)
+            child = os.path.join(path, name)
+            if previous is None:
+                # A rename within the directory keeps the mtime and size of the file
+                source = next((
+                    other for other, other_entry in deleted.items()
+                    if other_entry == entry and not entry[0]
+                ), None)
+                if source is not None:
+                    del deleted[source]
+                    events.append(FileMovedEvent(os.path.join(path, source), child))
+                else:
+                    events.append(DirCreatedEvent(child) if entry[0] else FileCreatedEvent(child))
+            elif previous[0] != entry[0]:
+                events.append(DirDeletedEvent(child) if previous[0] else FileDeletedEvent(child))
+                events.append(DirCreatedEvent(child) if entry[0] else FileCreatedEvent(child))
+            elif not entry[0] and previous != entry:
+                events.append(FileModifiedEvent(child))
+
+        for name, (is_dir, _, _) in deleted.items():
+            child = os.path.join(path, name)
+            events.append(DirDeletedEvent(child) if is_dir else FileDeletedEvent(child))
+        return events
+
+    def rebalance(self) -> None:
+        # Native watches go to the most active directories, then to the shallowest ones
+        with self.lock:
+            for directory in list(self.activity):
+                self.activity[directory] /= 2
+                if self.activity[directory] < 0.01:
+                    del self.activity[directory]
+
+            ranked = sorted(
+                self.handlers,
+                key=lambda directory: (-self.activity.get(directory, 0), directory.count(os.sep), directory)
+            )
+            hot = set(ranked[:self.watch_budget])
+            demoted = [directory for directory in self.watches if directory not in hot]
+            promoted = [directory for directory in ranked[:self.watch_budget] if directory not in self.watches]
+            unseen = [
+                directory for directory in ranked[self.watch_budget:]
+                if directory not in self.watches and directory not in self.polled
+            ]
+
+        for directory in unseen:
+            entries = list_directory(directory)
+            with self.lock:
+                handler = self.handlers.get(directory)
+                if entries is not None and handler is not None:
+                    self.polled[directory] = PolledDirectory(handler, entries, self.min_interval)
+
+        for directory in demoted:
+            # Listed before the watch is removed, so nothing falls between both
+            entries = list_directory(directory)
+            with self.lock:
+                handler = self.handlers.get(directory)
+                watch = self.watches.pop(directory)
+                if entries is not None and handler is not None:
+                    self.polled[directory] = PolledDirectory(handler, entries, self.min_interval)
+            self.unschedule(watch)
+
+        for directory in promoted:
+            with self.lock:
+                handler = self.handlers.get(directory)
+            if handler is None:
+                continue
+            try:
+                watch = self.observer.schedule(ActivityHandler(self, handler), directory, recursive=False)
+            except OSError as e:
+                # Out of kernel watches: keep polling, and stop asking for more
+                logging.error(f"Error watching {directory}, polling it instead: {e}")
+                with self.lock:
+                    self.watch_budget = len(self.watches)
+                break
+            with self.lock:
+                self.watches[directory] = watch
+            # Changes since the last poll, then the watch takes over
+            self.poll(directory)
+            with self.lock:
+                self.polled.pop(directory, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {'watched': len(self.watches), 'polled': len(self.polled), 'polls': self.polls}
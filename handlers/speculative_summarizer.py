@@ -0,0 +1,110 @@
+import time
+import logging
+import threading
+
+from collections import deque
+from typing import Callable, List, Optional
+
+from .completion_handler import CompletionHandler
+from utils.commit_cache import CommitCache
+from utils.payload_builder import estimate_tokens
+from utils.metrics import Metrics
+from utils.utils import Utils
+
+
+class SpeculativeSummarizer:
+    # Summarizes the net change of each file once it has been idle for `idle_time`
+    # seconds, so commit-generate only has to merge the summaries. Summaries are
+    # kept on the commit cache entries and go stale as soon as the file changes.
+    # Speculative requests are capped per minute, and their tokens per day.
+    def __init__(
+            self,
+            completion: CompletionHandler,
+            commit_caches: Callable[[], List[CommitCache]],
+            idle_time: float = 30,
+            requests_per_minute: int = 10,
+            daily_tokens: int = 100000,
+            metrics: Optional[Metrics] = None
+        ) -> None:
+
+        # `completion` must not be the handler used by commit-generate: its event loop
+        # runs on the background thread
+        self.completion = completion
+        self.commit_caches = commit_caches
+        self.idle_time = idle_time
+        self.requests_per_minute = requests_per_minute
+        self.daily_tokens = daily_tokens
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        self.requests: deque = deque() # Times of the requests made in the last minute
+        self.day = time.strftime('%Y-%m-%d')
+        self.spent_tokens = 0
+        self.stopped = threading.Event()
+        self.worker: Optional[threading.Thread] = None
+
+    def allow(self, tokens: int) -> bool:
+        now = time.time()
+        today = time.strftime('%Y-%m-%d')
+        if today != self.day:
+            self.day, self.spent_tokens = today, 0
+        while self.requests and now - self.requests[0] >= 60:
+            self.requests.popleft()
+        return len(self.requests) < self.requests_per_minute and self.spent_tokens + max(tokens, 1) <= self.daily_tokens
+
+    def summarize_idle(self) -> int:
+        # One round over every root, returns the number of files summarized
+        summarized = 0
+        for commit_cache in self.commit_caches():
+            for file_path, state in commit_cache.idle_files(self.idle_time):
+                # The budget is checked before diffing, so a spent budget costs nothing
+                if not self.allow(0):
+                    self.metrics.inc('speculative_summaries_total', outcome='over_budget')
+                    return summarized
+
+                diffs, _ = commit_cache.net_diffs([file_path])
+                changes = diffs.get(file_path)
+                chunks = self.completion.payload_builder.build({file_path: changes}) if changes else []
+                if len(chunks) != 1:
+                    # No change left, or too large for one request: left to commit-generate
+                    commit_cache.set_speculative(file_path, state, None)
+                    continue
+
+                tokens = estimate_tokens(Utils.summary_prompt + chunks[0])
+                if not self.allow(tokens):
+                    self.metrics.inc('speculative_summaries_total', outcome='over_budget')
+                    return summarized
+
+                self.requests.append(time.time())
+                self.spent_tokens += tokens
+                try:
+                    summary = self.completion.summarize_chunk(chunks[0])
+                except Exception as e:
+                    logging.error(f"Error summarizing {file_path} in the background: {e}")
+                    self.metrics.inc('speculative_summaries_total', outcome='error')
+                    continue
+
+                self.spent_tokens += estimate_tokens(summary)
+                commit_cache.set_speculative(file_path, state, summary)
+                self.metrics.inc('speculative_summaries_total', outcome='ok')
+                summarized += 1
+        return summarized
+
+    def run(self) -> None:
+        interval = max(0.5, self.idle_time / 4)
+        while not self.stopped.wait(interval):
+            try:
+                self.summarize_idle()
+            except Exception as e:
+                logging.error(f"Error in background summaries: {e}")
+
+    def start(self) -> None:
+        self.stopped.clear()
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
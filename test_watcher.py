@@ -1,21 +1,52 @@
-import unittest
-import shutil
+import os
+import sys
 import json
+import zlib
+import time
+import shutil
+import asyncio
+import unittest
+import threading
+import subprocess
+import http.client
 
-from unittest.mock import patch, MagicMock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from unittest.mock import patch, MagicMock, AsyncMock
 from pathlib import Path
-from collections import defaultdict
 
-from watchdog.events import FileSystemEvent
+from watchdog.events import (
+    FileSystemEvent, FileSystemEventHandler, FileCreatedEvent, FileModifiedEvent, FileDeletedEvent,
+    FileMovedEvent, DirCreatedEvent, DirDeletedEvent, DirMovedEvent
+)
 
-from vcwatcher import VCWatcher
+from vcwatcher import VCWatcher, WatchedRoot
+import vcwclient
+import benchmark
 
 from handlers.file_history_handler import FileHistoryHandler
 from handlers.file_event_handler import FileEventHandler
 from handlers.completion_handler import CompletionHandler
+from handlers.event_queue import EventQueue
+from handlers.hybrid_observer import HybridObserver, ActivityHandler, SharedInotify
+from handlers.speculative_summarizer import SpeculativeSummarizer
+from handlers.daemon_server import DaemonServer, TextResponse
+from handlers.completion_handler import COMMIT_HEADER, NO_CHANGES_MSG
 
 from utils.utils import Utils
 from utils.file_repr import FileRepr, FileReprEncoder
+from utils.snapshot_store import SnapshotStore, content_hash
+from utils.baseline_index import BaselineIndex, IndexEntry
+from utils.response_cache import ResponseCache
+from utils.commit_cache import CommitCache
+from utils.file_classifier import is_binary, detect_encoding
+from utils.ignore_rules import IgnoreRules, parse_rule
+from utils.metrics import Metrics
+from utils.payload_builder import PayloadBuilder, estimate_tokens
+from utils.diff_serializer import CompactDiffSerializer, create_serializer
+from utils.diff_pool import DiffPool
+from utils.change_summarizer import summarize_change
+from utils.diff_engine import MyersDiffEngine, PatienceDiffEngine, create_diff_engine
 
 
 class TestVCWatcher(unittest.TestCase):
@@ -24,6 +55,10 @@ class TestVCWatcher(unittest.TestCase):
     required by the `@patch` decorators, even if they are no used directly. 
     """
     
+    @patch('vcwatcher.Metrics')
+    @patch('vcwatcher.EventQueue')
+    @patch('vcwatcher.create_diff_engine')
+    @patch('vcwatcher.SnapshotStore')
     @patch('vcwatcher.load_dotenv')
     @patch('vcwatcher.os.getenv')
     @patch('vcwatcher.Utils')
@@ -36,12 +71,20 @@ class TestVCWatcher(unittest.TestCase):
         _mock_file_history_handler, 
         _mock_completion_handler, 
         _mock_utils, 
-        _mock_load_dotenv,
         mock_getenv,
+        _mock_load_dotenv,
+        _mock_snapshot_store,
+        _mock_create_diff_engine,
+        _mock_event_queue,
+        _mock_metrics,
         ):
 
         mock_getenv.return_value = 'dummy_api_key'
+        _mock_utils.return_value.change_summaries = None
+        _mock_utils.return_value.watch_budget = None
+        _mock_utils.return_value.speculative_idle_time = None
         self.vcwatcher = VCWatcher('dummy_api_key')
+        self.vcwatcher.utils.metrics_port = None
 
     @patch('vcwatcher.os.getenv')
     def test_init_raises_value_error_if_api_key_not_found(self, mock_getenv):
@@ -49,9 +92,45 @@ class TestVCWatcher(unittest.TestCase):
         with self.assertRaises(ValueError):
             VCWatcher('API_KEY')
 
-    @patch('vcwatcher.Observer')
+    @patch('vcwatcher.inotify_watch_limit', return_value=None)
+    @patch('vcwatcher.HybridObserver')
+    @patch('watchdog.observers.Observer')
+    def test_create_observer_polls_past_watch_budget(self, mock_observer, mock_hybrid, _mock_limit):
+        self.vcwatcher.file_history.dirs = {str(i): {} for i in range(5)}
+        self.assertIs(self.vcwatcher.create_observer(), mock_observer.return_value)
+
+        # Even under the budget, since the Observer would also watch ignored directories
+        self.vcwatcher.utils.watch_budget = 10
+        self.assertIs(self.vcwatcher.create_observer(), mock_hybrid.return_value)
+        self.assertEqual(mock_hybrid.call_args.kwargs['watch_budget'], 10)
+        mock_hybrid.return_value.schedule.assert_called_once()
+
+    @patch('vcwatcher.inotify_watch_limit', return_value=None)
+    @patch('vcwatcher.logging.error')
+    @patch.object(HybridObserver, 'join')
+    @patch.object(HybridObserver, 'start')
+    @patch('watchdog.observers.Observer')
     @patch('vcwatcher.time.sleep', side_effect=KeyboardInterrupt)
-    def test_observe_dir_starts_observer(self, mock_sleep, mock_observer):
+    def test_observe_dir_polls_when_the_observer_fails(self, _mock_sleep, mock_observer, mock_start, mock_join, mock_log_error, _mock_limit):
+        mock_observer.return_value.start.side_effect = OSError(28, "inotify watch limit reached")
+        self.vcwatcher.observe_dir()
+        mock_start.assert_called_once()
+        mock_join.assert_called_once()
+        mock_log_error.assert_called_once()
+
+    @patch('vcwatcher.logging.error')
+    @patch.object(HybridObserver, 'start', side_effect=OSError(24, "inotify instance limit reached"))
+    def test_observe_dir_survives_observer_errors(self, _mock_start, mock_log_error):
+        self.vcwatcher.utils.watch_budget = 10
+        self.vcwatcher.observe_dir()
+        self.assertTrue(self.vcwatcher.observing.is_set())
+        mock_log_error.assert_called_once()
+        self.vcwatcher.queue.stop.assert_called_once()
+
+    @patch('vcwatcher.inotify_watch_limit', return_value=None)
+    @patch('watchdog.observers.Observer')
+    @patch('vcwatcher.time.sleep', side_effect=KeyboardInterrupt)
+    def test_observe_dir_starts_observer(self, mock_sleep, mock_observer, _mock_limit):
         mock_observer_instance = mock_observer.return_value
         self.vcwatcher.observe_dir()
         mock_observer_instance.schedule.assert_called_once()
@@ -81,11 +160,121 @@ class TestVCWatcher(unittest.TestCase):
         self.vcwatcher.file_history.construct_tree.assert_called_once()
         mock_start_observing_in_thread.assert_called_once()
 
+    @patch('vcwatcher.sys.argv', ['vcwatcher.py', '/some/directory'])
+    @patch('vcwatcher.Path')
+    @patch('vcwatcher.input', side_effect=['resync', 'exit'])
+    @patch.object(VCWatcher, 'start_observing_in_thread')
+    def test_run_resync(self, _mock_start_observing_in_thread, _mock_input, mock_path):
+        mock_path.return_value.is_dir.return_value = True
+        self.vcwatcher.run()
+        self.assertEqual(self.vcwatcher.file_history.construct_tree.call_count, 2)
+
+    @patch('vcwatcher.sys.argv', ['vcwatcher.py', '/service/a', '/service/b'])
+    @patch('vcwatcher.Path')
+    @patch('vcwatcher.input', side_effect=['exit'])
+    @patch.object(VCWatcher, 'start_observing_in_thread')
+    @patch.object(VCWatcher, 'add_root')
+    def test_run_multiple_roots(self, mock_add_root, _mock_start_observing_in_thread, _mock_input, mock_path):
+        mock_path.return_value.is_dir.return_value = True
+        self.vcwatcher.run()
+        self.assertEqual([c.args[0] for c in mock_path.call_args_list], ['/service/a', '/service/b'])
+        mock_add_root.assert_called_once_with(mock_path.return_value)
+
+    @patch('vcwatcher.sys.argv', ['vcwatcher.py', '--profile-startup', '/some/directory'])
+    @patch('vcwatcher.Path')
+    @patch('vcwatcher.print')
+    @patch('vcwatcher.input')
+    @patch.object(VCWatcher, 'start_observing_in_thread')
+    def test_run_profile_startup(self, mock_start_observing_in_thread, mock_input, mock_print, mock_path):
+        mock_path.return_value.is_dir.return_value = True
+        mock_start_observing_in_thread.side_effect = self.vcwatcher.observing.set
+        self.vcwatcher.run()
+
+        mock_input.assert_not_called()
+        report = mock_print.call_args.args[0]
+        phases = [line.split('  ')[0].strip() for line in report.splitlines()]
+        self.assertEqual(
+            phases, ['imports', 'init', 'open indexes', 'scan', 'completion client (deferred)', 'ready after']
+        )
+        self.assertIsNotNone(self.vcwatcher.profile.ready)
+
+    def test_import_defers_heavy_modules(self):
+        # The LLM client and the observer backend are only loaded once needed
+        loaded = subprocess.run(
+            [sys.executable, '-c', "import sys, vcwatcher; print('openai' in sys.modules, 'watchdog.observers' in sys.modules)"],
+            capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        self.assertEqual(loaded.stdout.split(), ['False', 'False'])
+
+    @patch('vcwatcher.CommitCache')
+    @patch('vcwatcher.FileEventHandler')
+    @patch('vcwatcher.FileHistoryHandler')
+    def test_add_root_shares_store_and_queue(self, mock_history, mock_event_handler, mock_commit_cache):
+        root = self.vcwatcher.add_root(Path('other'))
+        self.assertIs(self.vcwatcher.roots[-1], root)
+        self.assertIs(mock_history.call_args.kwargs['store'], self.vcwatcher.store)
+        self.assertIs(mock_event_handler.call_args.kwargs['queue'], self.vcwatcher.queue)
+        self.assertIs(mock_event_handler.call_args.kwargs['commit_cache'], mock_commit_cache.return_value)
+        self.assertIsNot(root.commit_cache, self.vcwatcher.roots[0].commit_cache)
+
+    def make_root(self, path):
+        file_history = MagicMock()
+        file_history.relative_parts.side_effect = lambda p: ('f',) if p.startswith(path + '/') else None
+        return WatchedRoot(Path(path), file_history, MagicMock(), MagicMock())
+
+    def test_process_batch_routes_to_innermost_root(self):
+        outer, inner = self.make_root('a'), self.make_root('a/b')
+        self.vcwatcher.roots = [outer, inner]
+        self.vcwatcher.process_batch(['a/b/f.txt', 'a/g.txt', 'c/h.txt'])
+        inner.event_handler.process_file.assert_called_once_with('a/b/f.txt')
+        outer.event_handler.process_file.assert_called_once_with('a/g.txt')
+
+    @patch('vcwatcher.print')
+    def test_generate_commit_msgs_per_root(self, _mock_print):
+        self.vcwatcher.roots = [self.make_root('a'), self.make_root('b')]
+        self.vcwatcher.generate_commit_msgs()
+        self.assertEqual(
+            [c.kwargs['commit_cache'] for c in self.vcwatcher.completion.generate_commit_msg.call_args_list],
+            [root.commit_cache for root in self.vcwatcher.roots]
+        )
+
+    @patch('vcwatcher.print')
+    def test_generate_commit_msgs_survives_llm_errors(self, mock_print):
+        self.vcwatcher.roots = [self.make_root('a'), self.make_root('b')]
+        self.vcwatcher.completion.stream = False
+        self.vcwatcher.completion.generate_commit_msg.side_effect = [RuntimeError("Invalid API key"), "Add b"]
+        self.vcwatcher.generate_commit_msgs()
+        printed = [c.args[0] for c in mock_print.call_args_list]
+        self.assertTrue(any("Invalid API key" in line for line in printed))
+        self.assertEqual(printed[-1], "Add b")
+
+    def test_generate_returns_bare_messages(self):
+        self.vcwatcher.roots = [self.make_root('a'), self.make_root('b')]
+        self.vcwatcher.completion.generate_commit_msg.side_effect = [COMMIT_HEADER + 'Add a', NO_CHANGES_MSG]
+        self.assertEqual(self.vcwatcher.generate(), {'a': 'Add a', 'b': None})
+
+    def test_select_roots(self):
+        self.vcwatcher.roots = [self.make_root('a'), self.make_root('a/b')]
+        self.assertEqual(self.vcwatcher.select_roots(), self.vcwatcher.roots)
+        self.assertEqual(self.vcwatcher.select_roots('a/b/c'), [self.vcwatcher.roots[1]])
+        self.assertEqual(self.vcwatcher.select_roots('a'), [self.vcwatcher.roots[0]])
+        with self.assertRaises(ValueError):
+            self.vcwatcher.select_roots('elsewhere')
+
+    def test_reset_clears_pending_changes(self):
+        self.vcwatcher.roots = [self.make_root('a'), self.make_root('b')]
+        self.assertEqual(self.vcwatcher.reset('b'), ['b'])
+        self.vcwatcher.roots[1].commit_cache.clear.assert_called_once()
+        self.vcwatcher.roots[0].commit_cache.clear.assert_not_called()
+
     @patch('vcwatcher.sys.argv', ['vcwatcher.py'])
     @patch('vcwatcher.print')
     def test_run_with_incorrect_arguments(self, mock_print):
         self.vcwatcher.run()
-        mock_print.assert_called_once_with("Usage: `python vcwatcher.py <directory_to_monitor>`")
+        mock_print.assert_called_once_with(
+            "Usage: `python vcwatcher.py [--daemon] [--profile-startup] "
+            "<directory_to_monitor> [<directory_to_monitor> ...]`"
+        )
 
     @patch('vcwatcher.sys.argv', ['vcwatcher.py', '/invalid/directory'])
     @patch('vcwatcher.Path')
@@ -108,7 +297,8 @@ class TestFileHistoryHandler(unittest.TestCase):
             'node_modules', 
             '.git', 
             '__pycache__', 
-            'venv'
+            'venv',
+            '.vcwatcher'
         }
         self.mock_utils.excluded_files = {
             'db.sqlite3', 
@@ -116,6 +306,9 @@ class TestFileHistoryHandler(unittest.TestCase):
             'package-lock.json', 
             '.env',
         }
+        self.mock_utils.scan_workers = 2
+        self.mock_utils.max_file_size = 1024
+        self.mock_utils.ignore_files = ('.gitignore', '.vcwignore')
         self.file_history_handler = FileHistoryHandler(utils=self.mock_utils)
         self.test_dir = Path('test_temp_dir')
         self.test_dir.mkdir(parents=True, exist_ok=True)
@@ -133,10 +326,153 @@ class TestFileHistoryHandler(unittest.TestCase):
         self.assertEqual(self.file_history_handler.tree, {})
         self.assertEqual(self.file_history_handler.visited, set())
 
+    def test_trees_are_not_shared(self):
+        self.file_history_handler.root_path = self.test_dir
+        self.file_history_handler.update_file(str(self.test_file))
+        other = FileHistoryHandler(utils=self.mock_utils)
+        self.assertEqual(other.tree, {})
+        self.assertEqual(other.files, {})
+
     def test_get_directory_tree(self):
         directory_tree = str(self.file_history_handler.get_directory_tree(self.test_dir))
         self.assertEqual(directory_tree, "{'test_file.txt': FileRepr Object @ test_temp_dir/test_file.txt}")
 
+    def test_get_directory_tree_nested(self):
+        (self.test_dir / 'sub').mkdir()
+        (self.test_dir / 'sub' / 'nested.txt').write_text('Nested')
+        (self.test_dir / 'node_modules').mkdir()
+        (self.test_dir / 'node_modules' / 'lib.js').write_text('Excluded')
+        (self.test_dir / '.env').write_text('API_KEY=secret')
+
+        tree = self.file_history_handler.get_directory_tree(self.test_dir)
+
+        self.assertEqual(set(tree), {'test_file.txt', 'sub'})
+        self.assertEqual(tree['sub']['nested.txt'].file_content, 'Nested')
+        self.assertEqual(tree['sub']['nested.txt'].file_path, 'test_temp_dir/sub/nested.txt')
+        self.assertEqual(self.file_history_handler.last_scan['files'], 2)
+        self.assertEqual(self.file_history_handler.last_scan['bytes'], 12)
+
+    def test_get_directory_tree_skips_symlink_loops(self):
+        try:
+            (self.test_dir / 'loop').symlink_to(self.test_dir.resolve(), target_is_directory=True)
+        except OSError:
+            self.skipTest("Symlinks are not supported")
+        self.file_history_handler.visited.add(self.test_dir.resolve())
+
+        tree = self.file_history_handler.get_directory_tree(self.test_dir)
+
+        self.assertNotIn('loop', tree)
+
+    def test_scan_report(self):
+        self.file_history_handler.last_scan = {'files': 100, 'bytes': 2 * 1024 * 1024, 'seconds': 2.0}
+        self.assertEqual(
+            self.file_history_handler.scan_report(),
+            "Scanned 100 files (2.0 MB) in 2.00s: 50 files/s, 1.0 MB/s"
+        )
+
+    def test_warm_restart_reads_only_changed_files(self):
+        self.file_history_handler.root_path = self.test_dir
+        other_file = self.test_dir / 'other.txt'
+        other_file.write_text('Other')
+        for path in (self.test_file, other_file):
+            os.utime(path, ns=(0, 1_000_000_000)) # Not racily clean
+
+        self.file_history_handler.open_index(self.test_dir / '.vcwatcher' / 'index.sqlite')
+        self.file_history_handler.construct_tree()
+        self.file_history_handler.save_index()
+        self.file_history_handler.index.close()
+
+        self.test_file.write_text('Changed while stopped')
+        os.utime(self.test_file, ns=(0, 2_000_000_000))
+
+        restarted = FileHistoryHandler(utils=self.mock_utils, tree={}, store=SnapshotStore())
+        restarted.root_path = self.test_dir
+        restarted.open_index(self.test_dir / '.vcwatcher' / 'index.sqlite')
+        with patch('handlers.file_history_handler.read_and_hash') as mock_read:
+            restarted.construct_tree()
+        mock_read.assert_not_called()
+
+        # Contents are only read from the index once needed
+        self.assertEqual(restarted.stale, [str(self.test_file)])
+        self.assertEqual(len(restarted.store.lazy_digests()), 2)
+        self.assertEqual(restarted.tree['.']['other.txt'].file_content, 'Other')
+        self.assertEqual(len(restarted.store.lazy_digests()), 1)
+
+        old, new = restarted.update_file(str(self.test_file))
+        self.assertEqual(restarted.dirty, {'test_file.txt'})
+        restarted.save_index() # Keeps the blob of the old baseline, not loaded yet
+        self.assertEqual((old.file_content, new.file_content), ('Tester', 'Changed while stopped'))
+        restarted.index.close()
+
+    def test_read_file_classifies_binary_oversized_and_encoded_files(self):
+        binary_file = self.test_dir / 'image.png'
+        binary_file.write_bytes(b'\x89PNG\r\n\x1a\n' + bytes(range(256)))
+        large_file = self.test_dir / 'large.log'
+        large_file.write_text('x' * 2048)
+        latin_file = self.test_dir / 'latin.txt'
+        latin_file.write_bytes('café\n'.encode('utf-16'))
+
+        binary = self.file_history_handler.read_file(binary_file)
+        self.assertEqual((binary.kind, binary.in_store, binary.file_content), ('binary', False, None))
+        self.assertEqual(binary.content_hash, content_hash(binary_file.read_bytes()))
+
+        large = self.file_history_handler.read_file(large_file)
+        self.assertEqual((large.kind, large.in_store), ('oversized', False))
+        self.assertEqual(large.content_hash, content_hash(b'x' * 2048))
+
+        latin = self.file_history_handler.read_file(latin_file)
+        self.assertEqual((latin.kind, latin.encoding, latin.file_content), ('text', 'utf-16', 'café\n'))
+
+    def test_read_file_unreadable(self):
+        with self.assertLogs(level='ERROR'):
+            file_repr = self.file_history_handler.read_file(self.test_dir / 'missing.txt')
+        self.assertEqual(file_repr.kind, 'unreadable')
+        self.assertFalse(file_repr.is_text)
+
+    def test_index_directory_is_ignored_by_git(self):
+        self.file_history_handler.open_index(self.test_dir / '.vcwatcher' / 'index.sqlite')
+        self.file_history_handler.index.close()
+        self.assertEqual((self.test_dir / '.vcwatcher' / '.gitignore').read_text(), '*\n')
+
+        # An existing directory is left alone
+        self.file_history_handler.open_index(self.test_dir / 'index.sqlite')
+        self.file_history_handler.index.close()
+        self.assertFalse((self.test_dir / '.gitignore').exists())
+
+    def test_updates_wait_for_the_index_save(self):
+        self.file_history_handler.root_path = self.test_dir
+        self.file_history_handler.construct_tree()
+        with self.file_history_handler.lock:
+            thread = threading.Thread(target=self.file_history_handler.update_file, args=(str(self.test_file),))
+            self.test_file.write_text('Changed')
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(self.file_history_handler.dirty, {'test_file.txt'})
+            self.file_history_handler.dirty.clear()
+        thread.join()
+        self.assertEqual(self.file_history_handler.dirty, {'test_file.txt'})
+
+    def test_index_keeps_binary_files_without_blob(self):
+        self.file_history_handler.root_path = self.test_dir
+        (self.test_dir / 'data.bin').write_bytes(b'\x00\x01\x02')
+        os.utime(self.test_dir / 'data.bin', ns=(0, 1_000_000_000))
+        self.file_history_handler.open_index(self.test_dir / '.vcwatcher' / 'index.sqlite')
+        self.file_history_handler.construct_tree()
+        self.file_history_handler.save_index()
+        self.file_history_handler.index.close()
+
+        restarted = FileHistoryHandler(utils=self.mock_utils, tree={})
+        restarted.root_path = self.test_dir
+        restarted.open_index(self.test_dir / '.vcwatcher' / 'index.sqlite')
+        restarted.construct_tree()
+        self.assertIsNone(restarted.index.blob(content_hash(b'\x00\x01\x02')))
+        restarted.index.close()
+
+        restored = restarted.tree['.']['data.bin']
+        self.assertEqual((restored.kind, restored.in_store), ('binary', False))
+        self.assertEqual(restored.content_hash, content_hash(b'\x00\x01\x02'))
+
     def test_construct_tree(self):
         self.file_history_handler.visited.add(Path('some/dir'))
         with patch.object(self.file_history_handler, 'get_directory_tree', return_value={'mock_tree': {}}):
@@ -160,11 +496,129 @@ class TestFileHistoryHandler(unittest.TestCase):
                 }
             }
         }
-        self.mock_utils.excluded_files = ['file2.txt']
+        self.mock_utils.excluded_files.add('file2.txt')
         self.mock_utils.modified_file_path = '.\\dir1\\file2.txt'
         file_repr = self.file_history_handler.get_file_repr()
         self.assertEqual(file_repr, "Warning: '.\\dir1\\file2.txt' found in excluded.")
 
+    def test_get_file_repr_platform_independent(self):
+        self.file_history_handler.root_path = self.test_dir
+        self.file_history_handler.construct_tree()
+        file_repr = self.file_history_handler.files['test_file.txt']
+        for modified_path in ('test_temp_dir/test_file.txt', 'test_temp_dir\\test_file.txt'):
+            self.mock_utils.modified_file_path = modified_path
+            self.assertIs(self.file_history_handler.get_file_repr(), file_repr)
+        self.mock_utils.modified_file_path = 'test_temp_dir/missing.txt'
+        self.assertIsNone(self.file_history_handler.get_file_repr())
+
+    def test_flat_index_follows_tree(self):
+        self.file_history_handler.root_path = self.test_dir
+        (self.test_dir / 'sub').mkdir()
+        (self.test_dir / 'sub' / 'nested.txt').write_text('Nested')
+        self.file_history_handler.construct_tree()
+        self.assertEqual(set(self.file_history_handler.files), {'test_file.txt', 'sub/nested.txt'})
+        self.assertIs(self.file_history_handler.dirs['sub'], self.file_history_handler.tree['.']['sub'])
+
+        (self.test_dir / 'new' / 'deep').mkdir(parents=True)
+        (self.test_dir / 'new' / 'deep' / 'file.txt').write_text('New')
+        _, new = self.file_history_handler.update_file('test_temp_dir/new/deep/file.txt')
+        self.assertIs(self.file_history_handler.files['new/deep/file.txt'], new)
+        self.assertIs(self.file_history_handler.tree['.']['new']['deep']['file.txt'], new)
+
+        (self.test_dir / 'sub' / 'nested.txt').unlink()
+        self.file_history_handler.update_file('test_temp_dir/sub/nested.txt')
+        self.assertNotIn('sub/nested.txt', self.file_history_handler.files)
+        self.assertEqual(self.file_history_handler.tree['.']['sub'], {})
+
+        rebuilt = FileHistoryHandler(utils=self.mock_utils, tree=self.file_history_handler.tree)
+        self.assertEqual(rebuilt.files, self.file_history_handler.files)
+
+    def test_relative_parts(self):
+        self.file_history_handler.root_path = self.test_dir
+        self.assertEqual(
+            self.file_history_handler.relative_parts('test_temp_dir/sub/file.txt'), ('sub', 'file.txt')
+        )
+        self.assertEqual(
+            self.file_history_handler.relative_parts('test_temp_dir\\sub\\file.txt'), ('sub', 'file.txt')
+        )
+        self.assertIsNone(self.file_history_handler.relative_parts('elsewhere/file.txt'))
+
+    def test_update_file_patches_single_node(self):
+        self.file_history_handler.root_path = self.test_dir
+        self.file_history_handler.construct_tree()
+        untouched = self.file_history_handler.tree['.']['test_file.txt']
+
+        (self.test_dir / 'sub').mkdir()
+        new_file = self.test_dir / 'sub' / 'new.txt'
+        new_file.write_text('Fresh')
+
+        with patch.object(self.file_history_handler, 'get_directory_tree') as mock_get_tree:
+            old, new = self.file_history_handler.update_file(str(new_file))
+        mock_get_tree.assert_not_called()
+
+        self.assertIsNone(old)
+        self.assertEqual(new.file_content, 'Fresh')
+        self.assertIs(self.file_history_handler.tree['.']['sub']['new.txt'], new)
+        self.assertIs(self.file_history_handler.tree['.']['test_file.txt'], untouched)
+
+        new_file.write_text('Changed')
+        old, new = self.file_history_handler.update_file(str(new_file))
+        self.assertEqual(old.file_content, 'Fresh')
+        self.assertEqual(new.file_content, 'Changed')
+
+    def test_update_file_removes_deleted_file(self):
+        self.file_history_handler.root_path = self.test_dir
+        self.file_history_handler.construct_tree()
+        self.test_file.unlink()
+        old, new = self.file_history_handler.update_file(str(self.test_file))
+        self.assertEqual(old.file_content, 'Tester')
+        self.assertIsNone(new)
+        self.assertNotIn('test_file.txt', self.file_history_handler.tree['.'])
+
+    def test_update_file_excluded(self):
+        self.file_history_handler.root_path = self.test_dir
+        self.assertEqual(
+            self.file_history_handler.update_file('test_temp_dir/node_modules/lib.js'), (None, None)
+        )
+        self.assertEqual(self.file_history_handler.update_file('test_temp_dir/.env'), (None, None))
+
+    def test_scan_prunes_ignored_paths(self):
+        self.file_history_handler.root_path = self.test_dir
+        (self.test_dir / '.gitignore').write_text('build/\n*.log\n')
+        (self.test_dir / 'build').mkdir()
+        (self.test_dir / 'build' / 'out.js').write_text('generated')
+        (self.test_dir / 'run.log').write_text('log')
+        tree = self.file_history_handler.get_directory_tree()
+        self.assertEqual(set(tree), {'test_file.txt'})
+        self.assertEqual(
+            self.file_history_handler.update_file('test_temp_dir/build/out.js'), (None, None)
+        )
+        self.assertTrue(self.file_history_handler.is_ignored('test_temp_dir/run.log'))
+        self.assertFalse(self.file_history_handler.is_ignored('test_temp_dir/test_file.txt'))
+
+    def test_read_file_skips_on_stat_match(self):
+        old = self.file_history_handler.read_file(self.test_file)
+        old.read_ns += 5_000_000_000 # Read long after the last modification
+        with patch('handlers.file_history_handler.read_and_hash') as mock_read:
+            self.assertIs(self.file_history_handler.read_file(self.test_file, old), old)
+        mock_read.assert_not_called()
+        self.assertEqual(self.file_history_handler.skipped, {'stat': 1, 'hash': 0})
+
+    def test_read_file_skips_on_hash_match(self):
+        old = self.file_history_handler.read_file(self.test_file)
+        os.utime(self.test_file, ns=(0, old.st_mtime_ns + 5_000_000_000))
+        self.assertIs(self.file_history_handler.read_file(self.test_file, old), old)
+        self.assertEqual(self.file_history_handler.skipped, {'stat': 0, 'hash': 1})
+        self.assertEqual(old.st_mtime_ns, self.test_file.stat().st_mtime_ns)
+
+    def test_read_file_rereads_changed_content(self):
+        old = self.file_history_handler.read_file(self.test_file)
+        self.test_file.write_text('Tested')
+        new = self.file_history_handler.read_file(self.test_file, old)
+        self.assertIsNot(new, old)
+        self.assertEqual(new.file_content, 'Tested')
+        self.assertEqual(self.file_history_handler.skipped, {'stat': 0, 'hash': 0})
+
     def test_compare_files(self):
         old_file = "line1\nline2\nline3"
         new_file = "line1\nline3\nline4"
@@ -172,100 +626,529 @@ class TestFileHistoryHandler(unittest.TestCase):
         expected_differences = ['- line2', '+ line4']
         self.assertEqual(differences, expected_differences) 
 
+    def test_compare_hunks(self):
+        old_file = "line1\nline2\nline3"
+        new_file = "line1\nline3\nline4"
+        hunks = self.file_history_handler.compare_hunks(old_file, new_file, context=1)
+        self.assertEqual(hunks, ['@@ -1,3 +1,3 @@', '  line1', '- line2', '  line3', '+ line4'])
+
 
 class TestFileEventHandler(unittest.TestCase):
     def setUp(self):
         self.mock_history_handler = MagicMock(spec=FileHistoryHandler)
         self.mock_completion_handler = MagicMock(spec=CompletionHandler)
         self.mock_utils = MagicMock(spec=Utils)
+        self.mock_utils.settle_time = 0.5
+        self.mock_utils.max_event_latency = 5
+        self.mock_utils.max_pending_events = 100
+        self.mock_utils.ignore_files = ('.gitignore', '.vcwignore')
+        self.mock_history_handler.is_ignored.return_value = False
+        self.mock_history_handler.ignore = MagicMock()
+        self.mock_history_handler.remove_directory.return_value = []
         self.file_event_handler = FileEventHandler(
             self.mock_history_handler,
             self.mock_completion_handler,
             self.mock_utils
         )
 
-    @patch('time.time', return_value=100.0)
-    def test_on_modified_ignored_due_to_debouce(self, mock_time):
-        self.mock_utils.last_modified_time = 99.5
-        self.mock_utils.debounce_time = 1.0
+    def test_on_modified_queues_event(self):
         event = MagicMock(spec=FileSystemEvent)
         event.is_directory = False
         event.src_path = "test.txt"
 
         self.file_event_handler.on_modified(event)
 
-        self.assertEqual(self.mock_utils.last_modified_time, 99.5)
-        self.assertFalse(self.mock_history_handler.get_file_repr.called)
+        self.assertIn("test.txt", self.file_event_handler.queue.pending)
+        self.assertFalse(self.mock_history_handler.update_file.called)
 
-    @patch('time.time', return_value=100.0)
-    def test_on_modified_processes_event(self, mock_time):
-        self.mock_utils.last_modified_time = 98.0
-        self.mock_utils.debounce_time = 1.0
+    def test_on_modified_drops_ignored_paths(self):
+        self.mock_history_handler.is_ignored.return_value = True
         event = MagicMock(spec=FileSystemEvent)
         event.is_directory = False
-        event.src_path = "test.txt"
+        event.src_path = "build/out.log"
 
-        old_file_repr = MagicMock()
-        new_file_repr = MagicMock()
-        
-        self.mock_history_handler.get_file_repr.side_effect = [old_file_repr, new_file_repr]
+        self.file_event_handler.on_modified(event)
 
-        diffs = ['diff1', 'diff2']
+        self.assertEqual(self.file_event_handler.queue.pending, {})
+        self.mock_history_handler.is_ignored.assert_called_once_with("build/out.log", False)
+        counters = self.file_event_handler.metrics.collect()['counters']
+        self.assertEqual(counters['events_received_total'], 1)
+        self.assertEqual(counters['events_dropped_total{reason="ignored"}'], 1)
 
-        self.mock_history_handler.compare_files.return_value = diffs
+    def test_on_modified_reloads_changed_ignore_file(self):
+        self.mock_history_handler.is_ignored.return_value = True
+        event = MagicMock(spec=FileSystemEvent)
+        event.is_directory = False
+        event.src_path = "sub/.gitignore"
 
         self.file_event_handler.on_modified(event)
 
-        self.assertEqual(self.mock_utils.last_modified_time, 100.0)
+        self.mock_history_handler.ignore.invalidate.assert_called_once()
+
+    def test_on_modified_ignores_directories(self):
+        event = MagicMock(spec=FileSystemEvent)
+        event.is_directory = True
+        event.src_path = "some_dir"
+
+        self.file_event_handler.on_modified(event)
+
+        self.assertEqual(self.file_event_handler.queue.pending, {})
+
+    def test_on_modified_keeps_every_path(self):
+        for src_path in ("a.txt", "b.txt", "a.txt"):
+            event = MagicMock(spec=FileSystemEvent)
+            event.is_directory = False
+            event.src_path = src_path
+            self.file_event_handler.on_modified(event)
+
+        self.mock_history_handler.update_file.return_value = (None, None)
+        self.file_event_handler.queue.drain()
+
+        processed = [c.args[0] for c in self.mock_history_handler.update_file.call_args_list]
+        self.assertEqual(processed, ["a.txt", "b.txt"])
+
+    def test_process_file_processes_event(self):
+        old_file_repr = MagicMock()
+        new_file_repr = MagicMock()
+        
+        self.mock_history_handler.update_file.return_value = (old_file_repr, new_file_repr)
+
+        self.file_event_handler.process_file("test.txt")
+
         self.assertEqual(self.mock_utils.modified_file_path, "test.txt")
-        self.mock_history_handler.construct_tree.assert_called_once()
-        self.mock_history_handler.compare_files.assert_called_once_with(
-            old_file_repr.file_content, new_file_repr.file_content
-        )
+        self.mock_history_handler.update_file.assert_called_once_with("test.txt")
+        self.mock_history_handler.construct_tree.assert_not_called()
+        self.mock_history_handler.compare_files.assert_not_called()
         self.mock_completion_handler.store_commit.assert_called_once_with(
-            "test.txt", diffs
+            "test.txt", old_file_repr, new_file_repr
         )
 
-    @patch('time.time', return_value=100.0)
-    def test_on_modified_handles_attribute_error(self, mock_time):
-        self.mock_utils.last_modified_time = 98.0
-        self.mock_utils.debounce_time = 1.0
-        event = MagicMock(spec=FileSystemEvent)
-        event.is_directory = False
-        event.src_path = "test.txt"
+    def test_process_file_skips_unchanged_file(self):
+        file_repr = MagicMock()
+        self.mock_history_handler.update_file.return_value = (file_repr, file_repr)
 
-        old_file_repr = MagicMock()
+        self.file_event_handler.process_file("test.txt")
+
+        self.mock_history_handler.compare_files.assert_not_called()
+        self.mock_completion_handler.store_commit.assert_not_called()
+
+    def test_process_file_created_file(self):
         new_file_repr = MagicMock()
-        self.mock_history_handler.get_file_repr.side_effect = [old_file_repr, new_file_repr]
-        self.mock_history_handler.compare_files.side_effect = AttributeError("mocked error")
+        self.mock_history_handler.update_file.return_value = (None, new_file_repr)
 
-        with self.assertLogs(level='ERROR') as log:
-            self.file_event_handler.on_modified(event)
+        self.file_event_handler.process_file("test.txt")
+
+        self.mock_completion_handler.store_commit.assert_called_once_with("test.txt", None, new_file_repr)
+
+    def test_process_file_skips_transient_file(self):
+        self.mock_history_handler.update_file.return_value = (None, None)
+
+        self.file_event_handler.process_file("test.txt~")
+
+        self.mock_completion_handler.store_commit.assert_not_called()
+
+    def test_on_moved_records_rename(self):
+        for src, dest in (("a.txt", "b.txt"), ("b.txt", "c.txt")):
+            self.file_event_handler.on_moved(FileMovedEvent(src, dest))
+
+        self.assertEqual(self.file_event_handler.moves, {"c.txt": "a.txt"})
+        self.assertEqual(list(self.file_event_handler.queue.pending), ["a.txt", "b.txt", "c.txt"])
+
+
+class TestRenameReconciliation(unittest.TestCase):
+    # Real files and a real history, to follow the event sequences editors produce
+    def setUp(self):
+        self.root = os.path.abspath('test_rename_dir')
+        os.makedirs(self.root, exist_ok=True)
+        self.utils = Utils()
+        self.utils.index_path = None
+        self.history = FileHistoryHandler(utils=self.utils, tree={}, store=SnapshotStore())
+        self.history.root_path = Path(self.root)
+        self.write('a.py', 'one\ntwo\n')
+        os.mkdir(self.path('pkg'))
+        self.write('pkg/mod.py', 'x = 1\n')
+        self.history.construct_tree()
+        self.commit_cache = CommitCache()
+        self.handler = FileEventHandler(
+            self.history, MagicMock(spec=CompletionHandler), self.utils, commit_cache=self.commit_cache
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def path(self, name):
+        return f"{self.root}/{name}"
+
+    def write(self, name, content):
+        with open(self.path(name), 'w') as file:
+            file.write(content)
+
+    def settle(self, *events):
+        for event in events:
+            getattr(self.handler, 'on_' + event.event_type)(event)
+        self.handler.queue.drain()
+        diffs, _ = self.commit_cache.net_diffs()
+        return {os.path.relpath(path, self.root): changes for path, changes in diffs.items()}
+
+    def test_rename_keeps_content(self):
+        os.rename(self.path('a.py'), self.path('b.py'))
+        diffs = self.settle(FileMovedEvent(self.path('a.py'), self.path('b.py')))
+        self.assertEqual(diffs, {'b.py': [f"~ renamed from {self.path('a.py')}"]})
+        self.assertIn('b.py', self.history.files)
+        self.assertNotIn('a.py', self.history.files)
+
+    def test_atomic_save_through_temporary_file(self):
+        self.write('a.py.tmp', 'one\n2\n')
+        created = FileCreatedEvent(self.path('a.py.tmp'))
+        self.settle(created)
+        os.replace(self.path('a.py.tmp'), self.path('a.py'))
+        diffs = self.settle(FileMovedEvent(self.path('a.py.tmp'), self.path('a.py')))
+        self.assertEqual(diffs, {'a.py': ['- two', '+ 2']})
+
+    def test_atomic_save_through_backup_rename(self):
+        os.rename(self.path('a.py'), self.path('a.py~'))
+        self.write('a.py', 'one\n2\n')
+        os.remove(self.path('a.py~'))
+        diffs = self.settle(
+            FileMovedEvent(self.path('a.py'), self.path('a.py~')),
+            FileCreatedEvent(self.path('a.py')),
+            FileModifiedEvent(self.path('a.py')),
+            FileDeletedEvent(self.path('a.py~')),
+        )
+        self.assertEqual(diffs, {'a.py': ['- two', '+ 2']})
+
+    def test_backup_rename_split_across_batches(self):
+        # The settle window can close between the save and the removal of the backup
+        os.rename(self.path('a.py'), self.path('a.py~'))
+        self.write('a.py', 'one\n2\n')
+        self.settle(
+            FileMovedEvent(self.path('a.py'), self.path('a.py~')),
+            FileCreatedEvent(self.path('a.py')),
+        )
+        os.remove(self.path('a.py~'))
+        diffs = self.settle(FileDeletedEvent(self.path('a.py~')))
+        self.assertEqual(diffs, {'a.py': ['- two', '+ 2']})
+
+    def test_directory_rename_and_delete(self):
+        os.rename(self.path('pkg'), self.path('lib'))
+        diffs = self.settle(DirMovedEvent(self.path('pkg'), self.path('lib')))
+        self.assertEqual(diffs, {'lib/mod.py': [f"~ renamed from {self.path('pkg/mod.py')}"]})
+        self.assertIn('lib/mod.py', self.history.files)
+
+        shutil.rmtree(self.path('lib'))
+        diffs = self.settle(DirDeletedEvent(self.path('lib')))
+        self.assertEqual(diffs, {'pkg/mod.py': ['- x = 1']})
+        self.assertNotIn('lib', self.history.dirs)
+
+
+class TestHybridObserver(unittest.TestCase):
+    def setUp(self):
+        self.root = os.path.abspath('test_hybrid_dir')
+        for directory in ('a', 'b'):
+            os.makedirs(os.path.join(self.root, directory), exist_ok=True)
+        self.write('a/one.txt', 'one')
+        self.handler = MagicMock(spec=FileSystemEventHandler)
+        self.observer = HybridObserver(watch_budget=1, min_interval=1, max_interval=4, observer_factory=MagicMock)
+        self.observer.schedule(self.handler, self.root, ['', 'a', 'b'])
+        self.observer.rebalance()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def write(self, name, content):
+        with open(self.path(name), 'w') as file:
+            file.write(content)
+
+    def events(self):
+        events = [(type(c.args[0]).__name__, c.args[0].src_path) for c in self.handler.dispatch.call_args_list]
+        self.handler.dispatch.reset_mock()
+        return events
+
+    def test_shallowest_directories_are_watched_first(self):
+        self.assertEqual(list(self.observer.watches), [self.root])
+        self.assertEqual(sorted(self.observer.polled), [self.path('a'), self.path('b')])
+        handler, path = self.observer.observer.schedule.call_args.args
+        self.assertIsInstance(handler, ActivityHandler)
+        self.assertEqual(path, self.root)
+        self.assertFalse(self.observer.observer.schedule.call_args.kwargs['recursive'])
+
+    def test_native_directory_creation_is_discovered(self):
+        os.makedirs(self.path('b/new/deep'))
+        self.write('b/new/deep/file.txt', 'file')
+        self.observer.native_event(self.handler, DirCreatedEvent(self.path('b/new')))
+        self.assertEqual(sorted(self.events()), [
+            ('DirCreatedEvent', self.path('b/new')),
+            ('FileCreatedEvent', self.path('b/new/deep/file.txt')),
+        ])
+        self.assertIn(self.path('b/new/deep'), self.observer.polled)
+        self.assertEqual(self.observer.activity[self.path('b')], 1)
+
+    def test_poll_reports_changes(self):
+        self.write('a/one.txt', 'one, changed')
+        self.write('a/two.txt', 'two')
+        os.mkdir(self.path('a/sub'))
+        self.write('a/sub/three.txt', 'three')
+        self.observer.poll(self.path('a'))
+        self.assertEqual(sorted(self.events()), [
+            ('DirCreatedEvent', self.path('a/sub')),
+            ('FileCreatedEvent', self.path('a/sub/three.txt')),
+            ('FileCreatedEvent', self.path('a/two.txt')),
+            ('FileModifiedEvent', self.path('a/one.txt')),
+        ])
+        self.assertIn(self.path('a/sub'), self.observer.polled)
+
+        os.rename(self.path('a/two.txt'), self.path('a/renamed.txt'))
+        os.remove(self.path('a/one.txt'))
+        self.observer.poll(self.path('a'))
+        self.assertEqual(sorted(self.events()), [
+            ('FileDeletedEvent', self.path('a/one.txt')),
+            ('FileMovedEvent', self.path('a/two.txt')),
+        ])
+
+    def test_quiet_directories_are_polled_less_often(self):
+        state = self.observer.polled[self.path('b')]
+        for interval in (2, 4, 4):
+            self.observer.poll(self.path('b'))
+            self.assertEqual(state.interval, interval)
+        self.write('b/new.txt', 'new')
+        self.observer.poll(self.path('b'))
+        self.assertEqual(state.interval, 1)
+
+    def test_active_directories_are_promoted(self):
+        for _ in range(5):
+            self.observer.touch(self.path('b'))
+        self.observer.rebalance()
+        self.assertEqual(list(self.observer.watches), [self.path('b')])
+        self.assertIn(self.root, self.observer.polled)
+        self.assertNotIn(self.path('b'), self.observer.polled)
+        self.observer.observer.unschedule.assert_called_once()
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "inotify is Linux only")
+    def test_native_watches_share_one_inotify_instance(self):
+        observer = HybridObserver(watch_budget=2, min_interval=0.1)
+        observer.schedule(self.handler, self.root, ['', 'a', 'b'])
+        observer.start()
+        try:
+            self.assertIsInstance(observer.observer, SharedInotify)
+            self.assertEqual(sorted(observer.observer.handlers), [self.root, self.path('a')])
+            self.write('a/two.txt', 'two')
+            os.rename(self.path('a/two.txt'), self.path('a/renamed.txt'))
+            os.remove(self.path('a/one.txt'))
+            self.write('b/three.txt', 'three')
+            time.sleep(1)
+        finally:
+            observer.stop()
+            observer.join()
+        self.assertIsNone(observer.observer.fd)
+        events = set(self.events())
+        self.assertLessEqual({
+            ('FileCreatedEvent', self.path('a/two.txt')),
+            ('FileMovedEvent', self.path('a/two.txt')),
+            ('FileDeletedEvent', self.path('a/one.txt')),
+            ('FileCreatedEvent', self.path('b/three.txt')),
+        }, events)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "inotify is Linux only")
+    def test_removed_watch_does_not_lose_other_events(self):
+        inotify = SharedInotify()
+        inotify.schedule(self.handler, self.path('a'))
+        inotify.schedule(self.handler, self.path('b'))
+        inotify.start()
+        try:
+            inotify.unschedule(self.path('b'))
+            self.write('a/x.txt', 'x')
+            self.write('b/y.txt', 'y')
+            time.sleep(1)
+            self.assertEqual(list(inotify.paths.values()), [self.path('a')])
+        finally:
+            inotify.stop()
+            inotify.join()
+        events = set(self.events())
+        self.assertIn(('FileCreatedEvent', self.path('a/x.txt')), events)
+        self.assertNotIn(('FileCreatedEvent', self.path('b/y.txt')), events)
+
+
+class TestEventQueue(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.queue = EventQueue(self.batches.append, settle_time=0.5, max_latency=2, max_pending=3)
+
+    @patch('handlers.event_queue.time.monotonic')
+    def test_put_coalesces_same_path(self, mock_monotonic):
+        mock_monotonic.side_effect = [10.0, 10.2]
+        self.queue.put('a.txt')
+        self.queue.put('a.txt')
+        self.assertEqual(self.queue.pending, {'a.txt': (10.0, 10.2)})
+        self.assertEqual(self.queue.coalesced, 1)
+
+    @patch('handlers.event_queue.time.monotonic')
+    def test_take_ready_waits_for_settle_time(self, mock_monotonic):
+        mock_monotonic.side_effect = [10.0, 10.3, 10.4, 10.6]
+        self.queue.put('a.txt')
+        self.queue.put('b.txt')
+        with self.queue.condition:
+            ready, wait = self.queue.take_ready()
+        self.assertEqual(ready, [])
+        self.assertAlmostEqual(wait, 0.1)
+        with self.queue.condition:
+            ready, wait = self.queue.take_ready()
+        self.assertEqual(ready, ['a.txt'])
+        self.assertAlmostEqual(wait, 0.2)
+
+    @patch('handlers.event_queue.time.monotonic')
+    def test_take_ready_bounds_latency(self, mock_monotonic):
+        self.queue.pending = {'busy.txt': (10.0, 11.9)}
+        mock_monotonic.return_value = 12.0
+        with self.queue.condition:
+            ready, _ = self.queue.take_ready()
+        self.assertEqual(ready, ['busy.txt'])
+
+    def test_take_ready_flushes_when_full(self):
+        for path in ('a', 'b', 'c'):
+            self.queue.put(path)
+        with self.queue.condition:
+            ready, _ = self.queue.take_ready()
+        self.assertEqual(ready, ['a', 'b', 'c'])
+        self.assertEqual(self.queue.pending, {})
 
-        self.assertIn("Error comparing files: mocked error", log.output[0])
+    def test_worker_processes_batches(self):
+        self.queue.settle_time = 0
+        self.queue.start()
+        self.queue.put('a.txt')
+        self.queue.stop()
+        self.assertEqual([path for batch in self.batches for path in batch], ['a.txt'])
+        self.assertFalse(self.queue.worker.is_alive())
 
 
 class TestCompletionHandler(unittest.TestCase):
-    @patch('handlers.completion_handler.OpenAI')
-    def setUp(self, mock_openai):
+    def setUp(self):
+        # The client is built on first use, so openai stays patched for the whole test
+        openai_patcher = patch('openai.AsyncOpenAI')
+        self.mock_openai = openai_patcher.start()
+        self.addCleanup(openai_patcher.stop)
         self.api_key = 'dummy_api_key'
-        self.completion_handler = CompletionHandler(self.api_key)
-        self.mock_openai_client = mock_openai.return_value
+        self.completion_handler = CompletionHandler(self.api_key, retry_backoff=0)
+        self.mock_openai_client = self.mock_openai.return_value
+        self.mock_openai_client.chat.completions.create = AsyncMock()
+
+    def tearDown(self) -> None:
+        self.completion_handler.loop.close()
+        return super().tearDown()
 
     def test_init(self):
+        self.mock_openai.assert_not_called()
+        self.assertEqual(self.completion_handler.client, self.mock_openai_client)
         self.assertEqual(self.completion_handler.client, self.mock_openai_client)
-        self.assertIsInstance(self.completion_handler.commit_cache, defaultdict)
+        self.mock_openai.assert_called_once_with(api_key=self.api_key, base_url=None, max_retries=0)
+        self.assertIsInstance(self.completion_handler.commit_cache, CommitCache)
+
+    def test_payload_format(self):
+        handler = CompletionHandler(self.api_key, payload_format='compact')
+        self.assertIsInstance(handler.payload_builder.serializer, CompactDiffSerializer)
+        handler.loop.close()
+        with self.assertRaises(ValueError):
+            CompletionHandler(self.api_key, payload_format='xml')
 
     def test_store_commit(self):
         file_path = 'test_file.py'
-        changes = ['Added a new function', 'Refactored code']
-        self.completion_handler.store_commit(file_path, changes)
+        old, new = FileRepr(file_path, 'old'), FileRepr(file_path, 'new')
+        self.completion_handler.store_commit(file_path, old, new)
         self.assertIn(file_path, self.completion_handler.commit_cache)
-        self.assertIn(changes, self.completion_handler.commit_cache[file_path])
+        self.assertIs(self.completion_handler.commit_cache[file_path].baseline, old)
+
+    @patch('handlers.completion_handler.Utils')
+    def test_generate_commit_msg_from_commit_cache(self, mock_utils):
+        mock_utils.content_prompt = "This is a content prompt"
+        mock_response = MagicMock()
+        mock_response.choices = [MagicMock()]
+        mock_response.choices[0].message.content = "Net message"
+        self.mock_openai_client.chat.completions.create.return_value = mock_response
+        self.completion_handler.store_commit('a.py', FileRepr('a.py', 'one'), FileRepr('a.py', 'two'))
+
+        commit_msg = self.completion_handler.generate_commit_msg()
+
+        self.assertTrue(commit_msg.endswith("Net message"))
+        content = self.mock_openai_client.chat.completions.create.call_args.kwargs['messages'][1]['content']
+        self.assertEqual(content, "--- a.py\n- one\n+ two")
+        self.assertEqual(len(self.completion_handler.commit_cache), 0)
+
+    @patch('handlers.completion_handler.Utils')
+    def test_generate_commit_msg_merges_speculative_summaries(self, mock_utils):
+        mock_utils.merge_prompt = "Merge"
+        mock_utils.summary_prompt = "Summarize"
+        mock_response = MagicMock()
+        mock_response.choices = [MagicMock()]
+        mock_response.choices[0].message.content = "Merged message"
+        self.mock_openai_client.chat.completions.create.return_value = mock_response
+        commit_cache = self.completion_handler.commit_cache
+        commit_cache.store('a.py', FileRepr('a.py', 'one'), FileRepr('a.py', 'two'))
+        [(file_path, state)] = commit_cache.idle_files(0)
+        commit_cache.set_speculative(file_path, state, "a.py: one became two")
+
+        commit_msg = self.completion_handler.generate_commit_msg()
+
+        self.assertTrue(commit_msg.endswith("Merged message"))
+        self.mock_openai_client.chat.completions.create.assert_called_once()
+        messages = self.mock_openai_client.chat.completions.create.call_args.kwargs['messages']
+        self.assertEqual([m['content'] for m in messages], ["Merge", "a.py: one became two"])
+
+    def test_generate_commit_msg_without_changes(self):
+        commit_msg = self.completion_handler.generate_commit_msg()
+        self.assertEqual(commit_msg, "\n No changes since the last generated commit message.")
+        self.mock_openai_client.chat.completions.create.assert_not_called()
+
+    @patch('handlers.completion_handler.Utils')
+    def test_generate_commit_msg_retries_transient_errors(self, mock_utils):
+        mock_response = MagicMock()
+        mock_response.choices = [MagicMock()]
+        mock_response.choices[0].message.content = "Recovered"
+        self.mock_openai_client.chat.completions.create.side_effect = [
+            asyncio.TimeoutError(), asyncio.TimeoutError(), mock_response
+        ]
+
+        commit_msg = self.completion_handler.generate_commit_msg({'a.py': [['+ a']]})
+
+        self.assertTrue(commit_msg.endswith("Recovered"))
+        self.assertEqual(self.mock_openai_client.chat.completions.create.call_count, 3)
+        counters = self.completion_handler.metrics.collect()['counters']
+        self.assertEqual(counters['llm_requests_total{outcome="retry"}'], 2)
+        self.assertEqual(counters['llm_requests_total{outcome="ok"}'], 1)
+
+    @patch('handlers.completion_handler.Utils')
+    def test_generate_commit_msg_gives_up_after_max_retries(self, mock_utils):
+        self.completion_handler.max_retries = 1
+        self.mock_openai_client.chat.completions.create.side_effect = asyncio.TimeoutError()
+
+        with self.assertRaises(asyncio.TimeoutError):
+            self.completion_handler.generate_commit_msg({'a.py': [['+ a']]})
+        self.assertEqual(self.mock_openai_client.chat.completions.create.call_count, 2)
+
+    @patch('handlers.completion_handler.Utils')
+    def test_generate_commit_msg_streams_tokens(self, mock_utils):
+        printed = []
+        self.completion_handler.stream = True
+        self.completion_handler.on_token = printed.append
+
+        async def stream():
+            for token in ("Add ", None, "tests"):
+                chunk = MagicMock()
+                chunk.choices = [MagicMock()]
+                chunk.choices[0].delta.content = token
+                yield chunk
+        self.mock_openai_client.chat.completions.create.return_value = stream()
+
+        commit_msg = self.completion_handler.generate_commit_msg({'a.py': [['+ a']]})
+
+        self.assertEqual(commit_msg, "\n Generated commit message: \nAdd tests")
+        self.assertEqual(printed, ["\n Generated commit message: \n", "Add ", "tests"])
+        self.assertTrue(self.mock_openai_client.chat.completions.create.call_args.kwargs['stream'])
 
     @patch('handlers.completion_handler.Utils')
     def test_generate_commit_msg(self, mock_utils):
-        diff_state = ['diff line 1', 'diff line 2']
+        diff_state = {'a.py': [['- old line', '+ new line']]}
         mock_response = MagicMock()
         mock_response.choices = [MagicMock()]
         mock_response.choices[0].message.content = "This is a commit message"
@@ -280,10 +1163,702 @@ class TestCompletionHandler(unittest.TestCase):
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "This is a content prompt"},
-                {"role": "user", "content": str(diff_state)}
+                {"role": "user", "content": "--- a.py\n- old line\n+ new line"}
             ]
         )
 
+    @patch('handlers.completion_handler.Utils')
+    def test_generate_commit_msg_uses_response_cache(self, mock_utils):
+        mock_utils.content_prompt = "This is a content prompt"
+        mock_response = MagicMock()
+        mock_response.choices = [MagicMock()]
+        mock_response.choices[0].message.content = "Cached message"
+        self.mock_openai_client.chat.completions.create.return_value = mock_response
+
+        first = self.completion_handler.generate_commit_msg({'a.py': [['+ a']]})
+        second = self.completion_handler.generate_commit_msg({'a.py': [['+ a  ']]})
+
+        self.assertEqual(first, second)
+        self.mock_openai_client.chat.completions.create.assert_called_once()
+        self.assertEqual(self.completion_handler.cache.stats(), {'entries': 1, 'hits': 1, 'misses': 1})
+
+    @patch('handlers.completion_handler.Utils')
+    def test_generate_commit_msg_map_reduce(self, mock_utils):
+        mock_utils.summary_prompt = "summary"
+        mock_utils.merge_prompt = "merge"
+        self.completion_handler.payload_builder = PayloadBuilder(chunk_tokens=10, total_tokens=1000)
+        diff_state = {'a.py': [['+ ' + 'a' * 30]], 'b.py': [['+ ' + 'b' * 30]]}
+
+        def complete(model, messages):
+            response = MagicMock()
+            response.choices = [MagicMock()]
+            response.choices[0].message.content = f"{messages[0]['content']}:{len(messages[1]['content'])}"
+            return response
+        self.mock_openai_client.chat.completions.create.side_effect = complete
+
+        commit_msg = self.completion_handler.generate_commit_msg(diff_state)
+
+        prompts = [c.kwargs['messages'][0]['content'] for c in self.mock_openai_client.chat.completions.create.call_args_list]
+        self.assertEqual(prompts, ['summary', 'summary', 'merge'])
+        self.assertTrue(commit_msg.endswith("merge:22"))
+
+
+class StubCompletionServer(BaseHTTPRequestHandler):
+    # Minimal OpenAI compatible endpoint, standing in for the API in tests
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        content = f"stub:{body['messages'][1]['content']}"
+        response = json.dumps({
+            'id': 'stub', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+            'choices': [{
+                'index': 0, 'finish_reason': 'stop',
+                'message': {'role': 'assistant', 'content': content}
+            }],
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestCompletionHandlerWithStubServer(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubCompletionServer)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.completion_handler = CompletionHandler(
+            'dummy_api_key', base_url=f"http://127.0.0.1:{self.server.server_port}/v1"
+        )
+
+    def tearDown(self) -> None:
+        self.completion_handler.loop.close()
+        self.server.shutdown()
+        self.server.server_close()
+        return super().tearDown()
+
+    def test_generate_commit_msg(self):
+        commit_msg = self.completion_handler.generate_commit_msg({'a.py': [['+ a']]})
+        self.assertEqual(commit_msg, "\n Generated commit message: \nstub:--- a.py\n+ a")
+
+
+class TestCommitCache(unittest.TestCase):
+    def setUp(self):
+        self.store = SnapshotStore()
+        self.commit_cache = CommitCache()
+
+    def repr(self, content):
+        return FileRepr('a.py', content, store=self.store)
+
+    def test_store_keeps_baseline_and_latest(self):
+        baseline = self.repr('one')
+        self.commit_cache.store('a.py', baseline, self.repr('two'))
+        self.commit_cache.store('a.py', self.repr('two'), self.repr('three'))
+        diffs, _ = self.commit_cache.net_diffs()
+        self.assertEqual(diffs, {'a.py': ['- one', '+ three']})
+        self.assertIs(self.commit_cache['a.py'].baseline, baseline)
+
+    def test_store_drops_reverted_files(self):
+        self.commit_cache.store('a.py', self.repr('one'), self.repr('two'))
+        self.commit_cache.store('a.py', self.repr('two'), self.repr('one'))
+        self.assertEqual(len(self.commit_cache), 0)
+
+    def test_deleted_file(self):
+        self.commit_cache.store('a.py', self.repr('one'), None)
+        diffs, _ = self.commit_cache.net_diffs()
+        self.assertEqual(diffs, {'a.py': ['- one']})
+
+    def test_binary_change_is_summarized(self):
+        old, new = FileRepr('a.png', None, store=self.store), FileRepr('a.png', None, store=self.store)
+        old.set_digest('aa', 'binary')
+        new.set_digest('bb', 'binary')
+        old.st_size, new.st_size = 10, 12
+        self.commit_cache.store('a.png', old, new)
+        diffs, _ = self.commit_cache.net_diffs()
+        self.assertEqual(diffs, {'a.png': ['~ binary changed (10→12 bytes)']})
+
+    def test_advance_keeps_later_changes(self):
+        self.commit_cache.store('a.py', self.repr('one'), self.repr('two'))
+        self.commit_cache.store('b.py', self.repr('b1'), self.repr('b2'))
+        _, snapshot = self.commit_cache.net_diffs()
+        self.commit_cache.store('a.py', self.repr('two'), self.repr('three'))
+
+        self.commit_cache.advance(snapshot)
+
+        diffs, _ = self.commit_cache.net_diffs()
+        self.assertEqual(diffs, {'a.py': ['- two', '+ three']})
+
+    def test_enforce_limit_folds_oldest_entries(self):
+        self.commit_cache.max_bytes = 150
+        unchanged = "line\n" * 20
+        self.commit_cache.store('a.py', self.repr(unchanged + 'a'), self.repr(unchanged + 'b'))
+        self.commit_cache.store('c.py', self.repr(unchanged + 'c'), self.repr(unchanged + 'd'))
+
+        self.assertEqual(self.commit_cache['a.py'].folded, ['- a', '+ b'])
+        self.assertIs(self.commit_cache['a.py'].baseline, self.commit_cache['a.py'].current)
+        self.assertEqual(self.commit_cache['c.py'].folded, [])
+        self.assertLessEqual(self.commit_cache.memory_usage(), 150)
+
+        self.commit_cache.store('a.py', self.repr(unchanged + 'b'), self.repr(unchanged + 'e'))
+        diffs, _ = self.commit_cache.net_diffs()
+        self.assertEqual(diffs['a.py'], ['- a', '+ b', '- b', '+ e'])
+
+    def test_memory_usage_is_kept_up_to_date(self):
+        def recount():
+            return sum(entry.pinned_bytes() for entry in self.commit_cache.entries.values())
+
+        self.commit_cache.max_bytes = 150
+        unchanged = "line\n" * 20
+        self.commit_cache.store('a.py', self.repr(unchanged + 'a'), self.repr(unchanged + 'b'))
+        self.commit_cache.store('b.py', self.repr('one'), None)
+        self.commit_cache.store('c.py', None, self.repr('new'))
+        self.assertEqual(self.commit_cache.memory_usage(), recount())
+        self.commit_cache.move('b.py', 'd.py', self.repr('one'))
+        self.commit_cache.move('c.py', 'a.py', self.repr('new'))
+        self.commit_cache.store('e.py', self.repr(unchanged + 'c'), self.repr(unchanged + 'd'))
+        self.assertEqual(self.commit_cache.memory_usage(), recount())
+
+        _, snapshot = self.commit_cache.net_diffs()
+        self.commit_cache.store('e.py', None, self.repr('later'))
+        self.commit_cache.advance(snapshot)
+        self.assertEqual(self.commit_cache.memory_usage(), recount())
+        self.commit_cache.clear()
+        self.assertEqual(self.commit_cache.memory_usage(), 0)
+
+    def test_context_lines(self):
+        self.commit_cache.context = 1
+        self.commit_cache.store('a.py', self.repr('one\ntwo\nthree'), self.repr('one\n2\nthree'))
+        diffs, _ = self.commit_cache.net_diffs()
+        self.assertEqual(diffs['a.py'], ['@@ -1,3 +1,3 @@', '  one', '- two', '+ 2', '  three'])
+
+
+
+class TestDiffPool(unittest.TestCase):
+    def setUp(self):
+        self.store = SnapshotStore()
+        self.engine = PatienceDiffEngine()
+        self.pairs = [
+            (FileRepr('a.py', 'one\ntwo', store=self.store), FileRepr('a.py', 'one\n2', store=self.store)),
+            (FileRepr('b.py', 'x' * 100, store=self.store), None),
+            (FileRepr('c.py', 'same', store=self.store), FileRepr('c.py', 'same\nmore', store=self.store)),
+        ]
+        self.expected = [['- two', '+ 2'], ['- ' + 'x' * 100], ['+ more']]
+
+    def test_small_pairs_stay_in_process(self):
+        pool = DiffPool(workers=2, min_bytes=1024)
+        self.assertEqual(pool.map(self.engine, self.pairs), self.expected)
+        self.assertIsNone(pool.executor)
+
+    def test_worker_processes_keep_order(self):
+        pool = DiffPool(workers=2, min_bytes=50)
+        try:
+            self.assertEqual(pool.map(self.engine, self.pairs), self.expected)
+        finally:
+            pool.close()
+        self.assertEqual(pool.offloaded, 1)
+
+    def test_concurrent_callers_share_one_executor(self):
+        def slow_executor(*args, **kwargs):
+            time.sleep(0.05)
+            return MagicMock()
+
+        pool = DiffPool(workers=2)
+        with patch('utils.diff_pool.ProcessPoolExecutor', side_effect=slow_executor) as mock_executor:
+            threads = [threading.Thread(target=pool.start) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        mock_executor.assert_called_once()
+
+    def test_commit_cache_uses_pool(self):
+        commit_cache = CommitCache(diff_pool=DiffPool(workers=0))
+        for old, new in self.pairs:
+            commit_cache.store(old.file_path, old, new)
+        diffs, _ = commit_cache.net_diffs()
+        self.assertEqual(diffs, dict(zip(('a.py', 'b.py', 'c.py'), self.expected)))
+
+
+class TestChangeSummarizer(unittest.TestCase):
+    OLD = (
+        "import os\n"
+        "LIMIT = 10\n"
+        "def parse(text):\n    return text.split()\n"
+        "def helper():\n    return 1\n"
+        "class Reader:\n    def read(self, path):\n        return open(path).read()\n"
+    )
+    NEW = (
+        "import sys\n"
+        "LIMIT = 20\n"
+        "def parse(text, sep=None):\n    return text.split(sep)\n"
+        "def assist():\n    return 1\n"
+        "class Reader:\n    def read(self, path):\n        # Text only\n        return open(path).read().strip()\n"
+        "    def close(self):\n        pass\n"
+    )
+
+    def test_python_records(self):
+        records = summarize_change('pkg/mod.py', self.OLD, self.NEW)
+        self.assertEqual(records, [
+            "~ removed import os",
+            "~ added import sys",
+            "~ renamed function helper to assist",
+            "~ added method Reader.close(self)",
+            "~ changed function parse signature: (text) -> (text, sep=None)",
+            "~ changed method Reader.read body",
+            "~ changed LIMIT",
+        ])
+
+    def test_class_body_changes(self):
+        # Attributes, decorators and docstrings of a class are covered, its methods have records of their own
+        records = summarize_change("x.py", "import os\nclass A:\n    T = 5\n", "import sys\nclass A:\n    T = 500\n")
+        self.assertEqual(records, ["~ removed import os", "~ added import sys", "~ changed class A body"])
+        records = summarize_change("x.py", "class A:\n    pass\n", "@dataclass\nclass A:\n    pass\n")
+        self.assertEqual(records, ["~ changed class A body"])
+        records = summarize_change(
+            "x.py", "class A:\n    def f(self):\n        return 1\n", "class A:\n    def f(self):\n        return 2\n"
+        )
+        self.assertEqual(records, ["~ changed method A.f body"])
+
+    def test_unsupported_or_invalid_source(self):
+        self.assertIsNone(summarize_change('notes.txt', 'a', 'b'))
+        self.assertIsNone(summarize_change('mod.py', 'def f(:', 'x = 1'))
+        self.assertEqual(summarize_change('mod.py', 'x = 1\n', '# note\nx = 1\n'), [])
+
+    def test_commit_cache_modes(self):
+        store = SnapshotStore()
+        old, new = FileRepr('mod.py', self.OLD, store=store), FileRepr('mod.py', self.NEW, store=store)
+        comment = FileRepr('b.py', 'x = 1', store=store), FileRepr('b.py', '# note\nx = 1', store=store)
+
+        commit_cache = CommitCache(summary_mode='instead')
+        commit_cache.store('mod.py', old, new)
+        commit_cache.store('b.py', *comment)
+        diffs, _ = commit_cache.net_diffs()
+        self.assertTrue(all(line.startswith('~ ') for line in diffs['mod.py']))
+        self.assertEqual(diffs['b.py'], ['+ # note'])
+
+        commit_cache = CommitCache(summary_mode='alongside')
+        commit_cache.store('mod.py', old, new)
+        diffs, _ = commit_cache.net_diffs()
+        self.assertEqual(diffs['mod.py'][0], "~ removed import os")
+        self.assertIn("+ import sys", diffs['mod.py'])
+
+        with self.assertRaises(ValueError):
+            CommitCache(summary_mode='summary')
+
+
+class TestSpeculativeSummarizer(unittest.TestCase):
+    def setUp(self):
+        self.store = SnapshotStore()
+        self.commit_cache = CommitCache()
+        for name in ('a.py', 'b.py'):
+            self.commit_cache.store(name, FileRepr(name, 'one', store=self.store), FileRepr(name, 'two', store=self.store))
+        self.completion = MagicMock()
+        self.completion.payload_builder = PayloadBuilder()
+        self.completion.summarize_chunk.side_effect = lambda chunk: f"Summary of {chunk.split()[1]}"
+        self.summarizer = SpeculativeSummarizer(self.completion, lambda: [self.commit_cache], idle_time=0)
+
+    def test_summarizes_idle_files_once(self):
+        self.assertEqual(self.summarizer.summarize_idle(), 2)
+        self.assertEqual(
+            self.commit_cache.speculative_summaries(), {'a.py': "Summary of a.py", 'b.py': "Summary of b.py"}
+        )
+        self.assertEqual(self.summarizer.summarize_idle(), 0)
+
+    def test_change_makes_summary_stale(self):
+        self.summarizer.summarize_idle()
+        self.commit_cache.store('a.py', None, FileRepr('a.py', 'three', store=self.store))
+        self.assertEqual(list(self.commit_cache.speculative_summaries()), ['b.py'])
+        self.assertEqual(self.commit_cache.idle_files(60), [])
+
+    def test_skipped_and_over_budget_files_are_not_diffed_again(self):
+        self.completion.payload_builder.build = MagicMock(return_value=['one', 'two']) # Too large
+        with patch.object(self.commit_cache, 'net_diffs', wraps=self.commit_cache.net_diffs) as net_diffs:
+            self.assertEqual(self.summarizer.summarize_idle(), 0)
+            self.assertEqual(net_diffs.call_count, 2)
+            self.assertEqual(self.summarizer.summarize_idle(), 0)
+            self.assertEqual(net_diffs.call_count, 2)
+        self.assertEqual(self.commit_cache.speculative_summaries(), {})
+
+        self.commit_cache.store('a.py', None, FileRepr('a.py', 'three', store=self.store))
+        self.summarizer.daily_tokens = 0
+        with patch.object(self.commit_cache, 'net_diffs') as net_diffs:
+            self.assertEqual(self.summarizer.summarize_idle(), 0)
+        net_diffs.assert_not_called()
+
+    def test_budgets(self):
+        self.summarizer.requests_per_minute = 1
+        self.assertEqual(self.summarizer.summarize_idle(), 1)
+        counters = self.summarizer.metrics.collect()['counters']
+        self.assertEqual(counters['speculative_summaries_total{outcome="over_budget"}'], 1)
+
+        self.summarizer.requests_per_minute = 10
+        self.summarizer.daily_tokens = self.summarizer.spent_tokens
+        self.assertEqual(self.summarizer.summarize_idle(), 0)
+        self.summarizer.day = '1970-01-01'
+        self.assertEqual(self.summarizer.summarize_idle(), 1)
+
+
+class TestFileClassifier(unittest.TestCase):
+    def test_is_binary(self):
+        self.assertTrue(is_binary(b'abc\x00def'))
+        self.assertTrue(is_binary(b'%PDF-1.7 plain looking header'))
+        self.assertFalse(is_binary('text'.encode('utf-16')))
+        self.assertFalse(is_binary(b'plain text\n'))
+
+    def test_detect_encoding(self):
+        self.assertEqual(detect_encoding(b'plain'), 'utf-8')
+        self.assertEqual(detect_encoding('bom'.encode('utf-8-sig')), 'utf-8-sig')
+        self.assertEqual(detect_encoding('wide'.encode('utf-32')), 'utf-32')
+        with patch('utils.file_classifier.charset_normalizer', None):
+            self.assertEqual(detect_encoding('café'.encode('latin-1')), 'cp1252')
+            self.assertEqual(detect_encoding(b'caf\xe9 \x81'), 'latin-1')
+            self.assertIsNone(detect_encoding(bytes(range(1, 256)) * 4))
+
+
+class TestIgnoreRules(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = Path('test_ignore_dir')
+        (self.test_dir / 'sub').mkdir(parents=True, exist_ok=True)
+        self.rules = IgnoreRules(self.test_dir, excluded_dirs={'.git'}, excluded_files={'.env'})
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_glob_patterns(self):
+        (self.test_dir / '.gitignore').write_text(
+            '# comment\n*.log\nbuild/**\n/dist/\ndocs/**/*.tmp\nfile[0-9].txt\n'
+        )
+        ignored = ['a.log', 'sub/deep/b.log', 'build/x/y.js', 'dist/app.js', 'docs/a/b/c.tmp', 'file1.txt']
+        kept = ['a.txt', 'sub/dist/app.js', 'docs/a.txt', 'filex.txt', 'build']
+        for path in ignored:
+            self.assertTrue(self.rules.is_ignored(path), path)
+        for path in kept:
+            self.assertFalse(self.rules.is_ignored(path), path)
+        self.assertTrue(self.rules.is_ignored('.git/config'))
+        self.assertTrue(self.rules.is_ignored('sub/.env'))
+
+    def test_nested_files_and_negation(self):
+        (self.test_dir / '.gitignore').write_text('*.log\n')
+        (self.test_dir / 'sub' / '.vcwignore').write_text('!keep.log\n/local.txt\n')
+        self.assertTrue(self.rules.is_ignored('debug.log'))
+        self.assertFalse(self.rules.is_ignored('sub/keep.log'))
+        self.assertTrue(self.rules.is_ignored('sub/other.log'))
+        self.assertTrue(self.rules.is_ignored('sub/local.txt'))
+        self.assertFalse(self.rules.is_ignored('local.txt'))
+
+    def test_directory_matchers_are_cached(self):
+        (self.test_dir / '.gitignore').write_text('*.log\n')
+        self.assertIs(self.rules.matcher('sub'), self.rules.matcher(''))
+        (self.test_dir / '.gitignore').write_text('*.txt\n')
+        self.assertTrue(self.rules.is_ignored('a.log'))
+        self.rules.invalidate()
+        self.assertFalse(self.rules.is_ignored('a.log'))
+
+    def test_parse_rule(self):
+        self.assertIsNone(parse_rule('# comment'))
+        self.assertIsNone(parse_rule('   '))
+        self.assertEqual(parse_rule('out/', 'sub'), (r'sub/(?:.*/)?out', False, True))
+        self.assertTrue(parse_rule('!a').negate)
+
+
+class TestDaemonServer(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = Path('test_daemon_dir')
+        self.server = DaemonServer({
+            ('GET', '/status'): lambda: {'roots': ['a']},
+            ('POST', '/generate'): lambda root=None: {root or 'a': 'Message'},
+        })
+
+    def tearDown(self):
+        if self.server.server is not None:
+            self.server.shutdown()
+            self.server.close()
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def start(self, **bind_args):
+        address = self.server.bind(**bind_args)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return address
+
+    def test_unix_socket(self):
+        socket_path = self.test_dir / 'daemon.sock'
+        self.start(socket_path=socket_path)
+        options = {'socket_path': str(socket_path)}
+        self.assertEqual(vcwclient.request('status', **options), {'roots': ['a']})
+        self.assertEqual(vcwclient.request('generate', {'root': 'b'}, **options), {'b': 'Message'})
+        with self.assertRaises(RuntimeError):
+            vcwclient.request('generate', {'unknown': 1}, **options)
+        with self.assertRaises(RuntimeError):
+            vcwclient.request('reset', **options)
+
+    def test_text_response(self):
+        self.server.commands[('GET', '/metrics')] = lambda: TextResponse("vcwatcher_up 1\n")
+        address = self.start(port=0)
+        port = int(address.rsplit(':', 1)[1])
+        self.assertEqual(vcwclient.request('metrics', port=port), "vcwatcher_up 1\n")
+
+    def test_tcp_fallback(self):
+        address = self.start(port=0)
+        port = int(address.rsplit(':', 1)[1])
+        self.assertEqual(vcwclient.request('status', port=port), {'roots': ['a']})
+
+    def test_invalid_body(self):
+        address = self.start(port=0)
+        port = int(address.rsplit(':', 1)[1])
+        for body in (b'[1, 2]', b'"root"', b'{not json'):
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            connection.request('POST', '/generate', body=body, headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            self.assertEqual(response.status, 400)
+            self.assertIn('Invalid request body', json.loads(response.read())['error'])
+            connection.close()
+
+    def test_stale_socket_is_replaced(self):
+        self.test_dir.mkdir()
+        (self.test_dir / 'daemon.sock').write_text('')
+        self.start(socket_path=self.test_dir / 'daemon.sock')
+        other = DaemonServer({})
+        with self.assertRaises(OSError):
+            other.bind(self.test_dir / 'daemon.sock')
+
+    @patch('vcwclient.request', return_value={'.': 'Add daemon mode'})
+    def test_prepare_commit_msg_hook(self, mock_request):
+        self.test_dir.mkdir()
+        message_file = self.test_dir / 'COMMIT_EDITMSG'
+        message_file.write_text('# Please enter the commit message\n')
+        vcwclient.prepare_commit_msg(str(message_file), '')
+        self.assertEqual(message_file.read_text(), 'Add daemon mode\n# Please enter the commit message\n')
+
+        vcwclient.prepare_commit_msg(str(message_file), 'message')
+        mock_request.assert_called_once()
+
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = Path('test_bench_dir')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_generate_tree_is_reproducible(self):
+        first = benchmark.generate_tree(self.test_dir / 'a', 50, 3, 512, 0.2, seed=1)
+        second = benchmark.generate_tree(self.test_dir / 'b', 50, 3, 512, 0.2, seed=1)
+        self.assertEqual(len(first['text']) + len(first['binary']), 50)
+        self.assertEqual(
+            [path.relative_to(self.test_dir / 'a') for path in first['binary']],
+            [path.relative_to(self.test_dir / 'b') for path in second['binary']]
+        )
+        self.assertTrue(all(len(path.relative_to(self.test_dir / 'a').parts) <= 4 for path in first['text']))
+
+    def test_run_and_compare(self):
+        output = self.test_dir / 'results.json'
+        self.test_dir.mkdir()
+        with patch('benchmark.print'):
+            benchmark.main([
+                '--files', '30', '--events', '20', '--hot-files', '3', '--diff-samples', '5',
+                '--diff-workers', '1', '--settle-time', '0.01', '--workdir', str(self.test_dir / 'tree'), '--output', str(output)
+            ])
+        results = json.loads(output.read_text())
+        self.assertFalse((self.test_dir / 'tree').exists())
+        self.assertEqual(results['metrics']['events'], 20)
+        self.assertEqual(results['metrics']['payload_requests'], 1)
+        self.assertGreater(results['metrics']['payload_tokens'], 0)
+        self.assertGreater(results['metrics']['diff_pool_lines_per_s'], 0)
+
+        slower = json.loads(output.read_text())
+        slower['metrics']['scan_files_per_s'] /= 2
+        changes = [line for line in benchmark.compare(slower, results) if line.startswith('scan_files_per_s')]
+        self.assertTrue(changes[0].endswith("(+100.0%) (better)"))
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counters_and_callbacks(self):
+        metrics = Metrics()
+        metrics.inc('events_total')
+        metrics.inc('events_total', 2)
+        metrics.inc('dropped_total', reason='ignored')
+        metrics.register('tree_files', lambda: 42, root='a')
+        metrics.register('broken', lambda: 1 / 0)
+        with self.assertLogs(level='ERROR'):
+            snapshot = metrics.collect()
+        self.assertEqual(snapshot['counters'], {'events_total': 3, 'dropped_total{reason="ignored"}': 1})
+        self.assertEqual(snapshot['gauges'], {'tree_files{root="a"}': 42})
+
+    def test_histogram_quantiles(self):
+        metrics = Metrics()
+        for value in [0.002] * 90 + [0.2] * 9 + [2]:
+            metrics.observe('read_seconds', value)
+        summary = metrics.collect()['histograms']['read_seconds']
+        self.assertEqual((summary['count'], summary['max']), (100, 2))
+        self.assertEqual((summary['p50'], summary['p95'], summary['p99']), (0.005, 0.5, 0.5))
+
+    def test_prometheus_text(self):
+        metrics = Metrics()
+        metrics.describe('events_total', 'Events received')
+        metrics.inc('events_total')
+        metrics.observe('read_bytes', 10, buckets=(100, 1000))
+        text = metrics.to_prometheus()
+        self.assertIn('# HELP vcwatcher_events_total Events received\n', text)
+        self.assertIn('# TYPE vcwatcher_events_total counter\nvcwatcher_events_total 1\n', text)
+        self.assertIn('vcwatcher_read_bytes_bucket{le="100"} 1\n', text)
+        self.assertIn('vcwatcher_read_bytes_bucket{le="+Inf"} 1\n', text)
+        self.assertIn('vcwatcher_read_bytes_count 1\n', text)
+
+    def test_trace_spans(self):
+        metrics = Metrics(trace=True)
+        with metrics.trace_event('event', path='a.py'):
+            with metrics.span('read'):
+                pass
+        with metrics.span('outside'):
+            pass
+        spans = metrics.recent_traces()
+        self.assertEqual([(span['trace_id'], span['span']) for span in spans], [(1, 'read'), (1, 'event')])
+        self.assertEqual(spans[1]['path'], 'a.py')
+        self.assertIn('outside_seconds', metrics.collect()['histograms'])
+
+        untraced = Metrics()
+        with untraced.trace_event('event', path='a.py'):
+            pass
+        self.assertEqual(untraced.recent_traces(), [])
+        self.assertEqual(untraced.collect()['histograms']['event_seconds']['count'], 1)
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache(max_entries=2, ttl=60)
+        self.cache_dir = Path('test_temp_cache')
+
+    def tearDown(self) -> None:
+        if self.cache_dir.exists():
+            shutil.rmtree(self.cache_dir)
+        return super().tearDown()
+
+    def test_key_normalizes_content(self):
+        self.assertEqual(
+            self.cache.key('model', 'prompt', '+ a  \r\n- b\n'),
+            self.cache.key('model', 'prompt', '+ a\n- b')
+        )
+        self.assertNotEqual(self.cache.key('model', 'prompt', '+ a'), self.cache.key('other', 'prompt', '+ a'))
+        self.assertNotEqual(self.cache.key('model', 'prompt', '+ a'), self.cache.key('model', 'other', '+ a'))
+
+    def test_get_and_put(self):
+        self.assertIsNone(self.cache.get('key'))
+        self.cache.put('key', 'response')
+        self.assertEqual(self.cache.get('key'), 'response')
+        self.assertEqual(self.cache.stats(), {'entries': 1, 'hits': 1, 'misses': 1})
+
+    def test_put_evicts_least_recently_used(self):
+        self.cache.put('a', '1')
+        self.cache.put('b', '2')
+        self.cache.get('a')
+        self.cache.put('c', '3')
+        self.assertEqual(list(self.cache.entries), ['a', 'c'])
+
+    @patch('utils.response_cache.time.time')
+    def test_get_expires_entries(self, mock_time):
+        mock_time.return_value = 100.0
+        self.cache.put('key', 'response')
+        mock_time.return_value = 161.0
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_persists_to_disk(self):
+        self.cache.open(self.cache_dir / 'responses.json')
+        self.cache.put('key', 'response')
+
+        reopened = ResponseCache()
+        reopened.open(self.cache_dir / 'responses.json')
+        self.assertEqual(reopened.get('key'), 'response')
+
+
+class TestPayloadBuilder(unittest.TestCase):
+    def test_estimate_tokens(self):
+        self.assertEqual(estimate_tokens(''), 0)
+        self.assertEqual(estimate_tokens('abcdefgh'), 2)
+
+    def test_build_single_chunk(self):
+        builder = PayloadBuilder()
+        diff_state = {'b.py': [['+ b']], 'a.py': [['- a'], ['+ a2']], 'empty.py': [[]]}
+        self.assertEqual(builder.build(diff_state), ["--- a.py\n- a\n+ a2\n--- b.py\n+ b"])
+
+    def test_build_splits_chunks_per_file(self):
+        builder = PayloadBuilder(chunk_tokens=10, total_tokens=1000)
+        diff_state = {'a.py': [['+ ' + 'a' * 20]], 'b.py': [['+ ' + 'b' * 20]]}
+        chunks = builder.build(diff_state)
+        self.assertEqual(len(chunks), 2)
+        self.assertTrue(chunks[0].startswith('--- a.py'))
+        self.assertTrue(chunks[1].startswith('--- b.py'))
+
+    def test_build_splits_large_file(self):
+        builder = PayloadBuilder(chunk_tokens=12, total_tokens=1000)
+        chunks = builder.build({'a.py': [['+ line %d' % i for i in range(6)]]})
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(chunks[1].startswith('--- a.py (continued)'))
+
+    def test_build_respects_total_budget(self):
+        builder = PayloadBuilder(chunk_tokens=10, total_tokens=12)
+        diff_state = {name: [['+ ' + name * 20]] for name in ('a', 'b', 'c')}
+        chunks = builder.build(diff_state)
+        self.assertTrue(chunks[-1].endswith('... 2 more changed files truncated'))
+
+    def test_references_stay_within_a_chunk(self):
+        builder = PayloadBuilder(chunk_tokens=500, total_tokens=10000, serializer=CompactDiffSerializer())
+        hunk = ['- import old_module_name', '+ import new_module_name']
+        diff_state = {
+            'a/one.py': [hunk],
+            'b/mid.py': [['+ value_%d = compute(%d)' % (i, i) for i in range(150)]],
+            'c/two.py': [hunk],
+        }
+        chunks = builder.build(diff_state)
+        self.assertGreater(len(chunks), 2)
+        self.assertNotIn('same change as', "\n".join(chunks))
+        self.assertTrue(chunks[-1].endswith('--- c/two.py\n-import old_module_name\n+import new_module_name'))
+
+        chunks = builder.build({'a.py': [hunk], 'b.py': [hunk]})
+        self.assertEqual(chunks, ['--- a.py\n-import old_module_name\n+import new_module_name\n--- b.py\n= same change as a.py'])
+
+    def test_report_compares_with_legacy_format(self):
+        builder = PayloadBuilder(serializer=CompactDiffSerializer())
+        hunk = ['@@ -10,3 +10,3 @@', '          value = 1', '-         return value', '+         return value + 1']
+        diff_state = {'a.py': [hunk], 'b.py': [hunk]}
+        report = builder.report(diff_state, builder.build(diff_state))
+        self.assertLess(report['tokens'], report['legacy_tokens'])
+
+
+class TestDiffSerializer(unittest.TestCase):
+    def test_plain_keeps_lines(self):
+        sections = create_serializer('plain').sections({'a.py': [['-   a'], ['+   b']]})
+        self.assertEqual(sections, [['--- a.py', '-   a', '+   b']])
+
+    def test_compact_dedents_and_shortens_hunk_headers(self):
+        serializer = CompactDiffSerializer()
+        lines = ['@@ -4,2 +4,2 @@', '          x = 1', '-         return x', '+         return x + 1']
+        self.assertEqual(
+            serializer.sections({'a.py': [lines]}),
+            [['--- a.py', '@@ 4', ' x = 1', '-return x', '+return x + 1']]
+        )
+
+    def test_compact_collapses_whitespace_only_changes(self):
+        serializer = CompactDiffSerializer()
+        lines = ['- x  =  1', '+ x = 1', '+ ', '- y', '+ z']
+        self.assertEqual(
+            serializer.sections({'a.py': [lines]}),
+            [['--- a.py', '-y', '+z', '~ 3 whitespace-only lines changed']]
+        )
+
+    def test_compact_references_repeated_hunks(self):
+        serializer = CompactDiffSerializer()
+        lines = ['- import old_module_name', '+ import new_module_name']
+        sections = serializer.sections({'a.py': [lines], 'b.py': [lines]})
+        self.assertEqual(sections[1], ['--- b.py', '= same change as a.py'])
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            create_serializer('xml')
+
+
 class TestFileRepr(unittest.TestCase):
     def setUp(self):
         self.file_path = '/path/to/file.txt'
@@ -306,6 +1881,178 @@ class TestFileRepr(unittest.TestCase):
         expected_dict = {"FileRepr Object @": self.file_path}
         self.assertEqual(self.file_repr.to_dict(), expected_dict)
 
+    def test_content_is_held_in_store(self):
+        store = SnapshotStore()
+        first = FileRepr('a.txt', 'same', store=store)
+        second = FileRepr('b.txt', 'same', store=store)
+        self.assertEqual(first.content_hash, second.content_hash)
+        self.assertEqual(store.memory_usage()['blobs'], 1)
+
+        second.file_content = 'changed'
+        self.assertEqual(second.file_content, 'changed')
+        self.assertEqual(store.memory_usage()['blobs'], 2)
+
+        del first
+        self.assertEqual(store.memory_usage()['blobs'], 1)
+
+    def test_stat_matches(self):
+        stat = MagicMock(st_size=10, st_mtime_ns=1_000_000_000, st_ino=42)
+        self.file_repr.set_stat(stat, read_ns=5_000_000_000)
+        self.assertTrue(self.file_repr.stat_matches(stat))
+        self.assertFalse(self.file_repr.stat_matches(MagicMock(st_size=11, st_mtime_ns=1_000_000_000, st_ino=42)))
+
+        # Racily clean: modified in the same second it was read
+        self.file_repr.set_stat(stat, read_ns=1_500_000_000)
+        self.assertFalse(self.file_repr.stat_matches(stat))
+
+    def test_file_content_normalizes_newlines(self):
+        file_repr = FileRepr('a.txt', store=SnapshotStore())
+        file_repr.set_data(b'one\r\ntwo\rthree')
+        self.assertEqual(file_repr.file_content, 'one\ntwo\nthree')
+
+
+class TestSnapshotStore(unittest.TestCase):
+    def setUp(self):
+        self.store = SnapshotStore()
+        self.pack_dir = Path('test_temp_pack')
+        self.pack_dir.mkdir(exist_ok=True)
+
+    def tearDown(self) -> None:
+        self.store.close()
+        shutil.rmtree(self.pack_dir)
+        return super().tearDown()
+
+    def test_put_lazy_loads_on_first_get(self):
+        loader = MagicMock(return_value=(zlib.compress(b'content'), 'zlib'))
+        digest = self.store.put_lazy(content_hash(b'content'), 7, loader)
+        self.assertEqual(self.store.sizes[digest], 7)
+        loader.assert_not_called()
+        self.assertEqual(self.store.get(digest), b'content')
+        self.assertEqual(self.store.get(digest), b'content')
+        loader.assert_called_once()
+        self.assertEqual(self.store.lazy_digests(), set())
+
+        # Content put meanwhile makes the loader unnecessary
+        other = self.store.put_lazy(content_hash(b'other'), 5, loader)
+        self.store.put(b'other')
+        self.assertEqual(self.store.get(other), b'other')
+        self.assertEqual(self.store.lazy_digests(), set())
+
+    def test_put_and_get(self):
+        digest = self.store.put(b'content')
+        self.assertEqual(digest, content_hash(b'content'))
+        self.assertEqual(self.store.get(digest), b'content')
+
+    def test_put_deduplicates(self):
+        data = b'x' * 1000
+        self.store.put(data)
+        self.store.put(data)
+        usage = self.store.memory_usage()
+        self.assertEqual(usage['blobs'], 1)
+        self.assertEqual(usage['raw_bytes'], 1000)
+        self.assertEqual(usage['dedup_hits'], 1)
+        self.assertLess(usage['resident_bytes'], 1000)
+
+    def test_release_drops_unreferenced_blobs(self):
+        digest = self.store.put(b'content')
+        self.store.put(b'content')
+        self.store.release(digest)
+        self.assertEqual(self.store.get(digest), b'content')
+        self.store.release(digest)
+        self.assertEqual(self.store.memory_usage()['blobs'], 0)
+        self.assertEqual(self.store.memory_usage()['resident_bytes'], 0)
+
+    def test_spill_to_pack_file(self):
+        store = SnapshotStore(pack_path=str(self.pack_dir / 'pack'), max_resident_bytes=10)
+        first = store.put(b'first blob')
+        second = store.put(b'second blob')
+        usage = store.memory_usage()
+        self.assertEqual(usage['resident_bytes'], 0)
+        self.assertGreater(usage['pack_bytes'], 0)
+        self.assertEqual(store.get(first), b'first blob')
+        self.assertEqual(store.get(second), b'second blob')
+        store.close()
+
+    @patch('utils.snapshot_store.zstandard', None)
+    def test_zstd_falls_back_to_zlib(self):
+        with self.assertLogs(level='ERROR'):
+            store = SnapshotStore(compression='zstd')
+        self.assertEqual(store.compression, 'zlib')
+
+
+class TestBaselineIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = BaselineIndex(':memory:')
+
+    def tearDown(self) -> None:
+        self.index.close()
+        return super().tearDown()
+
+    def test_save_and_load(self):
+        entry = IndexEntry(5, 100, 7, 200, content_hash(b'hello'))
+        self.index.save([('dir/a.txt', entry, b'hello')], [])
+        self.assertEqual(self.index.load(), {'dir/a.txt': entry})
+        self.assertEqual(self.index.blob(entry.content_hash), b'hello')
+
+    def test_save_removes_paths_and_orphan_blobs(self):
+        entry = IndexEntry(5, 100, 7, 200, content_hash(b'hello'))
+        self.index.save([('a.txt', entry, b'hello'), ('b.txt', entry, b'hello')], [])
+        self.index.save([], ['a.txt'])
+        self.assertEqual(list(self.index.load()), ['b.txt'])
+        self.assertEqual(self.index.blob(entry.content_hash), b'hello')
+        self.index.save([], ['b.txt'])
+        self.assertIsNone(self.index.blob(entry.content_hash))
+
+
+class TestDiffEngine(unittest.TestCase):
+    def setUp(self):
+        self.engines = [MyersDiffEngine(), PatienceDiffEngine()]
+
+    def test_compare_matches_ndiff_format(self):
+        old_file = "a\nb\nc\nd"
+        new_file = "a\nx\nc\nd\ne"
+        for engine in self.engines:
+            self.assertEqual(engine.compare(old_file, new_file), ['- b', '+ x', '+ e'])
+
+    def test_compare_identical_files(self):
+        for engine in self.engines:
+            self.assertEqual(engine.compare("a\nb", "a\nb"), [])
+            self.assertEqual(engine.unified("a\nb", "a\nb"), [])
+
+    def test_opcodes_rebuild_new_file(self):
+        old_lines = list("abcabba")
+        new_lines = list("cbabac")
+        for engine in self.engines:
+            rebuilt = []
+            for tag, i1, i2, j1, j2 in engine.opcodes(old_lines, new_lines):
+                if tag == 'equal':
+                    self.assertEqual(old_lines[i1:i2], new_lines[j1:j2])
+                rebuilt += new_lines[j1:j2]
+            self.assertEqual(rebuilt, new_lines)
+
+    def test_unified_splits_distant_hunks(self):
+        lines = [str(i) for i in range(20)]
+        old_file = "\n".join(lines)
+        lines[2], lines[17] = "two", "seventeen"
+        new_file = "\n".join(lines)
+        hunks = PatienceDiffEngine().unified(old_file, new_file, context=1)
+        self.assertEqual(hunks[0], '@@ -2,3 +2,3 @@')
+        self.assertEqual(hunks[5], '@@ -17,3 +17,3 @@')
+
+    def test_large_file_reported_as_rewritten(self):
+        engine = PatienceDiffEngine(max_lines=10)
+        new_file = "\n".join(str(i) for i in range(12))
+        self.assertEqual(engine.compare("old", new_file), ['~ file rewritten (12 lines)'])
+
+    def test_too_many_edits_replaces_region(self):
+        engine = MyersDiffEngine(max_edits=1)
+        self.assertEqual(engine.opcodes(list("ab"), list("ba")), [('replace', 0, 2, 0, 2)])
+
+    def test_create_diff_engine(self):
+        self.assertIsInstance(create_diff_engine('myers', max_lines=5), MyersDiffEngine)
+        with self.assertRaises(ValueError):
+            create_diff_engine('unknown')
+
 
 class TestFileReprEncoder(unittest.TestCase):
     def setUp(self):
@@ -0,0 +1,111 @@
+import zlib
+import sqlite3
+import threading
+
+from typing import Dict, Iterable, NamedTuple, Optional, Set, Tuple
+
+
+SCHEMA_VERSION = 2
+
+class IndexEntry(NamedTuple):
+    st_size: int
+    st_mtime_ns: int
+    st_ino: int
+    read_ns: int
+    content_hash: str
+    kind: str = 'text'
+    encoding: str = 'utf-8'
+
+
+class BaselineIndex:
+    # SQLite backed copy of the baseline tree: stat signature and content hash per
+    # relative path, and one compressed blob per content hash. It lets a restart
+    # re-read only the files whose stat changed while VCWatcher was not running.
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        # The index is only a cache, an outdated one is simply rebuilt
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            self.connection.executescript(f"""
+                DROP TABLE IF EXISTS files;
+                DROP TABLE IF EXISTS blobs;
+                PRAGMA user_version = {SCHEMA_VERSION};
+            """)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                st_size INTEGER,
+                st_mtime_ns INTEGER,
+                st_ino INTEGER,
+                read_ns INTEGER,
+                content_hash TEXT,
+                kind TEXT,
+                encoding TEXT
+            );
+            CREATE TABLE IF NOT EXISTS blobs (
+                content_hash TEXT PRIMARY KEY,
+                data BLOB
+            );
+        """)
+
+    def load(self) -> Dict[str, IndexEntry]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT path, st_size, st_mtime_ns, st_ino, read_ns, content_hash, kind, encoding FROM files"
+            )
+            return {row[0]: IndexEntry(*row[1:]) for row in rows}
+
+    def blob_hashes(self) -> Set[str]:
+        with self.lock:
+            return {row[0] for row in self.connection.execute("SELECT content_hash FROM blobs")}
+
+    def compressed_blob(self, content_hash: str) -> Optional[bytes]:
+        # zlib compressed, as stored
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT data FROM blobs WHERE content_hash = ?", (content_hash,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def blob(self, content_hash: str) -> Optional[bytes]:
+        blob = self.compressed_blob(content_hash)
+        return None if blob is None else zlib.decompress(blob)
+
+    def save(
+            self,
+            entries: Iterable[Tuple[str, IndexEntry, Optional[bytes]]],
+            removed: Iterable[str],
+            keep: Iterable[str] = ()
+        ) -> None:
+
+        # Blobs no longer used by any file are deleted, except those in `keep`,
+        # which baselines restored from the index have not loaded yet
+        with self.lock, self.connection:
+            for path, entry, data in entries:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (path, *entry)
+                )
+                if data is None:
+                    continue # Binary and oversized files have no blob
+                exists = self.connection.execute(
+                    "SELECT 1 FROM blobs WHERE content_hash = ?", (entry.content_hash,)
+                ).fetchone()
+                if not exists:
+                    self.connection.execute(
+                        "INSERT INTO blobs VALUES (?, ?)", (entry.content_hash, zlib.compress(data))
+                    )
+
+            self.connection.executemany("DELETE FROM files WHERE path = ?", ((path,) for path in removed))
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS kept (content_hash TEXT PRIMARY KEY)")
+            self.connection.execute("DELETE FROM kept")
+            self.connection.executemany("INSERT OR IGNORE INTO kept VALUES (?)", ((digest,) for digest in keep))
+            self.connection.execute(
+                "DELETE FROM blobs WHERE content_hash NOT IN (SELECT content_hash FROM files) "
+                "AND content_hash NOT IN (SELECT content_hash FROM kept)"
+            )
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
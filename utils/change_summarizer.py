@@ -0,0 +1,140 @@
+import os
+import ast
+
+from typing import Dict, List, Optional, Tuple
+
+# (kind, signature, structure without the name, own code) of one definition
+Definition = Tuple[str, str, str, str]
+
+
+class ChangeSummarizer:
+    # Turns the old and new content of a source file into structural change records,
+    # e.g. "~ added function parse(text)". Returns None when the file cannot be
+    # understood, so the line diff is used instead.
+    name = 'base'
+    extensions: Tuple[str, ...] = ()
+
+    def summarize(self, old_text: str, new_text: str) -> Optional[List[str]]:
+        raise NotImplementedError
+
+
+class PythonSummarizer(ChangeSummarizer):
+    name = 'python'
+    extensions = ('.py', '.pyi')
+
+    @staticmethod
+    def signature(node: ast.AST) -> str:
+        if isinstance(node, ast.ClassDef):
+            bases = [ast.unparse(base) for base in node.bases + node.keywords]
+            return f"({', '.join(bases)})" if bases else ""
+        returns = f" -> {ast.unparse(node.returns)}" if node.returns is not None else ""
+        return f"({ast.unparse(node.args)}){returns}"
+
+    @staticmethod
+    def class_code(node: ast.ClassDef) -> str:
+        # What its methods and nested classes do not cover: decorators, attributes, docstring
+        nested = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+        own = node.decorator_list + [statement for statement in node.body if not isinstance(statement, nested)]
+        return "\n".join(ast.dump(child) for child in own)
+
+    def definitions(self, body: List[ast.stmt], prefix: str = '') -> Dict[str, Definition]:
+        # Functions and classes by qualified name, methods included
+        found = {}
+        for node in body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                kind = 'method' if prefix else 'function'
+            elif isinstance(node, ast.ClassDef):
+                kind = 'class'
+                found.update(self.definitions(node.body, f"{prefix}{node.name}."))
+            else:
+                continue
+            name, node.name = node.name, '' # Compared without the name, to spot renames
+            structure = ast.dump(node)
+            node.name = name
+            code = self.class_code(node) if kind == 'class' else structure
+            found[prefix + name] = (kind, self.signature(node), structure, code)
+        return found
+
+    @staticmethod
+    def imports(body: List[ast.stmt]) -> List[str]:
+        return [ast.unparse(node) for node in body if isinstance(node, (ast.Import, ast.ImportFrom))]
+
+    @staticmethod
+    def assignments(body: List[ast.stmt]) -> Dict[str, str]:
+        # Module level names bound by plain assignments, e.g. constants
+        found = {}
+        for node in body:
+            if isinstance(node, (ast.Assign, ast.AnnAssign)):
+                targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                for target in targets:
+                    if isinstance(target, ast.Name):
+                        found[target.id] = ast.dump(node.value) if node.value is not None else ''
+        return found
+
+    @staticmethod
+    def module_code(body: List[ast.stmt]) -> List[str]:
+        skipped = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Import, ast.ImportFrom,
+                   ast.Assign, ast.AnnAssign)
+        return [ast.dump(node) for node in body if not isinstance(node, skipped)]
+
+    def summarize(self, old_text: str, new_text: str) -> Optional[List[str]]:
+        try:
+            old, new = ast.parse(old_text), ast.parse(new_text)
+        except (SyntaxError, ValueError):
+            return None
+
+        records = []
+        old_imports, new_imports = self.imports(old.body), self.imports(new.body)
+        records += [f"~ removed {line}" for line in old_imports if line not in new_imports]
+        records += [f"~ added {line}" for line in new_imports if line not in old_imports]
+
+        old_defs, new_defs = self.definitions(old.body), self.definitions(new.body)
+        removed = [name for name in old_defs if name not in new_defs]
+        added = [name for name in new_defs if name not in old_defs]
+        for name in list(removed):
+            kind, _, structure, _ = old_defs[name]
+            renamed = next((other for other in added if new_defs[other][:3:2] == (kind, structure)), None)
+            if renamed is not None:
+                records.append(f"~ renamed {kind} {name} to {renamed}")
+                removed.remove(name)
+                added.remove(renamed)
+
+        records += [f"~ removed {old_defs[name][0]} {name}" for name in removed]
+        records += [f"~ added {new_defs[name][0]} {name}{new_defs[name][1]}" for name in added]
+        for name, (kind, signature, _, code) in new_defs.items():
+            if name not in old_defs:
+                continue
+            _, old_signature, _, old_code = old_defs[name]
+            if signature != old_signature:
+                records.append(f"~ changed {kind} {name} signature: {old_signature or '()'} -> {signature or '()'}")
+            elif code != old_code:
+                # Methods of a class have records of their own
+                records.append(f"~ changed {kind} {name} body")
+
+        old_names, new_names = self.assignments(old.body), self.assignments(new.body)
+        records += [f"~ removed {name}" for name in old_names if name not in new_names]
+        records += [f"~ added {name}" for name in new_names if name not in old_names]
+        records += [
+            f"~ changed {name}" for name, value in new_names.items()
+            if name in old_names and old_names[name] != value
+        ]
+        if self.module_code(old.body) != self.module_code(new.body):
+            records.append("~ changed module level code")
+        return records
+
+
+SUMMARIZERS: Dict[str, ChangeSummarizer] = {}
+
+def register_summarizer(summarizer: ChangeSummarizer) -> None:
+    # Other languages plug in by file extension
+    for extension in summarizer.extensions:
+        SUMMARIZERS[extension] = summarizer
+
+register_summarizer(PythonSummarizer())
+
+
+def summarize_change(file_path: str, old_text: str, new_text: str) -> Optional[List[str]]:
+    summarizer = SUMMARIZERS.get(os.path.splitext(file_path)[1].lower())
+    if summarizer is None:
+        return None
+    return summarizer.summarize(old_text, new_text)
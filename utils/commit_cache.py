@@ -0,0 +1,323 @@
+import time
+import threading
+
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from utils.file_repr import FileRepr
+from utils.diff_engine import DiffEngine, PatienceDiffEngine
+from utils.diff_pool import DiffPool, hunks
+from utils.change_summarizer import summarize_change
+
+# None sends line diffs only, 'alongside' prefixes them with structural change
+# records, 'instead' sends the records alone for the files that have some
+SUMMARY_MODES = (None, 'alongside', 'instead')
+
+
+def diffable(baseline: FileRepr, current: Optional[FileRepr]) -> bool:
+    return baseline.is_text and (current is None or current.is_text)
+
+
+def describe_change(baseline: FileRepr, current: Optional[FileRepr]) -> str:
+    # Compact entry for files without tracked content
+    if baseline.kind == 'unreadable' or (current is not None and current.kind == 'unreadable'):
+        return "~ file could not be read"
+    old_size = baseline.st_size or 0
+    new_size = (current.st_size or 0) if current is not None else 0
+    return f"~ binary changed ({old_size}→{new_size} bytes)"
+
+
+class PendingChange:
+    # Net change of one file since the last commit message: the baseline and the
+    # latest version of the file, plus diff lines folded in when the cache was full.
+    __slots__ = ('baseline', 'current', 'folded', 'source', 'created', 'changed_at', 'speculative', 'pinned')
+
+    def __init__(self, baseline: FileRepr, current: Optional[FileRepr], created: bool = False) -> None:
+        self.baseline = baseline
+        self.current = current
+        self.folded: List[str] = []
+        self.source: Optional[str] = None # Path the file was renamed from
+        self.created = created # The baseline is an empty placeholder
+        self.changed_at = time.monotonic()
+        # (state, summary) made in the background, the summary is None when the state was skipped
+        self.speculative: Optional[Tuple[Tuple, Optional[str]]] = None
+        self.pinned = 0 # pinned_bytes() as last counted in the cache total
+
+    def state(self) -> Tuple:
+        # Identifies the net change, a summary of another state is stale
+        current_hash = self.current.content_hash if self.current is not None else None
+        return self.baseline.content_hash, current_hash, len(self.folded), self.source
+
+    def touch(self) -> None:
+        self.changed_at = time.monotonic()
+        self.speculative = None
+
+    def unchanged(self) -> bool:
+        current_hash = self.current.content_hash if self.current is not None else None
+        return not self.folded and self.source is None and current_hash == self.baseline.content_hash
+
+    def pinned_bytes(self) -> int:
+        # Baselines identical to the current content cost nothing, the tree holds them anyway
+        size = sum(len(line) for line in self.folded)
+        if self.current is None or self.current.content_hash != self.baseline.content_hash:
+            size += self.baseline.store.sizes.get(self.baseline.content_hash, 0)
+        return size
+
+
+class CommitCache:
+    # Keeps one entry per file, whatever the number of saves. Diffs are computed
+    # between the baseline and the latest content only when a message is generated,
+    # so edits reverted in the meantime never reach the LLM.
+    def __init__(
+            self,
+            diff_engine: Optional[DiffEngine] = None,
+            max_bytes: int = 64 * 1024 * 1024,
+            context: Optional[int] = None,
+            diff_pool: Optional[DiffPool] = None,
+            summary_mode: Optional[str] = None
+        ) -> None:
+
+        if summary_mode not in SUMMARY_MODES:
+            raise ValueError(f"Unknown summary mode: {summary_mode}")
+
+        self.diff_engine = diff_engine if diff_engine is not None else PatienceDiffEngine()
+        self.max_bytes = max_bytes
+        self.context = context # Lines around each change, None for changed lines only
+        self.diff_pool = diff_pool # Diffs large files in worker processes on commit-generate
+        self.summary_mode = summary_mode
+        self.entries: OrderedDict[str, PendingChange] = OrderedDict()
+        self.bytes = 0 # Sum of pinned bytes, kept up to date so each event does not walk every entry
+        self.lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, file_path: str) -> bool:
+        return file_path in self.entries
+
+    def __getitem__(self, file_path: str) -> PendingChange:
+        return self.entries[file_path]
+
+    def account(self, entry: PendingChange) -> None:
+        # Called after an entry in the cache changed
+        pinned = entry.pinned_bytes()
+        self.bytes += pinned - entry.pinned
+        entry.pinned = pinned
+
+    def discard(self, file_path: str) -> None:
+        entry = self.entries.pop(file_path)
+        self.bytes -= entry.pinned
+        entry.pinned = 0
+
+    def store(self, file_path: str, old: Optional[FileRepr], new: Optional[FileRepr]) -> None:
+        # `old` is None for a created file, `new` for a deleted one
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry is None and old is None:
+                placeholder = FileRepr(file_path, "", store=new.store)
+                entry = self.entries[file_path] = PendingChange(placeholder, new, created=True)
+            elif entry is None:
+                entry = self.entries[file_path] = PendingChange(old, new)
+            else:
+                entry.current = new
+                entry.touch()
+                self.entries.move_to_end(file_path)
+                if new is None and entry.source is not None:
+                    # Renamed, then deleted: a deletion of the original path
+                    del self.entries[file_path]
+                    file_path, entry.source = entry.source, None
+                    existing = self.entries.get(file_path)
+                    if existing is None:
+                        self.entries[file_path] = entry
+                    else:
+                        # The original path was written again meanwhile, e.g. by an editor
+                        # saving through a backup rename: a change from the moved baseline
+                        self.bytes -= entry.pinned
+                        existing.baseline, existing.folded = entry.baseline, entry.folded
+                        existing.created = False
+                        existing.touch()
+                        entry = existing
+
+            self.account(entry)
+            if entry.unchanged() or (entry.created and new is None):
+                self.discard(file_path) # Reverted to the baseline, or created and deleted again
+            self.enforce_limit()
+
+    def move(self, src: str, dest: str, current: FileRepr, replaced: Optional[FileRepr] = None) -> None:
+        # A file renamed from `src` to `dest`. Moved over an existing file, as editors
+        # saving through a temporary file do, it is a change of that file instead.
+        with self.lock:
+            entry = self.entries.pop(src, None)
+            if entry is not None:
+                self.bytes -= entry.pinned # Counted again if it is stored under `dest`
+                entry.pinned = 0
+            target = self.entries.get(dest)
+            if target is None and replaced is not None:
+                target = self.entries[dest] = PendingChange(replaced, replaced)
+
+            if target is not None:
+                target.current = current
+                target.touch()
+                self.entries.move_to_end(dest)
+                self.account(target)
+                if entry is None:
+                    entry = PendingChange(current, current)
+                if not entry.created:
+                    # The moved file existed before, so it is gone from its old path
+                    self.account(self.entries.setdefault(entry.source or src, PendingChange(entry.baseline, None)))
+                if target.unchanged():
+                    self.discard(dest)
+            else:
+                if entry is None:
+                    entry = PendingChange(current, current)
+                entry.current = current
+                entry.touch()
+                if not entry.created and entry.source is None:
+                    entry.source = src
+                if entry.source == dest:
+                    entry.source = None # Renamed back
+                self.entries[dest] = entry
+                self.account(entry)
+                if entry.unchanged():
+                    self.discard(dest)
+            self.enforce_limit()
+
+    def diff(self, baseline: FileRepr, current: Optional[FileRepr], folded: List[str]) -> List[str]:
+        if not diffable(baseline, current):
+            return folded + [describe_change(baseline, current)]
+
+        current_content = current.file_content if current is not None else ""
+        return folded + hunks(self.diff_engine, baseline.file_content, current_content, self.context)
+
+    def summarize(self, file_path: str, baseline: FileRepr, current: Optional[FileRepr]) -> List[str]:
+        # Empty when the language is not supported, the file does not parse, or only
+        # comments and formatting changed, which the line diff shows
+        current_content = current.file_content if current is not None else ""
+        return summarize_change(file_path, baseline.file_content, current_content) or []
+
+    def diff_all(self, pairs: List[Tuple[FileRepr, Optional[FileRepr]]]) -> List[List[str]]:
+        # Hunks of every text pair, in order, spread over the diff pool when there is one
+        if self.diff_pool is None:
+            return [self.diff(baseline, current, []) for baseline, current in pairs]
+        return self.diff_pool.map(self.diff_engine, pairs, self.context)
+
+    def enforce_limit(self) -> None:
+        # Fold the least recently changed entries: their net diff is computed now
+        # and their baseline advanced, so the old baseline can be released.
+        with self.lock:
+            if self.bytes <= self.max_bytes:
+                return
+            for entry in list(self.entries.values()):
+                if self.bytes <= self.max_bytes:
+                    break
+                if entry.current is None or entry.current is entry.baseline:
+                    continue
+                folded = self.diff(entry.baseline, entry.current, entry.folded)
+                if sum(len(line) for line in folded) >= entry.pinned:
+                    continue # Folding would not save anything
+                entry.folded = folded
+                entry.baseline = entry.current
+                self.account(entry)
+
+    def net_diffs(
+            self,
+            paths: Optional[Iterable[str]] = None
+        ) -> Tuple[Dict[str, List[str]], Dict[str, Optional[FileRepr]]]:
+
+        # Returns the diffs per file, of every file or only of `paths`, and a snapshot
+        # to `advance` to once they were used
+        with self.lock:
+            paths = self.entries if paths is None else set(paths)
+            entries = [
+                (file_path, entry.baseline, entry.current, list(entry.folded), entry.source)
+                for file_path, entry in self.entries.items() if file_path in paths
+            ]
+
+        summaries = {}
+        if self.summary_mode is not None:
+            for file_path, baseline, current, _, _ in entries:
+                if diffable(baseline, current):
+                    summaries[file_path] = self.summarize(file_path, baseline, current)
+        summarized_only = self.summary_mode == 'instead'
+
+        text_hunks = iter(self.diff_all([
+            (baseline, current) for file_path, baseline, current, _, _ in entries
+            if diffable(baseline, current) and not (summarized_only and summaries.get(file_path))
+        ]))
+
+        diffs, snapshot = {}, {}
+        for file_path, baseline, current, folded, source in entries:
+            records = summaries.get(file_path, [])
+            if summarized_only and records:
+                changes = folded + records
+            elif diffable(baseline, current):
+                changes = folded + records + next(text_hunks)
+            else:
+                changes = folded + [describe_change(baseline, current)]
+            if source is not None:
+                changes = [f"~ renamed from {source}"] + changes
+            snapshot[file_path] = current
+            if changes:
+                diffs[file_path] = changes
+
+        with self.lock:
+            for file_path in snapshot:
+                if file_path not in diffs and self.entries.get(file_path) is not None:
+                    if self.entries[file_path].current is snapshot[file_path]:
+                        self.discard(file_path)
+        return diffs, snapshot
+
+    def idle_files(self, idle_time: float) -> List[Tuple[str, Tuple]]:
+        # (file path, state) of the files unchanged for `idle_time` seconds, whose
+        # current state was neither summarized nor skipped yet. Nothing is diffed here.
+        now = time.monotonic()
+        with self.lock:
+            return [
+                (file_path, entry.state()) for file_path, entry in self.entries.items()
+                if now - entry.changed_at >= idle_time
+                and (entry.speculative is None or entry.speculative[0] != entry.state())
+            ]
+
+    def set_speculative(self, file_path: str, state: Tuple, summary: Optional[str]) -> None:
+        # Dropped if the file changed while it was summarized. A None summary marks
+        # the state as skipped, so it is not diffed again.
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry is not None and entry.state() == state:
+                entry.speculative = (state, summary)
+
+    def speculative_summaries(self) -> Dict[str, str]:
+        with self.lock:
+            return {
+                file_path: entry.speculative[1] for file_path, entry in self.entries.items()
+                if entry.speculative is not None and entry.speculative[1] is not None
+                and entry.speculative[0] == entry.state()
+            }
+
+    def advance(self, snapshot: Dict[str, Optional[FileRepr]]) -> None:
+        # Changes made after the snapshot was taken stay pending against the new baseline
+        with self.lock:
+            for file_path, current in snapshot.items():
+                entry = self.entries.get(file_path)
+                if entry is None:
+                    continue
+                if entry.current is current:
+                    self.discard(file_path)
+                    continue
+                if current is None: # Deleted at snapshot time, then created again
+                    current = FileRepr(file_path, "", store=entry.baseline.store)
+                entry.baseline = current
+                entry.folded = []
+                entry.source = None
+                entry.created = False
+                self.account(entry)
+                if entry.unchanged():
+                    self.discard(file_path)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def memory_usage(self) -> int:
+        return self.bytes
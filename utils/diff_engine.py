@@ -0,0 +1,267 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+Opcode = Tuple[str, int, int, int, int] # (tag, i1, i2, j1, j2), same layout as difflib opcodes
+Match = Tuple[int, int]
+
+
+class DiffEngine:
+    # Line based diff engines. Subclasses only implement `matches`, which returns
+    # the (old_index, new_index) pairs of lines kept between both versions.
+    name = 'base'
+
+    def __init__(self, max_lines: int = 50000, max_edits: int = 1000) -> None:
+        self.max_lines = max_lines # Past this, a file is reported as rewritten instead of diffed
+        self.max_edits = max_edits # Past this, a region is treated as replaced as a whole
+
+    def matches(self, a: Sequence[int], b: Sequence[int]) -> List[Match]:
+        raise NotImplementedError
+
+    def opcodes(self, old_lines: List[str], new_lines: List[str]) -> List[Opcode]:
+        # Lines are interned to ints so comparisons are cheap
+        ids: Dict[str, int] = {}
+        a = [ids.setdefault(line, len(ids)) for line in old_lines]
+        b = [ids.setdefault(line, len(ids)) for line in new_lines]
+
+        # Common prefix and suffix never need the real algorithm
+        prefix = 0
+        while prefix < len(a) and prefix < len(b) and a[prefix] == b[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < len(a) - prefix and suffix < len(b) - prefix and a[-1 - suffix] == b[-1 - suffix]:
+            suffix += 1
+
+        middle = self.matches(a[prefix:len(a) - suffix], b[prefix:len(b) - suffix])
+        matches = [(i, i) for i in range(prefix)]
+        matches += [(i + prefix, j + prefix) for i, j in middle]
+        matches += [(len(a) - suffix + i, len(b) - suffix + i) for i in range(suffix)]
+        return to_opcodes(matches, len(a), len(b))
+
+    def rewritten(self, old_lines: List[str], new_lines: List[str]) -> Optional[List[str]]:
+        if max(len(old_lines), len(new_lines)) > self.max_lines:
+            return [f"~ file rewritten ({len(new_lines)} lines)"]
+        return None
+
+    def compare(self, old_file: str, new_file: str) -> List[str]:
+        # Only added and removed lines, in the same `+ `/`- ` format as difflib.ndiff
+        old_lines, new_lines = old_file.splitlines(), new_file.splitlines()
+        rewritten = self.rewritten(old_lines, new_lines)
+        if rewritten is not None:
+            return rewritten
+
+        differences = []
+        for tag, i1, i2, j1, j2 in self.opcodes(old_lines, new_lines):
+            if tag == 'equal':
+                continue
+            differences += ['- ' + line for line in old_lines[i1:i2]]
+            differences += ['+ ' + line for line in new_lines[j1:j2]]
+        return differences
+
+    def unified(self, old_file: str, new_file: str, context: int = 3) -> List[str]:
+        old_lines, new_lines = old_file.splitlines(), new_file.splitlines()
+        rewritten = self.rewritten(old_lines, new_lines)
+        if rewritten is not None:
+            return rewritten
+
+        hunks = []
+        for group in group_opcodes(self.opcodes(old_lines, new_lines), context):
+            i1, i2 = group[0][1], group[-1][2]
+            j1, j2 = group[0][3], group[-1][4]
+            hunks.append(f"@@ -{i1 + 1},{i2 - i1} +{j1 + 1},{j2 - j1} @@")
+            for tag, a1, a2, b1, b2 in group:
+                if tag == 'equal':
+                    hunks += ['  ' + line for line in old_lines[a1:a2]]
+                    continue
+                hunks += ['- ' + line for line in old_lines[a1:a2]]
+                hunks += ['+ ' + line for line in new_lines[b1:b2]]
+        return hunks
+
+
+class MyersDiffEngine(DiffEngine):
+    # Myers' O((N+M)D) greedy algorithm, D being the number of edits
+    name = 'myers'
+
+    def matches(self, a: Sequence[int], b: Sequence[int]) -> List[Match]:
+        n, m = len(a), len(b)
+        if not n or not m:
+            return []
+
+        v = {1: 0}
+        trace = []
+        for d in range(min(n + m, self.max_edits) + 1):
+            trace.append(dict(v))
+            for k in range(-d, d + 1, 2):
+                if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                    x = v[k + 1]
+                else:
+                    x = v[k - 1] + 1
+                y = x - k
+                while x < n and y < m and a[x] == b[y]:
+                    x, y = x + 1, y + 1
+                v[k] = x
+                if x >= n and y >= m:
+                    return self.backtrack(trace, n, m)
+        return [] # Too many edits, the region is replaced as a whole
+
+    def backtrack(self, trace: List[Dict[int, int]], n: int, m: int) -> List[Match]:
+        matches = []
+        x, y = n, m
+        for d in range(len(trace) - 1, -1, -1):
+            v = trace[d]
+            k = x - y
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                prev_k = k + 1
+            else:
+                prev_k = k - 1
+            prev_x = v[prev_k]
+            prev_y = prev_x - prev_k
+
+            while x > prev_x and y > prev_y:
+                x, y = x - 1, y - 1
+                matches.append((x, y))
+            x, y = prev_x, prev_y
+        matches.reverse()
+        return matches
+
+
+class PatienceDiffEngine(MyersDiffEngine):
+    # Anchors on lines that are unique in both versions, which keeps large files
+    # linear in practice and yields readable hunks. Regions without unique lines
+    # fall back to Myers.
+    name = 'patience'
+
+    def matches(self, a: Sequence[int], b: Sequence[int]) -> List[Match]:
+        matches: List[Match] = []
+        stack = [(0, len(a), 0, len(b))]
+
+        while stack:
+            alo, ahi, blo, bhi = stack.pop()
+
+            while alo < ahi and blo < bhi and a[alo] == b[blo]:
+                matches.append((alo, blo))
+                alo, blo = alo + 1, blo + 1
+            while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+                ahi, bhi = ahi - 1, bhi - 1
+                matches.append((ahi, bhi))
+            if alo == ahi or blo == bhi:
+                continue
+
+            anchors = self.unique_anchors(a, alo, ahi, b, blo, bhi)
+            if not anchors:
+                middle = super().matches(a[alo:ahi], b[blo:bhi])
+                matches += [(i + alo, j + blo) for i, j in middle]
+                continue
+
+            for i, j in anchors:
+                matches.append((i, j))
+                stack.append((alo, i, blo, j))
+                alo, blo = i + 1, j + 1
+            stack.append((alo, ahi, blo, bhi))
+
+        matches.sort()
+        return matches
+
+    def unique_anchors(self, a, alo, ahi, b, blo, bhi) -> List[Match]:
+        counts: Dict[int, List[int]] = {}
+        for i in range(alo, ahi):
+            entry = counts.setdefault(a[i], [0, 0, i, 0])
+            entry[0] += 1
+        for j in range(blo, bhi):
+            entry = counts.get(b[j])
+            if entry is not None:
+                entry[1] += 1
+                entry[3] = j
+
+        pairs = sorted(
+            (entry[2], entry[3]) for entry in counts.values() if entry[0] == 1 and entry[1] == 1
+        )
+        return longest_increasing(pairs)
+
+
+def longest_increasing(pairs: List[Match]) -> List[Match]:
+    # Patience sorting: longest subsequence of pairs increasing in both indexes
+    tails: List[int] = []
+    tail_pairs: List[int] = []
+    previous: List[int] = []
+
+    for index, (_, j) in enumerate(pairs):
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tails[mid] < j:
+                lo = mid + 1
+            else:
+                hi = mid
+        previous.append(tail_pairs[lo - 1] if lo else -1)
+        if lo == len(tails):
+            tails.append(j)
+            tail_pairs.append(index)
+        else:
+            tails[lo] = j
+            tail_pairs[lo] = index
+
+    result = []
+    index = tail_pairs[-1] if tail_pairs else -1
+    while index != -1:
+        result.append(pairs[index])
+        index = previous[index]
+    result.reverse()
+    return result
+
+
+def to_opcodes(matches: List[Match], n: int, m: int) -> List[Opcode]:
+    opcodes: List[Opcode] = []
+    i = j = 0
+    for x, y in matches + [(n, m)]:
+        if i < x and j < y:
+            opcodes.append(('replace', i, x, j, y))
+        elif i < x:
+            opcodes.append(('delete', i, x, j, y))
+        elif j < y:
+            opcodes.append(('insert', i, x, j, y))
+
+        if x < n:
+            if opcodes and opcodes[-1][0] == 'equal':
+                tag, i1, _, j1, _ = opcodes[-1]
+                opcodes[-1] = (tag, i1, x + 1, j1, y + 1)
+            else:
+                opcodes.append(('equal', x, x + 1, y, y + 1))
+        i, j = x + 1, y + 1
+    return opcodes
+
+
+def group_opcodes(opcodes: List[Opcode], context: int = 3) -> List[List[Opcode]]:
+    # Splits opcodes into hunks with up to `context` lines of surrounding equal lines
+    if not opcodes or all(tag == 'equal' for tag, *_ in opcodes):
+        return []
+
+    opcodes = list(opcodes)
+    if opcodes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = opcodes[0]
+        opcodes[0] = (tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2)
+    if opcodes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = opcodes[-1]
+        opcodes[-1] = (tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context))
+
+    groups, group = [], []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal' and i2 - i1 > context * 2:
+            group.append((tag, i1, i1 + context, j1, j1 + context))
+            groups.append(group)
+            group = []
+            i1, j1 = i2 - context, j2 - context
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        groups.append(group)
+    return groups
+
+
+DIFF_ENGINES = {
+    MyersDiffEngine.name: MyersDiffEngine,
+    PatienceDiffEngine.name: PatienceDiffEngine,
+}
+
+def create_diff_engine(name: str = 'patience', **kwargs) -> DiffEngine:
+    try:
+        return DIFF_ENGINES[name](**kwargs)
+    except KeyError:
+        raise ValueError(f"Unknown diff engine: {name}")
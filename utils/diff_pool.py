@@ -0,0 +1,115 @@
+import logging
+import threading
+import multiprocessing
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from utils.diff_engine import DiffEngine
+from utils.file_repr import FileRepr, decode_text
+from utils.snapshot_store import decompress
+
+# (compressed blob, compression, encoding) of one side of a diff, None for a deleted file
+Side = Optional[Tuple[bytes, str, str]]
+
+
+def hunks(engine: DiffEngine, old_text: str, new_text: str, context: Optional[int] = None) -> List[str]:
+    if context is None:
+        return engine.compare(old_text, new_text)
+    return engine.unified(old_text, new_text, context)
+
+
+def load_side(side: Side) -> str:
+    if side is None:
+        return ""
+    blob, compression, encoding = side
+    return decode_text(decompress(blob, compression), encoding)
+
+
+def diff_blobs(engine: DiffEngine, old: Side, new: Side, context: Optional[int] = None) -> List[str]:
+    # Runs in a worker process. Blobs are sent compressed, as the snapshot store
+    # holds them, which is several times less to pickle than the decoded text.
+    return hunks(engine, load_side(old), load_side(new), context)
+
+
+class DiffPool:
+    # Diffs large files in worker processes, so one core is not pegged when a branch
+    # switch changes thousands of files. Pairs under `min_bytes` are diffed in the
+    # calling thread while the workers run, as sending them would cost more than
+    # the diff itself. Results always come back in the order of the pairs.
+    def __init__(self, workers: int = 4, min_bytes: int = 256 * 1024) -> None:
+        self.workers = workers
+        self.min_bytes = min_bytes
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.offloaded = 0
+        self.lock = threading.Lock() # Shared by the REPL, the daemon and the speculative summarizer
+
+    @staticmethod
+    def side(file_repr: Optional[FileRepr]) -> Side:
+        if file_repr is None or not file_repr.in_store:
+            return None
+        store = file_repr.store
+        return store.blob(file_repr.content_hash), store.compression, file_repr.encoding
+
+    @staticmethod
+    def size(file_repr: Optional[FileRepr]) -> int:
+        if file_repr is None or not file_repr.in_store:
+            return 0
+        return file_repr.store.sizes.get(file_repr.content_hash, 0)
+
+    def start(self) -> ProcessPoolExecutor:
+        # Spawned rather than forked: the watcher runs observer and event loop threads
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')
+                )
+            return self.executor
+
+    def map(
+            self,
+            engine: DiffEngine,
+            pairs: List[Tuple[FileRepr, Optional[FileRepr]]],
+            context: Optional[int] = None
+        ) -> List[List[str]]:
+
+        futures: Dict[int, Future] = {}
+        if self.workers > 0:
+            for i, (old, new) in enumerate(pairs):
+                if self.size(old) + self.size(new) >= self.min_bytes:
+                    try:
+                        futures[i] = self.start().submit(
+                            diff_blobs, engine, self.side(old), self.side(new), context
+                        )
+                    except Exception as e:
+                        logging.error(f"Error starting diff workers, diffing in process: {e}")
+                        with self.lock:
+                            self.workers = 0
+                        break
+
+        # Small pairs first, while the workers are busy with the large ones
+        results: List[Optional[List[str]]] = [None] * len(pairs)
+        for i, (old, new) in enumerate(pairs):
+            if i not in futures:
+                results[i] = self.diff_here(engine, old, new, context)
+
+        for i, future in futures.items():
+            try:
+                results[i] = future.result()
+                with self.lock:
+                    self.offloaded += 1
+            except Exception as e:
+                logging.error(f"Error in diff worker, diffing in process: {e}")
+                results[i] = self.diff_here(engine, *pairs[i], context)
+        return results
+
+    @staticmethod
+    def diff_here(engine: DiffEngine, old: FileRepr, new: Optional[FileRepr], context: Optional[int]) -> List[str]:
+        new_text = new.file_content if new is not None else ""
+        return hunks(engine, old.file_content, new_text, context)
+
+    def close(self) -> None:
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
@@ -0,0 +1,145 @@
+import re
+
+from typing import Dict, List, Mapping, Tuple
+
+HUNK_HEADER = re.compile(r'^@@ -\d+(?:,\d+)? \+(\d+)(?:,\d+)? @@$')
+
+
+class DiffSerializer:
+    # One section per changed file: a '--- <file path>' header followed by its
+    # diff lines as they come out of the commit cache.
+    name = 'plain'
+
+    @staticmethod
+    def flatten(changes: List) -> List[str]:
+        lines = []
+        for change in changes:
+            if isinstance(change, str):
+                lines.append(change)
+            else:
+                lines.extend(change)
+        return lines
+
+    def serialize(self, file_path: str, changes: List) -> List[str]:
+        return [f"--- {file_path}"] + self.flatten(changes)
+
+    def reset(self) -> None:
+        # Called for every payload and at each chunk boundary
+        pass
+
+    def sections(self, diff_state: Mapping[str, List]) -> List[List[str]]:
+        self.reset()
+        sections = []
+        for file_path in sorted(diff_state):
+            section = self.serialize(file_path, diff_state[file_path])
+            if len(section) > 1:
+                sections.append(section)
+        return sections
+
+
+class CompactDiffSerializer(DiffSerializer):
+    # Drops what the model does not need: whitespace-only edits are collapsed into
+    # a count, hunks already sent for another file of the same chunk are referenced
+    # instead of repeated, hunk headers keep only the new line number, prefixes
+    # lose their space and each hunk is dedented.
+    name = 'compact'
+
+    def __init__(self) -> None:
+        self.seen: Dict[Tuple[str, ...], str] = {}
+
+    def reset(self) -> None:
+        self.seen = {} # Each chunk goes to its own request, references do not cross it
+
+    def serialize(self, file_path: str, changes: List) -> List[str]:
+        section = [f"--- {file_path}"]
+        for header, lines in self.hunks(self.flatten(changes)):
+            body = self.compact(lines)
+            if not any(line[:1] in '+-~' for line in body):
+                continue # Nothing left but context
+
+            key = tuple(body)
+            reference = f"= same change as {self.seen.get(key)}"
+            if self.seen.get(key, file_path) != file_path and len(reference) < len("\n".join(body)):
+                section += ([header] if header else []) + [reference]
+                continue
+            self.seen.setdefault(key, file_path)
+            section += ([header] if header else []) + body
+        return section
+
+    @staticmethod
+    def hunks(lines: List[str]) -> List[Tuple[str, List[str]]]:
+        hunks, header, current = [], '', []
+        for line in lines:
+            match = HUNK_HEADER.match(line)
+            if match is None:
+                current.append(line)
+                continue
+            if current:
+                hunks.append((header, current))
+            header, current = f"@@ {match.group(1)}", []
+        if current:
+            hunks.append((header, current))
+        return hunks
+
+    @staticmethod
+    def collapse_whitespace(removed: List[str], added: List[str]) -> Tuple[List[str], List[str], int]:
+        # Blank lines, and line pairs equal but for whitespace, are only counted
+        kept_removed = [line for line in removed if line.strip()]
+        kept_added = [line for line in added if line.strip()]
+        collapsed = len(removed) - len(kept_removed) + len(added) - len(kept_added)
+        if len(kept_removed) != len(kept_added):
+            return kept_removed, kept_added, collapsed
+
+        pairs = [
+            (old, new) for old, new in zip(kept_removed, kept_added)
+            if old.split() != new.split()
+        ]
+        collapsed += 2 * (len(kept_removed) - len(pairs))
+        return [old for old, _ in pairs], [new for _, new in pairs], collapsed
+
+    def compact(self, lines: List[str]) -> List[str]:
+        body, notes, removed, added, collapsed = [], [], [], [], 0
+
+        def flush() -> None:
+            nonlocal removed, added, collapsed
+            kept_removed, kept_added, count = self.collapse_whitespace(removed, added)
+            body.extend(('-', line) for line in kept_removed)
+            body.extend(('+', line) for line in kept_added)
+            collapsed += count
+            removed, added = [], []
+
+        for line in lines:
+            prefix, text = line[:2], line[2:]
+            if prefix == '- ':
+                removed.append(text)
+            elif prefix == '+ ':
+                added.append(text)
+            else:
+                flush()
+                if line.startswith('  '):
+                    body.append((' ', text))
+                else:
+                    notes.append(line) # '~ ...' summaries and folded notes
+        flush()
+
+        # Dedent the hunk by the indentation its lines have in common
+        texts = [text.rstrip() for _, text in body]
+        indents = [len(text) - len(text.lstrip()) for text in texts if text.strip()]
+        indent = min(indents, default=0)
+        compacted = [prefix + text[indent:] for (prefix, _), text in zip(body, texts)]
+        if collapsed:
+            compacted.append(f"~ {collapsed} whitespace-only lines changed")
+        return compacted + notes
+
+
+SERIALIZERS = {
+    DiffSerializer.name: DiffSerializer,
+    CompactDiffSerializer.name: CompactDiffSerializer,
+}
+
+
+def create_serializer(name: str) -> DiffSerializer:
+    try:
+        return SERIALIZERS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown payload format: {name}. Available: {', '.join(SERIALIZERS)}")
@@ -0,0 +1,79 @@
+import codecs
+
+from typing import Optional
+
+try:
+    import charset_normalizer
+except ImportError:
+    charset_normalizer = None
+
+SNIFF_SIZE = 8192
+
+# Leading bytes of common binary formats which may not contain a NUL early on
+BINARY_MAGIC = (
+    b'\x89PNG',
+    b'\xff\xd8\xff', # JPEG
+    b'GIF87a',
+    b'GIF89a',
+    b'%PDF-',
+    b'PK\x03\x04', # zip, jar, docx, whl
+    b'\x1f\x8b', # gzip
+    b'BZh',
+    b'\xfd7zXZ\x00',
+    b'7z\xbc\xaf\x27\x1c',
+    b'\x7fELF',
+    b'\xca\xfe\xba\xbe', # Mach-O fat binary, Java class
+    b'\x00asm',
+    b'OggS',
+    b'fLaC',
+    b'SQLite format 3\x00',
+)
+
+# Longest BOMs first, since the UTF-32 LE BOM starts with the UTF-16 LE one
+BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+# Control bytes text does not contain, tab, newlines, backspace, form feed and escape aside
+CONTROL_BYTES = bytes(sorted(set(range(32)) - {8, 9, 10, 12, 13, 27})) + b'\x7f'
+
+
+def is_binary(head: bytes) -> bool:
+    # `head` is the first SNIFF_SIZE bytes of the file
+    if head.startswith(BINARY_MAGIC):
+        return True
+    if any(head.startswith(bom) for bom, _ in BOMS):
+        return False # UTF-16/32 text is full of NUL bytes
+    return b'\x00' in head
+
+
+def detect_encoding(data: bytes) -> Optional[str]:
+    # Returns None when the data does not decode as text
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return encoding
+
+    try:
+        data.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+
+    if charset_normalizer is not None:
+        match = charset_normalizer.from_bytes(data).best()
+        return match.encoding if match is not None else None
+
+    # Without charset_normalizer, text in a single byte encoding such as Latin-1
+    # is told from binary data by its lack of control bytes
+    controls = len(data) - len(data.translate(None, CONTROL_BYTES))
+    if controls > len(data) // 100:
+        return None
+    try:
+        data.decode('cp1252')
+        return 'cp1252'
+    except UnicodeDecodeError:
+        return 'latin-1' # Decodes any byte
@@ -1,19 +1,109 @@
 import json
+import time
+
+from utils.snapshot_store import SnapshotStore
+
+_default_store = None
+
+def default_store() -> SnapshotStore:
+    global _default_store
+    if _default_store is None:
+        _default_store = SnapshotStore()
+    return _default_store
+
+
+def decode_text(data, encoding = 'utf-8'):
+    # Line endings are normalized, so a CRLF conversion alone is not a change of every line
+    text = data.decode(encoding)
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
 
 class FileRepr:
-    def __init__(self, file_path = None, file_content = None):
+    # Only the content hash is held here, the content itself lives in the snapshot store.
+    # Binary and oversized files are tracked by hash and size only, without content.
+    def __init__(self, file_path = None, file_content = None, store = None):
         self.file_path = file_path
-        self.file_content = file_content
+        self.store = store if store is not None else default_store()
+        self.content_hash = None
+        self.in_store = False
+        self.kind = 'text' # 'text', 'binary', 'oversized' or 'unreadable'
+        self.encoding = 'utf-8'
+        if file_content is not None:
+            self.file_content = file_content
+
+        # Stat signature of the file when it was read
+        self.st_size = None
+        self.st_mtime_ns = None
+        self.st_ino = None
+        self.read_ns = None
+
+    @property
+    def file_content(self):
+        if not self.in_store:
+            return None
+        return decode_text(self.store.get(self.content_hash), self.encoding)
+
+    @file_content.setter
+    def file_content(self, file_content):
+        self.set_data(None if file_content is None else file_content.encode('utf-8'))
+
+    @property
+    def is_text(self):
+        return self.kind == 'text'
+
+    def set_data(self, data, digest = None, encoding = 'utf-8'):
+        previous = self.content_hash if self.in_store else None
+        self.content_hash = None if data is None else self.store.put(data, digest)
+        self.in_store = data is not None
+        self.kind = 'text'
+        self.encoding = encoding
+        if previous is not None:
+            self.store.release(previous)
+
+    def set_lazy(self, digest, size, loader, encoding = 'utf-8'):
+        # Text whose content is only read from `loader` when it is first needed
+        previous = self.content_hash if self.in_store else None
+        self.content_hash = self.store.put_lazy(digest, size, loader)
+        self.in_store = True
+        self.kind = 'text'
+        self.encoding = encoding
+        if previous is not None:
+            self.store.release(previous)
+
+    def set_digest(self, digest, kind):
+        # Tracks a file by hash only, its content is never kept
+        self.set_data(None)
+        self.content_hash = digest
+        self.kind = kind
+
+    def set_stat(self, stat, read_ns = None):
+        self.st_size = stat.st_size
+        self.st_mtime_ns = stat.st_mtime_ns
+        self.st_ino = stat.st_ino
+        self.read_ns = read_ns if read_ns is not None else time.time_ns()
+
+    def stat_matches(self, stat):
+        if self.st_mtime_ns is None:
+            return False
+        # A file modified within a second of being read may change again without
+        # its mtime moving on coarse filesystems, so only the content hash can tell.
+        if self.read_ns - self.st_mtime_ns < 1_000_000_000:
+            return False
+        return (stat.st_size, stat.st_mtime_ns, stat.st_ino) == (self.st_size, self.st_mtime_ns, self.st_ino)
+
+    def __del__(self):
+        if getattr(self, 'in_store', False):
+            self.store.release(self.content_hash)
 
     def __str__(self):
         return f"File Path: {self.file_path} \n File Content: {self.file_content}"
-    
+
     def __repr__(self):
         return f"FileRepr Object @ {self.file_path}"
-    
+
     def to_dict(self):
         return {"FileRepr Object @": self.file_path}
-    
+
 class FileReprEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, FileRepr):
@@ -0,0 +1,175 @@
+import re
+import logging
+
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Pattern
+
+
+class IgnoreRule(NamedTuple):
+    pattern: str # Regex matching paths relative to the observed root
+    negate: bool
+    dir_only: bool
+
+
+def translate_glob(glob: str) -> str:
+    # gitignore glob to regex: '*' and '?' stop at '/', '**' crosses directories
+    i, n, out = 0, len(glob), []
+    while i < n:
+        c = glob[i]
+        if c == '*':
+            if glob.startswith('**', i) and (i == 0 or glob[i - 1] == '/'):
+                if glob[i + 2:i + 3] == '/':
+                    out.append('(?:.*/)?') # Leading or inner '**/', any number of directories
+                    i += 3
+                    continue
+                if i + 2 == n:
+                    out.append('.*') # Trailing '/**', everything inside
+                    i += 2
+                    continue
+            while i + 1 < n and glob[i + 1] == '*':
+                i += 1
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            end = glob.find(']', i + 2)
+            if end == -1:
+                out.append(re.escape(c))
+            else:
+                body = glob[i + 1:end].replace('\\', '\\\\').replace('[', '\\[')
+                if body[0] in '!^':
+                    body = '^' + body[1:]
+                out.append(f'[{body}]')
+                i = end
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            out.append(re.escape(glob[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
+
+
+def parse_rule(line: str, directory: str = '') -> Optional[IgnoreRule]:
+    # `directory` is the root relative directory holding the ignore file
+    if not line.endswith('\\ '):
+        line = line.rstrip()
+    if not line or line.startswith('#'):
+        return None
+
+    negate = line.startswith('!')
+    if negate:
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    if not line:
+        return None
+
+    # Patterns with a slash are relative to their directory, others match at any depth
+    anchored = '/' in line
+    prefix = re.escape(directory + '/') if directory else ''
+    if not anchored:
+        prefix += '(?:.*/)?'
+    return IgnoreRule(prefix + translate_glob(line.lstrip('/')), negate, dir_only)
+
+
+def compile_any(rules: Iterable[IgnoreRule]) -> Optional[Pattern]:
+    patterns = [f'(?:{rule.pattern})' for rule in rules]
+    return re.compile('|'.join(patterns)) if patterns else None
+
+
+class IgnoreMatcher:
+    # All rules in effect for one directory. Without negations they are compiled
+    # into one alternation per kind, so a path is matched with a single regex call.
+    def __init__(self, rules: List[IgnoreRule]) -> None:
+        self.rules = rules
+        self.negated = any(rule.negate for rule in rules)
+        if self.negated:
+            self.compiled = [(rule, re.compile(rule.pattern)) for rule in reversed(rules)]
+        else:
+            self.files = compile_any(rule for rule in rules if not rule.dir_only)
+            self.dirs = compile_any(rules)
+
+    def matches(self, path: str, is_dir: bool) -> bool:
+        if not self.negated:
+            combined = self.dirs if is_dir else self.files
+            return combined is not None and combined.fullmatch(path) is not None
+
+        # The last matching rule wins
+        for rule, regex in self.compiled:
+            if rule.dir_only and not is_dir:
+                continue
+            if regex.fullmatch(path):
+                return not rule.negate
+        return False
+
+
+class IgnoreRules:
+    # Reads ignore files hierarchically: the matcher of a directory holds the
+    # rules of its parents followed by its own, and is built once per directory.
+    # Paths are relative to the root and use '/' whatever the platform.
+    def __init__(
+            self,
+            root: Path,
+            ignore_files: Iterable[str] = ('.gitignore', '.vcwignore'),
+            excluded_dirs: Iterable[str] = (),
+            excluded_files: Iterable[str] = ()
+        ) -> None:
+
+        self.root = Path(root)
+        self.ignore_files = ignore_files
+        self.excluded_dirs = excluded_dirs
+        self.excluded_files = excluded_files
+        self.matchers: Dict[str, IgnoreMatcher] = {}
+        self.ignored_dirs: Dict[str, bool] = {}
+
+    def invalidate(self) -> None:
+        # Called when an ignore file changed, rules are read again on demand
+        self.matchers = {}
+        self.ignored_dirs = {}
+
+    def read_rules(self, directory: str) -> List[IgnoreRule]:
+        rules = []
+        for name in self.ignore_files:
+            try:
+                with open(self.root / directory / name, 'r', encoding='utf-8', errors='replace') as file:
+                    lines = file.read().splitlines()
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logging.error(f"Error reading ignore file: {e}")
+                continue
+            rules.extend(rule for rule in (parse_rule(line, directory) for line in lines) if rule)
+        return rules
+
+    def matcher(self, directory: str) -> IgnoreMatcher:
+        matcher = self.matchers.get(directory)
+        if matcher is None:
+            parent = self.matcher(directory.rpartition('/')[0]) if directory else IgnoreMatcher([])
+            rules = self.read_rules(directory)
+            # Directories without ignore files share their parent's matcher
+            matcher = IgnoreMatcher(parent.rules + rules) if rules else parent
+            self.matchers[directory] = matcher
+        return matcher
+
+    def match(self, path: str, is_dir: bool = False) -> bool:
+        # Only checks `path` itself, its parent directories must not be ignored
+        directory, _, name = path.rpartition('/')
+        if name in (self.excluded_dirs if is_dir else self.excluded_files):
+            return True
+        return self.matcher(directory).matches(path, is_dir)
+
+    def dir_ignored(self, directory: str) -> bool:
+        ignored = self.ignored_dirs.get(directory)
+        if ignored is None:
+            parent = directory.rpartition('/')[0]
+            ignored = (bool(parent) and self.dir_ignored(parent)) or self.match(directory, True)
+            self.ignored_dirs[directory] = ignored
+        return ignored
+
+    def is_ignored(self, path: str, is_dir: bool = False) -> bool:
+        # Files inside an ignored directory cannot be re-included, as with git
+        directory = path.rpartition('/')[0]
+        if directory and self.dir_ignored(directory):
+            return True
+        return self.match(path, is_dir)
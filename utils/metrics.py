@@ -0,0 +1,199 @@
+import time
+import logging
+import itertools
+import threading
+
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(10)) # 1 KB to 256 MB
+TOKEN_BUCKETS = (100, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def format_name(name: str, labels: Labels, prefix: str = '') -> str:
+    if not labels:
+        return prefix + name
+    return prefix + name + '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # The last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, share: float) -> float:
+        # Upper bound of the bucket holding the observation, capped by the largest one seen
+        rank, seen = share * self.count, 0
+        for bound, count in zip(self.buckets + (self.max,), self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    # Counters, histograms and gauges for the event pipeline. Gauges are read from
+    # callbacks when collected, so nothing is computed on the hot path. With `trace`
+    # enabled, spans opened while an event is processed are kept per event.
+    def __init__(self, trace: bool = False, trace_buffer: int = 1000) -> None:
+        self.lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self.callbacks: Dict[Tuple[str, Labels], Tuple[str, Callable[[], float]]] = {}
+        self.help: Dict[str, str] = {}
+
+        self.trace = trace
+        self.traces: deque = deque(maxlen=trace_buffer)
+        self.trace_ids = itertools.count(1)
+        self.local = threading.local()
+
+    def describe(self, name: str, text: str) -> None:
+        self.help[name] = text
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = LATENCY_BUCKETS, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def register(self, name: str, read: Callable[[], float], kind: str = 'gauge', **labels: str) -> None:
+        # `kind` is 'counter' for values which only grow, but are kept elsewhere
+        with self.lock:
+            self.callbacks[(name, tuple(sorted(labels.items())))] = (kind, read)
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[None]:
+        # Times the block into the `<name>_seconds` histogram
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(f"{name}_seconds", seconds)
+            trace_id = getattr(self.local, 'trace_id', None)
+            if trace_id is not None:
+                self.traces.append({
+                    'trace_id': trace_id,
+                    'span': name,
+                    'ms': round(seconds * 1000, 3),
+                    **attributes
+                })
+
+    @contextmanager
+    def trace_event(self, name: str, **attributes) -> Iterator[None]:
+        # Spans opened inside the block on this thread are recorded under one trace id
+        if not self.trace:
+            with self.span(name):
+                yield
+            return
+
+        self.local.trace_id = next(self.trace_ids)
+        try:
+            with self.span(name, **attributes):
+                yield
+        finally:
+            self.local.trace_id = None
+
+    def read_callbacks(self) -> List[Tuple[str, Labels, str, float]]:
+        with self.lock:
+            callbacks = list(self.callbacks.items())
+        values = []
+        for (name, labels), (kind, read) in callbacks:
+            try:
+                values.append((name, labels, kind, read()))
+            except Exception as e:
+                logging.error(f"Error reading metric {name}: {e}")
+        return values
+
+    def collect(self) -> Dict:
+        # JSON friendly snapshot
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (histogram.count, histogram.sum, histogram.max, histogram.quantile(0.5),
+                                histogram.quantile(0.95), histogram.quantile(0.99))
+                          for key, histogram in self.histograms.items()}
+
+        snapshot = {'counters': {}, 'gauges': {}, 'histograms': {}}
+        for (name, labels), value in counters.items():
+            snapshot['counters'][format_name(name, labels)] = value
+        for name, labels, kind, value in self.read_callbacks():
+            snapshot['counters' if kind == 'counter' else 'gauges'][format_name(name, labels)] = value
+        for (name, labels), (count, total, largest, p50, p95, p99) in histograms.items():
+            snapshot['histograms'][format_name(name, labels)] = {
+                'count': count, 'sum': total, 'max': largest, 'p50': p50, 'p95': p95, 'p99': p99
+            }
+        return snapshot
+
+    def to_prometheus(self, prefix: str = 'vcwatcher_') -> str:
+        lines, typed = [], set()
+
+        def header(name: str, kind: str) -> None:
+            if name in typed:
+                return
+            typed.add(name)
+            if name in self.help:
+                lines.append(f"# HELP {prefix}{name} {self.help[name]}")
+            lines.append(f"# TYPE {prefix}{name} {kind}")
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = [
+                (key, histogram.buckets, list(histogram.counts), histogram.count, histogram.sum)
+                for key, histogram in sorted(self.histograms.items())
+            ]
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f"{format_name(name, labels, prefix)} {value}")
+        for name, labels, kind, value in sorted(self.read_callbacks()):
+            header(name, kind)
+            lines.append(f"{format_name(name, labels, prefix)} {value}")
+        for (name, labels), buckets, counts, count, total in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f"{format_name(name + '_bucket', labels + (('le', str(bound)),), prefix)} {cumulative}")
+            lines.append(f"{format_name(name + '_sum', labels, prefix)} {total}")
+            lines.append(f"{format_name(name + '_count', labels, prefix)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def format_text(self) -> str:
+        # Short human readable form for the `stats` command
+        snapshot = self.collect()
+        lines = [f"{name}: {value}" for name, value in sorted(snapshot['counters'].items())]
+        lines += [f"{name}: {value}" for name, value in sorted(snapshot['gauges'].items())]
+        for name, summary in sorted(snapshot['histograms'].items()):
+            scale, unit = (1000, 'ms') if name.endswith('_seconds') else (1, '')
+            lines.append(
+                f"{name}: count={summary['count']} "
+                + " ".join(f"{q}={summary[q] * scale:.1f}{unit}" for q in ('p50', 'p95', 'p99', 'max'))
+            )
+        return "\n".join(lines)
+
+    def recent_traces(self, limit: Optional[int] = None) -> List[Dict]:
+        traces = list(self.traces)
+        return traces[-limit:] if limit else traces
@@ -0,0 +1,96 @@
+from typing import Dict, List, Mapping, Optional
+
+from utils.diff_serializer import DiffSerializer
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly 4 characters per token for English text and source code
+    return (len(text) + 3) // 4
+
+
+def legacy_tokens(diff_state: Mapping[str, List]) -> int:
+    # Size of the payload in the original format, `str()` of the diffs per file
+    return estimate_tokens(str(dict(diff_state)))
+
+
+class PayloadBuilder:
+    # Serializes the commit cache into per-file sections and packs them into
+    # chunks under `chunk_tokens`, stopping once `total_tokens` is spent.
+    # Files of the same directory end up next to each other since paths are sorted.
+    def __init__(
+            self,
+            chunk_tokens: int = 3000,
+            total_tokens: int = 12000,
+            serializer: Optional[DiffSerializer] = None
+        ) -> None:
+
+        self.chunk_tokens = chunk_tokens
+        self.total_tokens = total_tokens
+        self.serializer = serializer if serializer is not None else DiffSerializer()
+
+    def serialize(self, file_path: str, changes: List) -> List[str]:
+        return self.serializer.serialize(file_path, changes)
+
+    def sections(self, diff_state: Mapping[str, List]) -> List[List[str]]:
+        return self.serializer.sections(diff_state)
+
+    def report(self, diff_state: Mapping[str, List], chunks: List[str]) -> Dict[str, int]:
+        # Tokens sent against the original format, for the savings in `stats`
+        return {
+            'tokens': sum(estimate_tokens(chunk) for chunk in chunks),
+            'legacy_tokens': legacy_tokens(diff_state),
+        }
+
+    def split(self, section: List[str]) -> List[str]:
+        # A single file larger than a chunk is split on line boundaries
+        header, parts, current, tokens = section[0], [], [section[0]], estimate_tokens(section[0])
+        for line in section[1:]:
+            line_tokens = estimate_tokens(line) + 1
+            if tokens + line_tokens > self.chunk_tokens and len(current) > 1:
+                parts.append("\n".join(current))
+                current, tokens = [f"{header} (continued)"], estimate_tokens(header) + 3
+            current.append(line)
+            tokens += line_tokens
+        parts.append("\n".join(current))
+        return parts
+
+    def build(self, diff_state: Mapping[str, List]) -> List[str]:
+        # Sections are serialized as they are packed, so that the compact format only
+        # references hunks of the chunk it is in: every map request stands on its own
+        chunks: List[str] = []
+        current: List[str] = []
+        current_tokens = total = 0
+        paths = sorted(diff_state)
+        self.serializer.reset()
+
+        for index, file_path in enumerate(paths):
+            section = self.serialize(file_path, diff_state[file_path])
+            if len(section) <= 1:
+                continue
+            parts = self.split(section)
+            if current and (len(parts) > 1 or current_tokens + estimate_tokens(parts[0]) + 1 > self.chunk_tokens):
+                chunks.append("\n".join(current))
+                current, current_tokens = [], 0
+                self.serializer.reset()
+                parts = self.split(self.serialize(file_path, diff_state[file_path]))
+
+            for part in parts:
+                part_tokens = estimate_tokens(part) + 1
+                if total + part_tokens > self.total_tokens:
+                    remaining = sum(1 for path in paths[index:] if self.serializer.flatten(diff_state[path]))
+                    current.append(f"... {remaining} more changed files truncated")
+                    chunks.append("\n".join(current))
+                    return chunks
+
+                if current and current_tokens + part_tokens > self.chunk_tokens:
+                    chunks.append("\n".join(current))
+                    current, current_tokens = [], 0
+                current.append(part)
+                current_tokens += part_tokens
+                total += part_tokens
+            if len(parts) > 1:
+                self.serializer.reset() # Its first hunks are in an earlier chunk
+
+        if current:
+            chunks.append("\n".join(current))
+        return chunks
@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+from pathlib import Path
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from utils.utils import make_state_dir
+
+
+class ResponseCache:
+    # LRU cache of LLM responses with a time to live, keyed on the model, the
+    # prompt and the normalized request content. Optionally persisted as JSON.
+    def __init__(self, max_entries: int = 128, ttl: float = 7 * 24 * 3600) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path: Optional[Path] = None
+        self.entries: OrderedDict[str, Tuple[float, str]] = OrderedDict() # key -> (created, response)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize(content: str) -> str:
+        # Trailing whitespace and line endings do not change what the model is asked
+        lines = content.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        return '\n'.join(line.rstrip() for line in lines).strip('\n')
+
+    def key(self, model: str, prompt: str, content: str) -> str:
+        hasher = hashlib.blake2b(digest_size=16)
+        for part in (model, self.normalize(prompt), self.normalize(content)):
+            hasher.update(part.encode('utf-8'))
+            hasher.update(b'\0')
+        return hasher.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, response: str) -> None:
+        with self.lock:
+            self.entries[key] = (time.time(), response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        self.save()
+
+    def open(self, path: Path) -> None:
+        self.path = path
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                entries = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.error(f"Error loading response cache: {e}")
+            return
+
+        with self.lock:
+            now = time.time()
+            for key, (created, response) in entries.items():
+                if now - created <= self.ttl:
+                    self.entries[key] = (created, response)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+
+        with self.lock:
+            entries = dict(self.entries)
+        try:
+            make_state_dir(self.path.parent)
+            temp_path = self.path.with_suffix('.tmp')
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump(entries, file)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logging.error(f"Error saving response cache: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,221 @@
+import os
+import mmap
+import zlib
+import hashlib
+import logging
+import threading
+
+from typing import Callable, Dict, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def decompress(blob: bytes, compression: str) -> bytes:
+    # Module level, so worker processes can decompress blobs without a store
+    if compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(blob)
+    if compression == 'none':
+        return blob
+    return zlib.decompress(blob)
+
+def content_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def read_and_hash(path: str, chunk_size: int = 1024 * 1024, keep: bool = True) -> Tuple[bytes, str]:
+    # Hashes while streaming the file, so the digest is ready as soon as the read is done.
+    # With `keep` disabled only the digest is computed, for files too large to hold.
+    hasher = hashlib.blake2b(digest_size=16)
+    chunks = []
+    with open(path, 'rb') as file:
+        while chunk := file.read(chunk_size):
+            hasher.update(chunk)
+            if keep:
+                chunks.append(chunk)
+    return b''.join(chunks), hasher.hexdigest()
+
+
+class SnapshotStore:
+    # Content-addressed store for file baselines. Identical contents are kept
+    # once, compressed, and reference counted by the FileRepr objects using them.
+    # When `pack_path` is set, blobs above `max_resident_bytes` are spilled to an
+    # append-only pack file which is read back through mmap. Contents added with
+    # `put_lazy` are only read from their loader when they are first needed.
+    def __init__(
+            self,
+            compression: str = 'zlib',
+            pack_path: Optional[str] = None,
+            max_resident_bytes: int = 64 * 1024 * 1024
+        ) -> None:
+
+        if compression == 'zstd' and zstandard is None:
+            logging.error("zstandard is not installed, falling back to zlib compression")
+            compression = 'zlib'
+
+        self.compression = compression
+        self.pack_path = pack_path
+        self.max_resident_bytes = max_resident_bytes
+
+        self.blobs: Dict[str, bytes] = {} # hash -> compressed blob held in memory
+        self.packed: Dict[str, Tuple[int, int]] = {} # hash -> (offset, length) in the pack file
+        self.refs: Dict[str, int] = {}
+        self.sizes: Dict[str, int] = {} # hash -> uncompressed size
+        self.loaders: Dict[str, Callable] = {} # hash -> loader of a blob not read yet
+
+        self.resident_bytes = 0
+        self.pack_bytes = 0
+        self.dedup_hits = 0
+
+        self.pack_file = None
+        self.pack_map: Optional[mmap.mmap] = None
+        self.lock = threading.RLock()
+
+    def compress(self, data: bytes) -> bytes:
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor().compress(data)
+        if self.compression == 'none':
+            return data
+        return zlib.compress(data)
+
+    def decompress(self, blob: bytes) -> bytes:
+        return decompress(blob, self.compression)
+
+    def put(self, data: bytes, digest: Optional[str] = None) -> str:
+        digest = digest or content_hash(data)
+
+        with self.lock:
+            if digest in self.refs:
+                self.refs[digest] += 1
+                self.dedup_hits += 1
+                if digest in self.loaders:
+                    self.adopt(digest, self.compress(data)) # No need to load it anymore
+                return digest
+
+            blob = self.compress(data)
+            self.blobs[digest] = blob
+            self.refs[digest] = 1
+            self.sizes[digest] = len(data)
+            self.resident_bytes += len(blob)
+
+            if self.pack_path and self.resident_bytes > self.max_resident_bytes:
+                self.spill()
+        return digest
+
+    def put_lazy(self, digest: str, size: int, loader: Callable[[], Optional[Tuple[bytes, str]]]) -> str:
+        # Content kept elsewhere, e.g. in the baseline index. `loader` returns it
+        # compressed, with its compression, and is called on the first `get`.
+        with self.lock:
+            if digest in self.refs:
+                self.refs[digest] += 1
+                self.dedup_hits += 1
+                return digest
+            self.refs[digest] = 1
+            self.sizes[digest] = size
+            self.loaders[digest] = loader
+        return digest
+
+    def load(self, digest: str, loader: Callable[[], Optional[Tuple[bytes, str]]]) -> bytes:
+        try:
+            loaded = loader()
+        except Exception as e:
+            logging.error(f"Error loading snapshot {digest}: {e}")
+            loaded = None
+        if loaded is None:
+            logging.error(f"Snapshot {digest} is missing, using empty content")
+            loaded = (b'', 'none')
+
+        blob, compression = loaded
+        if compression != self.compression:
+            blob = self.compress(decompress(blob, compression))
+        with self.lock:
+            if digest in self.loaders:
+                self.adopt(digest, blob)
+            return self.blobs.get(digest, blob) # Loaded by another thread meanwhile, or released
+
+    def adopt(self, digest: str, blob: bytes) -> None:
+        with self.lock:
+            del self.loaders[digest]
+            self.blobs[digest] = blob
+            self.resident_bytes += len(blob)
+            if self.pack_path and self.resident_bytes > self.max_resident_bytes:
+                self.spill()
+
+    def lazy_digests(self) -> set[str]:
+        with self.lock:
+            return set(self.loaders)
+
+    def get(self, digest: str) -> bytes:
+        return self.decompress(self.blob(digest))
+
+    def blob(self, digest: str) -> bytes:
+        # Compressed form, cheaper to hand to another process than the content
+        with self.lock:
+            blob = self.blobs.get(digest)
+            loader = self.loaders.get(digest) if blob is None else None
+            if blob is None and loader is None:
+                offset, length = self.packed[digest]
+                if self.pack_map is None:
+                    self.pack_map = mmap.mmap(self.pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+                blob = self.pack_map[offset:offset + length]
+        if loader is not None:
+            blob = self.load(digest, loader) # Outside the lock, loading may take a while
+        return blob
+
+    def retain(self, digest: str) -> None:
+        with self.lock:
+            self.refs[digest] += 1
+
+    def release(self, digest: str) -> None:
+        with self.lock:
+            refs = self.refs.get(digest, 0) - 1
+            if refs > 0:
+                self.refs[digest] = refs
+                return
+
+            self.refs.pop(digest, None)
+            self.sizes.pop(digest, None)
+            self.packed.pop(digest, None) # Space in the pack file is not reclaimed
+            self.loaders.pop(digest, None)
+            blob = self.blobs.pop(digest, None)
+            if blob is not None:
+                self.resident_bytes -= len(blob)
+
+    def spill(self) -> None:
+        with self.lock:
+            if self.pack_file is None:
+                self.pack_file = open(self.pack_path, 'w+b')
+
+            self.pack_file.seek(0, os.SEEK_END)
+            for digest, blob in self.blobs.items():
+                self.packed[digest] = (self.pack_file.tell(), len(blob))
+                self.pack_file.write(blob)
+                self.pack_bytes += len(blob)
+            self.pack_file.flush()
+
+            if self.pack_map is not None:
+                self.pack_map.close()
+                self.pack_map = None
+
+            self.blobs.clear()
+            self.resident_bytes = 0
+
+    def close(self) -> None:
+        with self.lock:
+            if self.pack_map is not None:
+                self.pack_map.close()
+                self.pack_map = None
+            if self.pack_file is not None:
+                self.pack_file.close()
+                self.pack_file = None
+
+    def memory_usage(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                'blobs': len(self.refs),
+                'raw_bytes': sum(self.sizes.values()),
+                'resident_bytes': self.resident_bytes,
+                'pack_bytes': self.pack_bytes,
+                'dedup_hits': self.dedup_hits,
+            }
@@ -0,0 +1,35 @@
+import time
+
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+
+class StartupProfile:
+    # Wall time of each startup phase, from the first import of vcwatcher.py until the
+    # roots are scanned and observed. Printed by `--profile-startup`, and kept as
+    # gauges so a slower startup also shows up in the metrics.
+    def __init__(self, started: Optional[float] = None) -> None:
+        self.started = started if started is not None else time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []
+        self.ready: Optional[float] = None # Seconds from `started` until the watcher was ready
+
+    def record(self, name: str, seconds: float) -> None:
+        self.phases.append((name, seconds))
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def mark_ready(self) -> None:
+        self.ready = time.perf_counter() - self.started
+
+    def report(self) -> str:
+        rows = list(self.phases)
+        if self.ready is not None:
+            rows.append(('ready after', self.ready))
+        width = max((len(name) for name, _ in rows), default=0)
+        return "\n".join(f"{name:<{width}}  {seconds * 1000:9.1f} ms" for name, seconds in rows)
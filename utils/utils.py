@@ -1,21 +1,93 @@
+import os
+
+from pathlib import Path
+
 class Utils:
     content_prompt = """
             Generate professional version control commit message from provided list of diffs.
-            + sign represents an addition of content, - sign represents removal. Be descriptive
-            and verbose. Do not include each line in the message.
+            Each file starts with a '--- <file path>' line.
+            + sign represents an addition of content, - sign represents removal. Lines starting
+            with ~ describe a change as a whole. Be descriptive and verbose. Do not include each
+            line in the message.
+        """
+
+    summary_prompt = """
+            Summarize the provided version control diffs as a short list of changes per file.
+            Each file starts with a '--- <file path>' line.
+            + sign represents an addition of content, - sign represents removal. Lines starting
+            with ~ describe a change as a whole.
+            This summary is one part of a larger change, it will be merged with the others.
+        """
+
+    merge_prompt = """
+            Merge the provided partial summaries of one change into a single professional
+            version control commit message. Be descriptive and verbose, but do not repeat
+            the same change twice.
         """
 
     def __init__(self):
-        self.debounce_time: int = 1  # Debounce time in seconds
-        self.last_modified_time: int = 0
+        self.settle_time: float = 0.5  # Seconds a file must be quiet before it is diffed
+        self.max_event_latency: float = 5  # Upper bound in seconds before a busy file is diffed anyway
+        self.max_pending_events: int = 10000  # Max distinct paths waiting in the event queue
+
+        self.watch_budget = None  # Max directories watched natively, the others are polled; None uses half the inotify limit
+        self.poll_min_interval: float = 1.0  # Seconds between polls of a directory which just changed
+        self.poll_max_interval: float = 30.0  # Seconds between polls of a quiet directory
+        self.poll_budget: int = 1000  # Max directories polled per second
+
+        self.max_file_size: int = 2 * 1024 * 1024  # Larger files are tracked by hash and size only
+        self.scan_workers: int = min(32, (os.cpu_count() or 1) + 4)  # Threads reading files during a full scan
+        self.diff_workers: int = min(8, os.cpu_count() or 1)  # Processes diffing large files on commit-generate, 0 disables them
+        self.diff_process_min_bytes: int = 256 * 1024  # Smaller file pairs are diffed in the calling thread
+
+        self.payload_chunk_tokens: int = 3000  # Max estimated tokens of diffs per LLM request
+        self.payload_total_tokens: int = 12000  # Max estimated tokens of diffs across all requests
+        self.payload_format = 'compact'  # 'compact' or 'plain' diff lines in LLM requests
+        self.diff_context: int = 1  # Unchanged lines sent around each change, None for changed lines only
+        self.change_summaries = None  # 'alongside' or 'instead' of line diffs, for languages with a summarizer
+        self.completion_concurrency: int = 4  # Max concurrent LLM requests when summarizing chunks
+        self.speculative_idle_time = 30  # Seconds a changed file is left alone before it is summarized in the background, None disables it
+        self.speculative_requests_per_minute: int = 10  # Max background summary requests per minute
+        self.speculative_daily_tokens: int = 100000  # Max estimated tokens spent on background summaries per day
+        self.completion_timeout: float = 60  # Seconds before a single LLM request is abandoned
+        self.completion_retries: int = 3  # Retries on connection, rate limit and server errors
+        self.completion_stream: bool = True  # Print the commit message as it is generated
+        self.api_base_url = None  # Custom OpenAI compatible endpoint, e.g. a local stub server
+        self.completion_model = "gpt-3.5-turbo"
+
+        self.commit_cache_max_bytes: int = 64 * 1024 * 1024  # Pending baselines kept before their diffs are folded
+
+        self.response_cache_entries: int = 128  # Responses kept for identical requests
+        self.response_cache_ttl: float = 7 * 24 * 3600  # Seconds before a cached response expires
+        self.response_cache_path = '.vcwatcher/responses.json'  # Relative to the observed root, None keeps it in memory
+
+        self.index_path = '.vcwatcher/index.sqlite'  # Baseline index relative to the observed root, None disables it
+
+        self.daemon_socket = '.vcwatcher/daemon.sock'  # API socket relative to the first root, None uses TCP instead
+        self.daemon_port: int = 8765  # Localhost port used without a Unix socket
+
+        self.metrics_port = None  # Serve /metrics on this localhost port in interactive mode, None disables it
+        self.trace_events: bool = False  # Record timed spans per processed event, shown by /traces
+        self.trace_buffer: int = 1000  # Most recent spans kept
+
+        self.snapshot_compression = 'zlib'  # 'zlib', 'zstd' (requires zstandard) or 'none'
+        self.snapshot_pack_path = None  # Set to a file path to spill baselines to an mmap'ed pack file
+        self.snapshot_max_resident_bytes: int = 64 * 1024 * 1024  # Compressed bytes kept in memory before spilling
+
+        self.diff_engine = 'patience'  # 'patience' or 'myers'
+        self.diff_max_lines: int = 50000  # Larger files are reported as rewritten instead of diffed
+        self.diff_max_edits: int = 1000  # Regions with more edits are reported as replaced as a whole
 
         self.modified_file_path = ""
 
+        self.ignore_files = ('.gitignore', '.vcwignore')  # gitignore style rule files read in every directory
+
         self.excluded_dirs = {
             'node_modules', 
             '.git', 
             '__pycache__', 
-            'venv'
+            'venv',
+            '.vcwatcher'
         }
         self.excluded_files = {
             'db.sqlite3', 
@@ -23,3 +95,16 @@ class Utils:
             'package-lock.json', 
             '.env',
         }
+
+
+def make_state_dir(path: Path) -> None:
+    # The state directory usually sits in the watched repository. When it is created
+    # here, a .gitignore keeps its index, cache and socket out of `git status`.
+    if path.is_dir():
+        return
+    path.mkdir(parents=True, exist_ok=True)
+    try:
+        with open(path / '.gitignore', 'w') as file:
+            file.write('*\n')
+    except OSError:
+        pass
@@ -1,20 +1,58 @@
+import time
+STARTED = time.perf_counter() # `--profile-startup` times the imports below
+
 import os
 import sys
-import time
+import signal
+import logging
 import threading
 from pathlib import Path
+from typing import Dict, List, Optional
 
 from dotenv import load_dotenv
-from watchdog.observers import Observer
 
 from handlers.file_event_handler import FileEventHandler
 from handlers.file_history_handler import FileHistoryHandler
-from handlers.completion_handler import CompletionHandler
+from handlers.completion_handler import CompletionHandler, NO_CHANGES_MSG, COMMIT_HEADER
+from handlers.daemon_server import DaemonServer, TextResponse
+from handlers.event_queue import EventQueue
+from handlers.hybrid_observer import HybridObserver, inotify_watch_limit
+from handlers.speculative_summarizer import SpeculativeSummarizer
 
 from utils.utils import Utils
+from utils.snapshot_store import SnapshotStore
+from utils.diff_engine import create_diff_engine
+from utils.payload_builder import PayloadBuilder
+from utils.response_cache import ResponseCache
+from utils.commit_cache import CommitCache
+from utils.diff_pool import DiffPool
+from utils.metrics import Metrics
+from utils.startup_profile import StartupProfile
+
+IMPORTED = time.perf_counter()
+
+class WatchedRoot:
+    # One observed directory, with its own baseline tree and pending changes.
+    # Roots share the snapshot store, the diff engine, the event queue and the LLM client.
+    def __init__(
+            self,
+            path: Path,
+            file_history: FileHistoryHandler,
+            event_handler: FileEventHandler,
+            commit_cache: CommitCache
+        ) -> None:
+
+        self.path = path
+        self.file_history = file_history
+        self.event_handler = event_handler
+        self.commit_cache = commit_cache
+
 
 class VCWatcher:
     def __init__(self, API_KEY: str):
+        self.profile = StartupProfile(STARTED)
+        self.profile.record('imports', IMPORTED - STARTED)
+        initializing = time.perf_counter()
         load_dotenv()
 
         self.api_key = os.getenv(API_KEY)
@@ -23,65 +61,454 @@ class VCWatcher:
             raise ValueError(f"API key not found in .env file: {API_KEY}")
 
         self.utils = Utils()
-        self.completion = CompletionHandler(self.api_key)
-        self.file_history = FileHistoryHandler(utils=self.utils)
+        self.metrics = Metrics(trace=self.utils.trace_events, trace_buffer=self.utils.trace_buffer)
+        self.store = SnapshotStore(
+            compression=self.utils.snapshot_compression,
+            pack_path=self.utils.snapshot_pack_path,
+            max_resident_bytes=self.utils.snapshot_max_resident_bytes
+        )
+        self.diff_engine = create_diff_engine(
+            self.utils.diff_engine,
+            max_lines=self.utils.diff_max_lines,
+            max_edits=self.utils.diff_max_edits
+        )
+        # Shared by the roots, worker processes are only started for the first large diff
+        self.diff_pool = DiffPool(workers=self.utils.diff_workers, min_bytes=self.utils.diff_process_min_bytes)
+        self.completion = CompletionHandler(
+            self.api_key,
+            payload_builder=PayloadBuilder(
+                chunk_tokens=self.utils.payload_chunk_tokens,
+                total_tokens=self.utils.payload_total_tokens
+            ),
+            max_concurrency=self.utils.completion_concurrency,
+            base_url=self.utils.api_base_url,
+            timeout=self.utils.completion_timeout,
+            max_retries=self.utils.completion_retries,
+            stream=self.utils.completion_stream,
+            model=self.utils.completion_model,
+            cache=ResponseCache(
+                max_entries=self.utils.response_cache_entries,
+                ttl=self.utils.response_cache_ttl
+            ),
+            commit_cache=CommitCache(
+                diff_engine=self.diff_engine,
+                max_bytes=self.utils.commit_cache_max_bytes,
+                context=self.utils.diff_context,
+                diff_pool=self.diff_pool,
+                summary_mode=self.utils.change_summaries
+            ),
+            metrics=self.metrics,
+            payload_format=self.utils.payload_format
+        )
+        # Background summaries use their own client and event loop, and share the response cache
+        self.speculative = SpeculativeSummarizer(
+            CompletionHandler(
+                self.api_key,
+                payload_builder=PayloadBuilder(
+                    chunk_tokens=self.utils.payload_chunk_tokens,
+                    total_tokens=self.utils.payload_total_tokens
+                ),
+                base_url=self.utils.api_base_url,
+                timeout=self.utils.completion_timeout,
+                max_retries=self.utils.completion_retries,
+                model=self.utils.completion_model,
+                cache=self.completion.cache,
+                metrics=self.metrics,
+                payload_format=self.utils.payload_format
+            ),
+            commit_caches=lambda: [root.commit_cache for root in self.roots],
+            idle_time=self.utils.speculative_idle_time,
+            requests_per_minute=self.utils.speculative_requests_per_minute,
+            daily_tokens=self.utils.speculative_daily_tokens,
+            metrics=self.metrics
+        )
+        self.queue = EventQueue(
+            self.process_batch,
+            settle_time=self.utils.settle_time,
+            max_latency=self.utils.max_event_latency,
+            max_pending=self.utils.max_pending_events
+        )
+        self.file_history = FileHistoryHandler(
+            utils=self.utils,
+            tree={},
+            store=self.store,
+            diff_engine=self.diff_engine,
+            metrics=self.metrics
+        )
 
         self.event_handler = FileEventHandler(
             history_handler=self.file_history,
             completion_handler=self.completion,
-            utils=self.utils
+            utils=self.utils,
+            queue=self.queue,
+            metrics=self.metrics
         )
 
         self.path = '.'
+        self.roots: List[WatchedRoot] = [
+            WatchedRoot(Path(self.path), self.file_history, self.event_handler, self.completion.commit_cache)
+        ]
+        self.observing = threading.Event() # Set once the observer has started
+        self.profile.record('init', time.perf_counter() - initializing)
 
     def log_api_key(self) -> str:
        return self.api_key
     
+    def add_root(self, path: Path) -> WatchedRoot:
+        commit_cache = CommitCache(
+            diff_engine=self.diff_engine,
+            max_bytes=self.utils.commit_cache_max_bytes,
+            context=self.utils.diff_context,
+            diff_pool=self.diff_pool,
+            summary_mode=self.utils.change_summaries
+        )
+        file_history = FileHistoryHandler(
+            utils=self.utils,
+            tree={},
+            store=self.store,
+            diff_engine=self.diff_engine,
+            metrics=self.metrics
+        )
+        event_handler = FileEventHandler(
+            history_handler=file_history,
+            completion_handler=self.completion,
+            utils=self.utils,
+            queue=self.queue,
+            commit_cache=commit_cache,
+            metrics=self.metrics
+        )
+        root = WatchedRoot(path, file_history, event_handler, commit_cache)
+        self.roots.append(root)
+        return root
+
+    def register_metrics(self) -> None:
+        # Gauges are read when metrics are collected, nothing is tracked on the hot path
+        self.metrics.describe('events_received_total', "File events received from the observer")
+        self.metrics.describe('events_coalesced_total', "Events merged into a path already queued")
+        self.metrics.describe('events_dropped_total', "Events dropped, by reason")
+        self.metrics.describe('events_skipped_total', "Events whose file content did not change")
+        self.metrics.describe('events_reconciled_total', "Move events applied to the tree in place")
+        self.metrics.describe('files_skipped_total', "Reads avoided by the stat or hash checks")
+        self.metrics.describe('llm_requests_total', "LLM requests, by outcome")
+        self.metrics.describe('speculative_summaries_total', "Background summaries of idle files, by outcome")
+        self.metrics.describe('speculative_summaries_used_total', "Files merged from a background summary on commit-generate")
+        self.metrics.describe('payload_tokens_total', "Estimated tokens of diffs sent to the LLM")
+        self.metrics.describe('payload_legacy_tokens_total', "Tokens the same diffs took in the original str() format")
+        self.metrics.register('events_coalesced_total', lambda: self.queue.coalesced, kind='counter')
+        self.metrics.register('queue_pending_events', lambda: len(self.queue.pending))
+        self.metrics.register('diffs_offloaded_total', lambda: self.diff_pool.offloaded, kind='counter')
+        for name in ('blobs', 'raw_bytes', 'resident_bytes', 'pack_bytes'):
+            self.metrics.register(f'snapshot_store_{name}', lambda name=name: self.store.memory_usage()[name])
+        self.metrics.register('response_cache_entries', lambda: self.completion.cache.stats()['entries'])
+        for root in self.roots:
+            path = str(root.path)
+            self.metrics.register('tree_files', lambda root=root: len(root.file_history.files), root=path)
+            self.metrics.register('commit_cache_files', lambda root=root: len(root.commit_cache), root=path)
+            self.metrics.register('commit_cache_bytes', root.commit_cache.memory_usage, root=path)
+
+    def register_startup_metrics(self) -> None:
+        self.metrics.describe('startup_seconds', "Wall time of each startup phase")
+        for name, seconds in self.profile.phases:
+            self.metrics.register('startup_seconds', lambda seconds=seconds: seconds, phase=name)
+        self.metrics.register('startup_seconds', lambda: self.profile.ready, phase='ready')
+
+    def metrics_report(self, format: str = 'json'):
+        if format == 'prometheus':
+            return TextResponse(self.metrics.to_prometheus())
+        return self.metrics.collect()
+
+    def traces(self, limit: Optional[str] = None) -> List[Dict]:
+        return self.metrics.recent_traces(int(limit) if limit else None)
+
+    def serve_metrics(self, port: int) -> DaemonServer:
+        # Metrics endpoint for the interactive mode, the daemon serves them with its API
+        server = DaemonServer({
+            ('GET', '/metrics'): self.metrics_report,
+            ('GET', '/traces'): self.traces,
+        })
+        print(f"Metrics are served on {server.bind(port=port)}/metrics")
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def root_for(self, path: str) -> Optional[WatchedRoot]:
+        # The innermost root wins when roots are nested
+        matches = [root for root in self.roots if root.file_history.relative_parts(path)]
+        return max(matches, key=lambda root: len(root.path.parts), default=None)
+
+    def process_batch(self, paths: List[str]) -> None:
+        for path in paths:
+            root = self.root_for(path)
+            if root is not None:
+                root.event_handler.process_file(path)
+
+    def create_observer(self, polling: bool = False):
+        # With a kernel watch budget, only the most active directories are watched. The
+        # recursive Observer would also watch ignored ones, like .git or node_modules.
+        # watchdog.observers loads the platform backend, so it is imported here.
+        budget = self.utils.watch_budget or inotify_watch_limit()
+        if budget is None and not polling:
+            from watchdog.observers import Observer
+            observer = Observer()
+            for root in self.roots:
+                observer.schedule(root.event_handler, root.path, recursive=True)
+            return observer
+
+        observer = HybridObserver(
+            watch_budget=budget or 0, # The Observer failed to start: every directory is polled
+            min_interval=self.utils.poll_min_interval,
+            max_interval=self.utils.poll_max_interval,
+            poll_budget=self.utils.poll_budget
+        )
+        for root in self.roots:
+            observer.schedule(
+                root.event_handler, str(root.path), root.file_history.dirs, root.file_history.is_ignored
+            )
+        for name in ('watched', 'polled'):
+            self.metrics.register(f'{name}_directories', lambda name=name: observer.stats()[name])
+        self.metrics.register('directory_polls_total', lambda: observer.stats()['polls'], kind='counter')
+        return observer
+
     def observe_dir(self) -> None:
-        observer = Observer()
-        observer.schedule(self.event_handler, self.path, recursive=True)
-        observer.start()
-        
+        # One observer schedules every root, one queue worker processes their events
+        try:
+            with self.profile.phase('observer'):
+                observer = self.create_observer()
+                self.queue.start()
+                observer = self.start_observer(observer)
+        except OSError as e:
+            # e.g. out of inotify instances or watches
+            logging.error(f"Error starting the observer, changes are not watched: {e}")
+            self.queue.stop()
+            return
+        finally:
+            self.observing.set() # Also on failure, nothing waits on it forever
+
         try:
             while True:
                 time.sleep(1)
         except KeyboardInterrupt:
             observer.stop()
         observer.join()
+        self.queue.stop()
+
+    def start_observer(self, observer):
+        try:
+            observer.start()
+        except OSError as e:
+            if isinstance(observer, HybridObserver):
+                raise
+            # e.g. out of kernel watches or file descriptors
+            logging.error(f"Error starting the observer, polling directories instead: {e}")
+            try:
+                observer.stop()
+            except Exception:
+                pass
+            observer = self.create_observer(polling=True)
+            observer.start()
+        return observer
 
     def start_observing_in_thread(self) -> None:
         observing_thread = threading.Thread(target=self.observe_dir)
         observing_thread.daemon = True
         observing_thread.start()
 
+    def reconcile_stale(self, root: WatchedRoot) -> None:
+        # Diff files which changed while VCWatcher was not running against their indexed baseline
+        for stale_path in root.file_history.stale:
+            root.event_handler.process_file(stale_path)
+        if root.file_history.stale:
+            print(f"Found {len(root.file_history.stale)} files changed in {root.path} since the last run.")
+        root.file_history.save_index()
+
+    def scan_roots(self) -> None:
+        for root in self.roots:
+            root.file_history.construct_tree()
+            print(f"{root.path}: {root.file_history.scan_report()}")
+            self.reconcile_stale(root)
+
+    def save_indexes(self) -> None:
+        for root in self.roots:
+            root.file_history.save_index()
+
+    def generate_commit_msgs(self) -> None:
+        # One message per root, from that root's pending changes only
+        for root in self.roots:
+            if len(self.roots) > 1:
+                print(f"\n[{root.path}]")
+            try:
+                response = self.completion.generate_commit_msg(commit_cache=root.commit_cache)
+            except Exception as e:
+                # Baselines are only advanced on success, the changes stay pending for the next try
+                print(f"\nError generating the commit message, the changes are kept: {e}")
+                continue
+            # A streamed message was already printed as it arrived
+            print("" if self.completion.stream and response != NO_CHANGES_MSG else response)
+
+    def select_roots(self, root: Optional[str] = None) -> List[WatchedRoot]:
+        # All roots, or the innermost one containing `root`
+        if root is None:
+            return self.roots
+        target = Path(root).resolve()
+        matches = [
+            watched for watched in self.roots
+            if watched.path.resolve() == target or watched.path.resolve() in target.parents
+        ]
+        if not matches:
+            raise ValueError(f"{root} is not inside a watched root")
+        return [max(matches, key=lambda watched: len(watched.path.resolve().parts))]
+
+    def status(self) -> Dict:
+        return {
+            'roots': [
+                {
+                    'path': str(root.path),
+                    'files': len(root.file_history.files),
+                    'pending_files': len(root.commit_cache),
+                }
+                for root in self.roots
+            ],
+            'queued_events': len(self.queue.pending),
+            'store': self.store.memory_usage(),
+            'response_cache': self.completion.cache.stats(),
+        }
+
+    def pending_diffs(self, root: Optional[str] = None) -> Dict[str, Dict[str, List[str]]]:
+        # Net diffs since the last message, the baselines are not advanced
+        return {str(watched.path): watched.commit_cache.net_diffs()[0] for watched in self.select_roots(root)}
+
+    def generate(self, root: Optional[str] = None) -> Dict[str, Optional[str]]:
+        # Bare messages per root, None where nothing changed
+        messages = {}
+        for watched in self.select_roots(root):
+            response = self.completion.generate_commit_msg(commit_cache=watched.commit_cache)
+            messages[str(watched.path)] = None if response == NO_CHANGES_MSG else response.removeprefix(COMMIT_HEADER)
+        return messages
+
+    def reset(self, root: Optional[str] = None) -> List[str]:
+        # Drops the pending changes, the current files become the new baselines
+        selected = self.select_roots(root)
+        for watched in selected:
+            watched.commit_cache.clear()
+        return [str(watched.path) for watched in selected]
+
+    def resync(self) -> Dict:
+        self.save_indexes()
+        self.scan_roots()
+        return self.status()
+
+    def serve(self) -> None:
+        # Headless mode: the warm state is driven through the socket API instead of the prompt
+        self.completion.stream = False
+        server = DaemonServer({
+            ('GET', '/status'): self.status,
+            ('GET', '/diffs'): self.pending_diffs,
+            ('POST', '/generate'): self.generate,
+            ('POST', '/reset'): self.reset,
+            ('POST', '/resync'): self.resync,
+            ('GET', '/metrics'): self.metrics_report,
+            ('GET', '/traces'): self.traces,
+        })
+        socket_path = self.path / self.utils.daemon_socket if self.utils.daemon_socket else None
+        address = server.bind(socket_path, port=self.utils.daemon_port)
+        print(f"VCWatcher daemon is listening on {address}")
+
+        def stop(_signum, _frame):
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            self.save_indexes()
+            self.speculative.stop()
+            self.diff_pool.close()
+
     def run(self) -> None:
-        if len(sys.argv) != 2:
-            print("Usage: `python vcwatcher.py <directory_to_monitor>`")
+        args = sys.argv[1:]
+        daemon = '--daemon' in args
+        profile_startup = '--profile-startup' in args
+        args = [arg for arg in args if arg not in ('--daemon', '--profile-startup')]
+        if not args:
+            print(
+                "Usage: `python vcwatcher.py [--daemon] [--profile-startup] "
+                "<directory_to_monitor> [<directory_to_monitor> ...]`"
+            )
             return
 
-        self.path = Path(sys.argv[1])
+        paths = [Path(arg) for arg in args]
+        for path in paths:
+            if not path.is_dir():
+                print(f"Error: {path} is not a valid directory.")
+                return
 
-        if not self.path.is_dir():
-            print(f"Error: {self.path} is not a valid directory.")
-            return
-        
-        self.file_history.root_path = self.path
+        self.path = paths[0]
+        self.roots[0].path = self.path
+        for path in paths[1:]:
+            self.add_root(path)
 
-        self.file_history.construct_tree()
+        with self.profile.phase('open indexes'):
+            for root in self.roots:
+                root.file_history.root_path = root.path
+                if self.utils.index_path:
+                    root.file_history.open_index(root.path / self.utils.index_path)
+            # Responses do not depend on the root, one cache serves all of them
+            if self.utils.response_cache_path:
+                self.completion.cache.open(self.path / self.utils.response_cache_path)
 
+        self.register_metrics()
+        with self.profile.phase('scan'):
+            self.scan_roots()
         self.start_observing_in_thread()
+        if profile_startup:
+            self.observing.wait()
+        self.profile.mark_ready()
+        self.register_startup_metrics()
+
+        if profile_startup:
+            # The client is only built by the first request, it is timed here to be tracked too
+            with self.profile.phase('completion client (deferred)'):
+                self.completion.client
+            print(self.profile.report())
+            self.save_indexes()
+            self.diff_pool.close()
+            return
+        # Built in the background once watching, so the first commit-generate does not wait for it
+        threading.Thread(target=lambda: self.completion.client, daemon=True).start()
+        if self.utils.speculative_idle_time is not None:
+            self.speculative.start()
+
+        if daemon:
+            self.serve()
+            return
+        if self.utils.metrics_port:
+            self.serve_metrics(self.utils.metrics_port)
 
+        observed = ", ".join(str(root.path) for root in self.roots)
         while True:
-            print(f"\nVCWatcher is observing {self.path}...")
+            print(f"\nVCWatcher is observing {observed}...")
             print("\nEnter 'commit-generate' to collect diffs and generate a message.\n")
+            print("Enter 'resync' to rebuild the file tree from disk.\n")
+            print("Enter 'stats' to show snapshot store usage, skipped events and response cache hits.\n")
             print("Enter 'exit' or 'quit' to close VCWatcher.")
             command = input("> ").lower()
             if command == "commit-generate":
-                response = watch.completion.generate_commit_msg(
-                    watch.completion.commit_cache
-                )
-                print(response)
+                self.generate_commit_msgs()
+            elif command == "resync":
+                self.save_indexes()
+                print("Rebuilding file trees.")
+                self.scan_roots()
+            elif command == "stats":
+                for root in self.roots:
+                    print(f"{root.path}: {root.file_history.scan_report()}")
+                for name, value in self.completion.cache.stats().items():
+                    print(f"response_cache_{name}: {value}")
+                print(self.metrics.format_text())
             elif command in ("exit", "quit"):
+                self.save_indexes()
+                self.speculative.stop()
+                self.diff_pool.close()
                 break
             else:
                 print("Unknown command...")
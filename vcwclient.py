@@ -0,0 +1,127 @@
+import os
+import sys
+import json
+import socket
+import argparse
+import http.client
+
+from typing import Any, Dict, Optional
+
+# Thin client for the VCWatcher daemon (`python vcwatcher.py --daemon <dir>`).
+# It only uses the standard library, so a git hook starts in milliseconds.
+
+COMMANDS = {
+    'status': 'GET',
+    'diffs': 'GET',
+    'generate': 'POST',
+    'reset': 'POST',
+    'resync': 'POST',
+    'metrics': 'GET',
+    'traces': 'GET',
+}
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float) -> None:
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request(
+        command: str,
+        params: Optional[Dict] = None,
+        socket_path: Optional[str] = None,
+        port: int = 8765,
+        timeout: float = 120
+    ) -> Any:
+
+    if socket_path is not None and hasattr(socket, 'AF_UNIX'):
+        connection = UnixHTTPConnection(socket_path, timeout)
+    else:
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+
+    body = json.dumps(params or {})
+    try:
+        connection.request(
+            COMMANDS[command], f"/{command}", body=body, headers={'Content-Type': 'application/json'}
+        )
+        response = connection.getresponse()
+        data = response.read()
+    finally:
+        connection.close()
+
+    if response.status == 200 and response.getheader('Content-Type', '').startswith('text/plain'):
+        return data.decode('utf-8')
+    reply = json.loads(data)
+
+    if response.status != 200:
+        raise RuntimeError(reply.get('error', f"HTTP {response.status}"))
+    return reply['result']
+
+
+def prepare_commit_msg(message_file: str, source: str, **options) -> None:
+    # `prepare-commit-msg` hook: fill in the message unless one was given with -m, -F,
+    # or comes from a merge, squash or amend. Never fails, so it cannot block a commit.
+    if source not in ('', 'template'):
+        return
+    try:
+        messages = request('generate', {'root': os.getcwd()}, **options)
+    except (OSError, RuntimeError, ValueError) as e:
+        print(f"vcwclient: no message from the VCWatcher daemon: {e}", file=sys.stderr)
+        return
+
+    message = next((message for message in messages.values() if message), None)
+    if message is None:
+        return
+    with open(message_file, 'r+', encoding='utf-8') as file:
+        existing = file.read()
+        file.seek(0)
+        file.write(message.strip() + '\n' + existing)
+        file.truncate()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Talk to a running VCWatcher daemon.")
+    parser.add_argument('command', choices=[*COMMANDS, 'hook'])
+    parser.add_argument('hook_args', nargs='*', help="prepare-commit-msg arguments, for `hook`")
+    parser.add_argument('--socket', default=os.getenv('VCWATCHER_SOCKET', '.vcwatcher/daemon.sock'))
+    parser.add_argument('--port', type=int, default=8765, help="Used when the socket is not available")
+    parser.add_argument('--root', help="Limit diffs, generate and reset to the root containing this path")
+    parser.add_argument('--format', choices=['json', 'prometheus'], default='json', help="For `metrics`")
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args(argv)
+
+    socket_path = args.socket if os.path.exists(args.socket) else None
+    options = {'socket_path': socket_path, 'port': args.port, 'timeout': args.timeout}
+    if args.command == 'hook':
+        if not args.hook_args:
+            parser.error("hook needs the commit message file")
+        source = args.hook_args[1] if len(args.hook_args) > 1 else ''
+        prepare_commit_msg(args.hook_args[0], source, **options)
+        return 0
+
+    params = {'root': args.root} if args.root and args.command in ('diffs', 'generate', 'reset') else {}
+    if args.command == 'metrics':
+        params = {'format': args.format}
+    try:
+        result = request(args.command, params, **options)
+    except (OSError, RuntimeError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    if isinstance(result, str):
+        print(result, end='')
+    elif args.command == 'generate':
+        for root, message in result.items():
+            print(f"[{root}]\n{message or 'No changes since the last generated commit message.'}\n")
+    else:
+        print(json.dumps(result, indent=4))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())